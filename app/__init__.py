@@ -1,6 +1,19 @@
 from flask import Flask
 from app.config import load_configurations, configure_logging
-from .views import webhook_blueprint
+from .views import analytics_blueprint, metrics_blueprint, webhook_blueprint
+from .commands import register_commands
+from .services.dedup import init_deduplicator
+from .services.delivery import init_delivery
+from .services.dispatcher import init_dispatcher, init_inbound_debouncer
+from .services.faq_index import init_faq
+from .services.flow_registry import init_flow_registry
+from .services.graph_client import init_graph_client
+from .services.inbound_queue import init_inbound_queue
+from .services.media_manager import init_media_manager
+from .services.metrics import init_metrics
+from .services.number_registry import init_number_registry
+from .services.run_coordinator import init_run_coordinator
+from .services.status_pipeline import init_status_pipeline
 
 
 def create_app():
@@ -10,7 +23,72 @@ def create_app():
     load_configurations(app)
     configure_logging()
 
+    # Background work started by `start_serving`, not by `flask` commands
+    app.extensions["serving_hooks"] = []
+
+    # Shared, keep-alive client for every outbound Graph API call
+    init_graph_client(app)
+
+    # Rate limiting, retries and dead-lettering on top of that client
+    init_delivery(app)
+
+    # Upload data/ assets once serving and keep their media ids fresh
+    init_media_manager(app)
+
+    # Reply flows compiled into payload templates
+    init_flow_registry(app)
+
+    # Further business numbers from NUMBERS_PATH, each with its own clients
+    init_number_registry(app)
+
+    # FAQ answers from the local index over data/
+    init_faq(app)
+
+    # Message-id cache that suppresses redelivered webhooks
+    init_deduplicator(app)
+
+    # Status webhooks buffered in memory, flushed to SQLite with rollups
+    init_status_pipeline(app)
+
+    # Worker pool used to run the reply flow off the request thread
+    init_dispatcher(app)
+
+    # Merge each sender's bursts of messages into one reply
+    init_inbound_debouncer(app)
+
+    # One Assistant run at a time per user, with bursts answered together
+    init_run_coordinator(app)
+
+    # Optional on-disk queue between the webhook's 200 and the reply
+    init_inbound_queue(app)
+
+    # Hot-path latency histograms and queue depths for /metrics
+    init_metrics(app)
+
+    # Fetch the OpenAI Assistant once the server starts rather than on the
+    # first reply
+    if app.config["OPENAI_API_KEY"] and app.config["OPENAI_ASSISTANT_ID"]:
+        from .services.openai_service import warm_assistant
+
+        app.extensions["serving_hooks"].append(warm_assistant)
+
     # Import and register blueprints, if any
     app.register_blueprint(webhook_blueprint)
+    app.register_blueprint(analytics_blueprint)
+    app.register_blueprint(metrics_blueprint)
+
+    # Maintenance commands, run with `flask --app run <command>`
+    register_commands(app)
 
     return app
+
+
+def start_serving(app):
+    """
+    Start the background work of a process that serves webhooks (media
+    uploads, Assistant warm-up, queue consumer, metrics exporter). Called by
+    run.py, by gunicorn.conf.py in each worker after the fork, and by the
+    async app on startup; `flask` commands never run it.
+    """
+    for start in app.extensions["serving_hooks"]:
+        start()
@@ -0,0 +1,372 @@
+"""
+Async alternative to `create_app`, served by aiohttp.
+
+Same /webhook contract as the Flask app (verification GET, signed POST,
+same status codes and bodies), but every outbound Graph API call goes
+through one shared `aiohttp.ClientSession`, so a single process can have
+thousands of conversations in flight instead of one per worker thread.
+
+Configuration, flows, the FAQ index, media, deduplication and cooldowns are
+the ones `create_app` sets up. The OpenAI SDK used by openai_service is
+synchronous, so Assistant runs go to a bounded thread pool
+(ASYNC_AI_THREADS) while everything around them stays on the event loop.
+
+Run with `python run_async.py`, or under gunicorn with
+`--worker-class aiohttp.GunicornWebWorker run_async:app`.
+"""
+import asyncio
+import functools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+from . import create_app, start_serving
+from .decorators.async_security import FLASK_APP, async_signature_required, async_token_required
+from .services.async_graph_client import AsyncGraphAPIClient, AsyncOutboundDelivery
+from .services.delivery import DeliveryFailure
+from .services.metrics import CONTENT_TYPE, SEND_SECONDS, WEBHOOK_SECONDS, Gauge, webhook_event
+from .services.number_registry import sending_from
+from .utils.debounce import AsyncKeyedDebouncer
+from .utils.webhook_parser import load_body, parse_webhook
+from .utils.whatsapp_utils import (
+    WhatsAppTextStream,
+    get_text_message_input,
+    group_by_number,
+    log_http_response,
+    plan_replies,
+    process_text_for_whatsapp,
+    resolve_reply,
+    split_for_whatsapp,
+)
+
+
+class AsyncConversations:
+    """
+    Replies to senders from the event loop.
+
+    Each sender's messages are collected by an AsyncKeyedDebouncer and
+    answered with the same merged plan as `process_burst`; at most
+    ASYNC_MAX_CONVERSATIONS bursts are worked on at once. Questions for the
+    Assistant get a second debouncer, so a user has one run at a time.
+
+    Every business number in the number registry gets its own session and
+    delivery, with the limits of its sync delivery.
+    """
+
+    def __init__(self, flask_app):
+        config = flask_app.config
+        self.flask_app = flask_app
+        self.numbers = flask_app.extensions["number_registry"]
+        self.deliveries = {}
+        for number in {self.numbers.default, *self.numbers}:
+            client = AsyncGraphAPIClient(
+                access_token=number.access_token,
+                version=config["VERSION"],
+                phone_number_id=number.phone_number_id,
+                pool_size=config["ASYNC_GRAPH_POOL_SIZE"],
+                connect_timeout=config["GRAPH_CONNECT_TIMEOUT"],
+                read_timeout=config["GRAPH_READ_TIMEOUT"],
+                base_url=config["GRAPH_BASE_URL"],
+            )
+            # Same limits as the sync delivery, and the same dead-letter log
+            self.deliveries[number] = AsyncOutboundDelivery(
+                client,
+                rate_per_second=number.delivery.rate_per_second,
+                burst=number.delivery.burst,
+                max_retries=number.delivery.max_retries,
+                dead_letter=number.delivery.dead_letter,
+            )
+        self.queue_size = config["DISPATCH_QUEUE_SIZE"]
+        self.ai_replies = config["AI_REPLIES"]
+        self.inbound = AsyncKeyedDebouncer(
+            self.reply,
+            window=config["INBOUND_DEBOUNCE_SECONDS"],
+            max_wait=config["INBOUND_DEBOUNCE_MAX_SECONDS"],
+            name="inbound-debouncer",
+        )
+        self.ai = AsyncKeyedDebouncer(
+            self.answer,
+            window=config["AI_DEBOUNCE_SECONDS"],
+            max_wait=config["AI_DEBOUNCE_MAX_SECONDS"],
+            name="ai-debouncer",
+        )
+        self.max_conversations = config["ASYNC_MAX_CONVERSATIONS"]
+        self.ai_executor = ThreadPoolExecutor(
+            max_workers=config["ASYNC_AI_THREADS"], thread_name_prefix="assistant"
+        )
+        self._semaphore = None
+
+    async def start(self):
+        for delivery in self.deliveries.values():
+            await delivery.graph_client.start()
+        self._semaphore = asyncio.Semaphore(self.max_conversations)
+
+    async def close(self):
+        await self.inbound.close()
+        await self.ai.close()
+        for delivery in self.deliveries.values():
+            await delivery.graph_client.close()
+        self.ai_executor.shutdown(wait=False)
+
+    def is_full(self, incoming):
+        return self.inbound.backlog() + incoming > self.queue_size
+
+    def accept(self, wa_id, events):
+        for event in events:
+            self.inbound.push(wa_id, event)
+
+    async def reply(self, wa_id, events):
+        """Answer a sender's events with one merged reply plan, in order."""
+        async with self._semaphore:
+            for phone_number_id, number_events in group_by_number(events).items():
+                number = self.numbers.get(phone_number_id)
+                if number is None:
+                    logging.warning(
+                        f"Ignoring {len(number_events)} message(s) "
+                        f"to unknown number {phone_number_id}"
+                    )
+                    continue
+                await self.answer_burst(number, wa_id, number_events)
+
+    async def answer_burst(self, number, wa_id, events):
+        name = events[-1].name
+        # The FAQ search and the flows' reload check block; keep them off the loop
+        plan = await asyncio.to_thread(self.plan, number, events)
+        sent = set()
+        for kind, value in plan:
+            if kind == "flow":
+                flow_name = number.cooldowns.choose(wa_id, value)
+                if flow_name:
+                    await self.send_flow(number, flow_name, wa_id, name, already_sent=sent)
+            elif kind == "text":
+                await self.send_text(number, wa_id, value)
+            elif kind == "ai":
+                self.ai.push((number.phone_number_id, wa_id), (name, value))
+
+    def plan(self, number, events):
+        """`plan_replies` for a burst, resolved as `process_burst` does."""
+        with self.flask_app.app_context(), sending_from(number):
+            return plan_replies([resolve_reply(event) for event in events])
+
+    async def answer(self, key, messages):
+        """One Assistant run for everything a user asked since their last one."""
+        from app.services import openai_service
+
+        phone_number_id, wa_id = key
+        number = self.numbers.get(phone_number_id)
+        if number is None:
+            return
+        name = messages[-1][0]
+        text = "\n".join(text for _, text in messages)
+        if len(messages) > 1:
+            logging.info(f"Answering {len(messages)} messages from {wa_id} with one run")
+        loop = asyncio.get_running_loop()
+
+        if self.ai_replies != "stream":
+            response = await loop.run_in_executor(
+                self.ai_executor, openai_service.generate_response, text, wa_id, name
+            )
+            if response:
+                await self.send_text(number, wa_id, response)
+            return
+
+        # Deltas cross over from the run's thread and are sent from the loop
+        deltas = asyncio.Queue()
+
+        def on_text(delta):
+            loop.call_soon_threadsafe(deltas.put_nowait, delta)
+
+        run = loop.run_in_executor(
+            self.ai_executor,
+            functools.partial(
+                openai_service.generate_response, text, wa_id, name, on_text=on_text
+            ),
+        )
+        # Queued after every delta the run produced
+        run.add_done_callback(lambda _: deltas.put_nowait(None))
+
+        stream = WhatsAppTextStream()
+        streamed = False
+        while True:
+            delta = await deltas.get()
+            if delta is None:
+                break
+            streamed = True
+            for chunk in stream.feed(delta):
+                await self.send_message(number, get_text_message_input(wa_id, chunk))
+        response = run.result()
+        # Polling runs produce no deltas, so format the finished reply in one go
+        chunks = stream.feed(response) if not streamed and response else []
+        for chunk in chunks + stream.flush():
+            await self.send_message(number, get_text_message_input(wa_id, chunk))
+
+    async def send_flow(self, number, flow_name, wa_id, name="", already_sent=None):
+        # Rendering may have to upload a media file first
+        payloads = await asyncio.to_thread(
+            number.flows.render, flow_name, wa_id, name, number.media_manager.resolve
+        )
+        for payload in payloads:
+            if already_sent is not None:
+                if payload in already_sent:
+                    continue
+                already_sent.add(payload)
+            await self.send_message(number, payload)
+
+    async def send_text(self, number, wa_id, text):
+        for chunk in split_for_whatsapp(process_text_for_whatsapp(text)):
+            await self.send_message(number, get_text_message_input(wa_id, chunk))
+
+    async def send_message(self, number, data):
+        started = time.perf_counter()
+        try:
+            response = await self.deliveries[number].send(data)
+        except DeliveryFailure as e:
+            SEND_SECONDS.labels(str(e.status_code or e.reason)).observe(time.perf_counter() - started)
+            logging.error(f"Request failed due to: {e}")
+            return None
+        SEND_SECONDS.labels(str(response.status_code)).observe(time.perf_counter() - started)
+        log_http_response(response)
+        return response
+
+
+CONVERSATIONS = web.AppKey("conversations", AsyncConversations)
+
+
+def json_error(message, status):
+    return web.json_response({"status": "error", "message": message}, status=status)
+
+
+async def webhook_get(request):
+    """Webhook verification, as in `views.verify`."""
+    mode = request.query.get("hub.mode")
+    token = request.query.get("hub.verify_token")
+    challenge = request.query.get("hub.challenge")
+    if mode and token:
+        if mode == "subscribe" and token == request.app[FLASK_APP].config["VERIFY_TOKEN"]:
+            logging.info("WEBHOOK_VERIFIED")
+            return web.Response(text=challenge or "", content_type="text/html")
+        logging.info("VERIFICATION_FAILED")
+        return json_error("Verification failed", 403)
+    logging.info("MISSING_PARAMETER")
+    return json_error("Missing parameters", 400)
+
+
+@async_signature_required
+async def webhook_post(request):
+    """Acknowledge a webhook delivery and queue its messages, as in `views.handle_message`."""
+    started = time.perf_counter()
+    try:
+        # read() returns the buffer the signature check already read
+        body = load_body(await request.read())
+    except ValueError:
+        logging.error("Failed to decode JSON")
+        WEBHOOK_SECONDS.labels("invalid").observe(time.perf_counter() - started)
+        return json_error("Invalid JSON provided", 400)
+
+    batch = parse_webhook(body)
+    try:
+        return await accept_batch(request, batch)
+    finally:
+        WEBHOOK_SECONDS.labels(webhook_event(batch)).observe(time.perf_counter() - started)
+
+
+async def accept_batch(request, batch):
+    """Record a parsed delivery's statuses and queue its messages."""
+    if batch.statuses:
+        pipeline = request.app[FLASK_APP].extensions["status_pipeline"]
+        if pipeline is not None:
+            pipeline.record(batch.statuses)
+        else:
+            logging.info(f"Received {len(batch.statuses)} WhatsApp status update(s).")
+
+    if batch.is_whatsapp and batch.messages:
+        deduplicator = request.app[FLASK_APP].extensions["message_deduplicator"]
+        if deduplicator.sqlite_path:
+            seen = await asyncio.to_thread(
+                lambda: [deduplicator.seen(event.message_id) for event in batch.messages]
+            )
+        else:
+            seen = [deduplicator.seen(event.message_id) for event in batch.messages]
+        batch.messages = [event for event, duplicate in zip(batch.messages, seen) if not duplicate]
+
+        conversations = request.app[CONVERSATIONS]
+        if conversations.is_full(len(batch.messages)):
+            # Let Meta redeliver later instead of piling up work
+            logging.warning("Webhook queue is full, asking Meta to retry")
+            for event in batch.messages:
+                deduplicator.forget(event.message_id)
+            return json_error("Server busy", 503)
+        for wa_id, events in batch.by_sender().items():
+            conversations.accept(wa_id, events)
+        return web.json_response({"status": "ok"})
+    elif batch.is_whatsapp and batch.statuses:
+        return web.json_response({"status": "ok"})
+    return json_error("Not a WhatsApp API event", 404)
+
+
+@async_token_required("ANALYTICS_TOKEN")
+async def status_analytics(request):
+    """Same as `views.status_analytics`."""
+    flask_app = request.app[FLASK_APP]
+    pipeline = flask_app.extensions["status_pipeline"]
+    if pipeline is None:
+        return json_error("Status analytics are off", 404)
+    try:
+        hours = int(request.query.get("hours", 24))
+    except ValueError:
+        hours = 24
+    aggregates = await asyncio.to_thread(
+        pipeline.aggregates, max(1, hours), request.query.get("phone_number_id")
+    )
+    return web.json_response(aggregates)
+
+
+@async_token_required("METRICS_TOKEN")
+async def metrics(request):
+    """Same as `views.metrics`."""
+    flask_app = request.app[FLASK_APP]
+    # Snapshot files are read and written off the loop
+    body = await asyncio.to_thread(flask_app.extensions["metrics"].render)
+    return web.Response(body=body.encode(), headers={"Content-Type": CONTENT_TYPE})
+
+
+async def start_conversations(app):
+    await app[CONVERSATIONS].start()
+    # Warming the Assistant is a blocking HTTP call
+    await asyncio.to_thread(start_serving, app[FLASK_APP])
+
+
+async def close_conversations(app):
+    await app[CONVERSATIONS].close()
+
+
+def create_async_app(flask_app=None):
+    """
+    aiohttp application serving /webhook, built on the services of
+    `flask_app` (a new `create_app()` by default). Refuses to start with
+    INBOUND_QUEUE_PATH set rather than silently skip the durable queue.
+    """
+    flask_app = flask_app or create_app()
+    if flask_app.config["INBOUND_QUEUE_PATH"]:
+        # Its consumer answers on the Flask app's thread pool, not on this loop
+        raise RuntimeError(
+            "INBOUND_QUEUE_PATH is not supported by the async app; "
+            "unset it, or serve the Flask app (run.py) instead"
+        )
+    app = web.Application()
+    app[FLASK_APP] = flask_app
+    conversations = app[CONVERSATIONS] = AsyncConversations(flask_app)
+    Gauge(
+        "whatsapp_async_backlog",
+        "Messages and questions accepted by the async app and not answered yet.",
+        lambda: conversations.inbound.backlog() + conversations.ai.backlog(),
+    )
+    app.on_startup.append(start_conversations)
+    app.on_cleanup.append(close_conversations)
+    app.router.add_get("/webhook", webhook_get)
+    app.router.add_post("/webhook", webhook_post)
+    app.router.add_get("/analytics/statuses", status_analytics)
+    app.router.add_get("/metrics", metrics)
+    return app
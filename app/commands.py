@@ -0,0 +1,284 @@
+import asyncio
+import json
+import os
+import time
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from .services.async_graph_client import AsyncGraphAPIClient, AsyncOutboundDelivery
+from .services.campaign import (
+    FAILED,
+    SENT,
+    STARTED,
+    CampaignCheckpoint,
+    CampaignRunner,
+    read_recipients,
+)
+from .services.faq_index import FaqIndex, build_index
+from .services.inbound_queue import DEAD, READY
+from .services.response_cache import get_response_cache
+from .services.thread_store import get_thread_store, migrate_shelve
+
+threads_cli = AppGroup("threads", help="Manage the wa_id -> OpenAI thread mapping.")
+dead_letters_cli = AppGroup("dead-letters", help="Inspect and replay undeliverable messages.")
+faq_cli = AppGroup("faq", help="Build the local FAQ index over data/.")
+answer_cache_cli = AppGroup("answer-cache", help="Inspect and clear cached Assistant answers.")
+campaign_cli = AppGroup("campaign", help="Send a template to a list of opted-in numbers.")
+inbound_queue_cli = AppGroup("inbound-queue", help="Inspect the durable queue of unanswered messages.")
+
+
+@threads_cli.command("export")
+@click.argument("path", type=click.Path(dir_okay=False))
+def export_threads(path):
+    """Write every wa_id -> thread_id pair to a JSON file."""
+    mapping = get_thread_store().export_threads()
+    with open(path, "w") as f:
+        json.dump(mapping, f, indent=2)
+    click.echo(f"Exported {len(mapping)} threads to {path}")
+
+
+@threads_cli.command("import")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+def import_threads(path):
+    """Load wa_id -> thread_id pairs from a JSON file written by `export`."""
+    with open(path) as f:
+        mapping = json.load(f)
+    count = get_thread_store().import_threads(mapping)
+    click.echo(f"Imported {count} threads from {path}")
+
+
+@threads_cli.command("migrate-shelve")
+@click.argument("path", default="threads_db")
+def migrate_shelve_command(path):
+    """Copy threads from the legacy shelve file (default: threads_db)."""
+    count = migrate_shelve(path, get_thread_store())
+    click.echo(f"Migrated {count} threads from {path}")
+
+
+@dead_letters_cli.command("count")
+def count_dead_letters():
+    """Show how many payloads are waiting in the dead-letter log."""
+    dead_letter = current_app.extensions["outbound_delivery"].dead_letter
+    click.echo(len(dead_letter) if dead_letter is not None else 0)
+
+
+@dead_letters_cli.command("replay")
+def replay_dead_letters():
+    """Resend every dead-lettered payload; ones that fail again are logged again."""
+    # Each payload goes out again from the number it was meant for
+    delivered, failed = current_app.extensions["number_registry"].replay_dead_letters()
+    click.echo(f"Delivered {delivered}, failed {failed}")
+
+
+@faq_cli.command("build")
+@click.option("--data-dir", default=None, help="Directory of PDFs (default: MEDIA_DATA_DIR).")
+def build_faq_index(data_dir):
+    """Index the PDFs in data/; unchanged files are reused from the last build."""
+    path = current_app.config["FAQ_INDEX_PATH"]
+    extracted, reused, passages = build_index(
+        data_dir or current_app.config["MEDIA_DATA_DIR"], path
+    )
+    click.echo(f"Indexed {passages} passages into {path} ({extracted} extracted, {reused} unchanged)")
+
+
+@faq_cli.command("search")
+@click.argument("question")
+def search_faq(question):
+    """Show the best passages for a question and their confidence."""
+    path = current_app.config["FAQ_INDEX_PATH"]
+    if not os.path.exists(path):
+        raise click.ClickException("No FAQ index yet, run `flask faq build`")
+    index = FaqIndex(path)
+    for passage_id, score, confidence, matched in index.search(question):
+        document, text, answer = index.passage(passage_id)
+        click.echo(f"{confidence:.2f} {score:6.2f} {matched} {document}: {answer or text}")
+
+
+def _answer_cache():
+    from .services.openai_service import get_answer_cache
+
+    cache = get_answer_cache()
+    if cache is None:
+        raise click.ClickException("The answer cache is off or the Assistant is unavailable")
+    return cache
+
+
+@answer_cache_cli.command("top")
+@click.option("--limit", default=10, show_default=True)
+def answer_cache_top(limit):
+    """List the most frequently asked cached questions."""
+    for question, hits in _answer_cache().top_questions(limit):
+        click.echo(f"{hits:6d}  {question}")
+
+
+@answer_cache_cli.command("clear")
+def answer_cache_clear():
+    """Drop every cached answer, in all workers; run after changing the Assistant's files."""
+    cache = get_response_cache()
+    if cache is None:
+        raise click.ClickException("The answer cache is off (ANSWER_CACHE=off)")
+    cache.invalidate()
+    click.echo("Answer cache cleared")
+
+
+@campaign_cli.command("send")
+@click.argument("recipients", type=click.Path(exists=True, dir_okay=False))
+@click.option("--template", "template_name", required=True, help="Approved template name.")
+@click.option("--language", default="en_US", show_default=True)
+@click.option("--checkpoint", default=None, help="Progress file (default: RECIPIENTS.checkpoint.jsonl).")
+@click.option("--concurrency", default=50, show_default=True, help="Requests in flight at once.")
+@click.option("--retry-failed", is_flag=True, help="Send again to numbers that failed.")
+@click.option(
+    "--retry-uncertain",
+    is_flag=True,
+    help="Send again to numbers a crash or a timed-out send left without an outcome.",
+)
+@click.option("--report-interval", default=5.0, show_default=True)
+@click.option(
+    "--from", "phone_number_id", default=None,
+    help="phone_number_id to send from (default: PHONE_NUMBER_ID).",
+)
+def send_campaign(
+    recipients, template_name, language, checkpoint, concurrency,
+    retry_failed, retry_uncertain, report_interval, phone_number_id,
+):
+    """Send a template to every number in a CSV or JSONL file; rerun to resume."""
+    try:
+        everyone = read_recipients(recipients)
+    except (ValueError, KeyError) as e:
+        raise click.ClickException(f"Could not read {recipients}: {e}")
+    registry = current_app.extensions["number_registry"]
+    number = registry.numbers.get(phone_number_id) if phone_number_id else registry.default
+    if number is None:
+        raise click.ClickException(f"{phone_number_id} is not in NUMBERS_PATH")
+    progress = CampaignCheckpoint(checkpoint or f"{recipients}.checkpoint.jsonl")
+    config = current_app.config
+    client = AsyncGraphAPIClient(
+        access_token=number.access_token,
+        version=config["VERSION"],
+        phone_number_id=number.phone_number_id,
+        pool_size=concurrency,
+        connect_timeout=config["GRAPH_CONNECT_TIMEOUT"],
+        read_timeout=config["GRAPH_READ_TIMEOUT"],
+        base_url=config["GRAPH_BASE_URL"],
+    )
+    delivery = AsyncOutboundDelivery(
+        client,
+        rate_per_second=number.delivery.rate_per_second,
+        burst=number.delivery.burst,
+        max_retries=number.delivery.max_retries,
+    )
+    runner = CampaignRunner(
+        delivery,
+        progress,
+        template_name,
+        language=language,
+        concurrency=concurrency,
+        report_interval=report_interval,
+        report=lambda stats: click.echo(stats.summary()),
+    )
+    pending = runner.pending(everyone, retry_failed, retry_uncertain)
+    uncertain = progress.counts()[STARTED] if not retry_uncertain else 0
+    click.echo(
+        f"{len(everyone)} recipients, {len(everyone) - len(pending)} already handled"
+        f"{f' ({uncertain} uncertain, see --retry-uncertain)' if uncertain else ''}"
+    )
+
+    async def run():
+        await client.start()
+        try:
+            return await runner.run(pending, total=len(everyone))
+        finally:
+            await client.close()
+
+    try:
+        asyncio.run(run())
+    finally:
+        progress.close()
+
+
+@campaign_cli.command("status")
+@click.argument("checkpoint", type=click.Path(exists=True, dir_okay=False))
+def campaign_status(checkpoint):
+    """Count sent, failed and uncertain numbers in a checkpoint file."""
+    progress = CampaignCheckpoint(checkpoint)
+    progress.close()
+    counts = progress.counts()
+    click.echo(f"{counts[SENT]} sent, {counts[FAILED]} failed, {counts[STARTED]} uncertain")
+
+
+def get_inbound_queue():
+    inbound_queue = current_app.extensions["inbound_queue"]
+    if inbound_queue is None:
+        raise click.ClickException("INBOUND_QUEUE_PATH is not set")
+    return inbound_queue
+
+
+@inbound_queue_cli.command("stats")
+def inbound_queue_stats():
+    """Count waiting, in-flight and dead deliveries."""
+    stats = get_inbound_queue().stats()
+    oldest = stats["oldest_age_seconds"]
+    click.echo(
+        f"{stats['ready']} ready, {stats['delayed']} delayed (debounce window or retry backoff), "
+        f"{stats['in_flight']} in flight, {stats['dead']} dead"
+    )
+    if oldest is not None:
+        click.echo(f"Oldest unanswered delivery: {oldest:.0f}s old")
+
+
+@inbound_queue_cli.command("list")
+@click.option("--dead", is_flag=True, help="List deliveries that ran out of attempts.")
+@click.option("--limit", default=20, show_default=True)
+def inbound_queue_list(dead, limit):
+    """List the oldest deliveries, with their attempts and last error."""
+    now = time.time()
+    for id, message_ids, attempts, enqueued_at, visible_at, last_error in get_inbound_queue().list(
+        DEAD if dead else READY, limit
+    ):
+        if dead:
+            due = "dead"
+        elif visible_at > now:
+            due = f"due in {visible_at - now:.0f}s"
+        else:
+            due = "due now"
+        click.echo(
+            f"{id}\t{now - enqueued_at:.0f}s old\t{attempts} attempt(s)\t{due}\t"
+            f"{message_ids}{f'  ({last_error})' if last_error else ''}"
+        )
+
+
+@inbound_queue_cli.command("show")
+@click.argument("delivery_id", type=int)
+def inbound_queue_show(delivery_id):
+    """Print the webhook body of a delivery."""
+    payload = get_inbound_queue().payload(delivery_id)
+    if payload is None:
+        raise click.ClickException(f"No delivery {delivery_id}")
+    click.echo(bytes(payload).decode("utf-8", "replace"))
+
+
+@inbound_queue_cli.command("requeue")
+@click.argument("delivery_ids", type=int, nargs=-1)
+def inbound_queue_requeue(delivery_ids):
+    """Give dead deliveries (all, or the given ids) a fresh set of attempts."""
+    count = get_inbound_queue().requeue(list(delivery_ids))
+    click.echo(f"Requeued {count} deliveries")
+
+
+@inbound_queue_cli.command("purge-dead")
+def inbound_queue_purge_dead():
+    """Delete every dead delivery."""
+    count = get_inbound_queue().purge_dead()
+    click.echo(f"Deleted {count} dead deliveries")
+
+
+def register_commands(app):
+    app.cli.add_command(threads_cli)
+    app.cli.add_command(dead_letters_cli)
+    app.cli.add_command(faq_cli)
+    app.cli.add_command(answer_cache_cli)
+    app.cli.add_command(campaign_cli)
+    app.cli.add_command(inbound_queue_cli)
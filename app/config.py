@@ -14,6 +14,100 @@ def load_configurations(app):
     app.config["VERSION"] = os.getenv("VERSION")
     app.config["PHONE_NUMBER_ID"] = os.getenv("PHONE_NUMBER_ID")
     app.config["VERIFY_TOKEN"] = os.getenv("VERIFY_TOKEN")
+    app.config["OPENAI_API_KEY"] = os.getenv("OPENAI_API_KEY")
+    app.config["OPENAI_ASSISTANT_ID"] = os.getenv("OPENAI_ASSISTANT_ID")
+    # Free-text answers from the Assistant: "off", "on", or "stream" to send
+    # paragraphs while the run is still generating
+    app.config["AI_REPLIES"] = os.getenv("AI_REPLIES", "off")
+    # Messages a user sends within this many seconds of each other (or while
+    # their previous run is still going) are answered by a single run
+    app.config["AI_DEBOUNCE_SECONDS"] = float(os.getenv("AI_DEBOUNCE_SECONDS", "1.0"))
+    app.config["AI_DEBOUNCE_MAX_SECONDS"] = float(os.getenv("AI_DEBOUNCE_MAX_SECONDS", "5.0"))
+
+    # Outbound Graph API connection pool; GRAPH_BASE_URL can point at a mock
+    # server such as start/mock_graph_api.py
+    app.config["GRAPH_BASE_URL"] = os.getenv("GRAPH_BASE_URL", "https://graph.facebook.com")
+    app.config["GRAPH_POOL_SIZE"] = int(os.getenv("GRAPH_POOL_SIZE", "10"))
+    app.config["GRAPH_CONNECT_TIMEOUT"] = float(os.getenv("GRAPH_CONNECT_TIMEOUT", "3.05"))
+    app.config["GRAPH_READ_TIMEOUT"] = float(os.getenv("GRAPH_READ_TIMEOUT", "10"))
+
+    # Outbound delivery: per-number token bucket (Meta's default throughput is
+    # 80 messages/second), retries with backoff, and a dead-letter file. The
+    # bucket is per process: with N gunicorn workers (or a campaign running
+    # next to the server) set the rate to the number's limit divided by N.
+    app.config["OUTBOUND_RATE_PER_SECOND"] = float(os.getenv("OUTBOUND_RATE_PER_SECOND", "80"))
+    app.config["OUTBOUND_BURST"] = int(os.getenv("OUTBOUND_BURST", "80"))
+    app.config["OUTBOUND_MAX_RETRIES"] = int(os.getenv("OUTBOUND_MAX_RETRIES", "4"))
+    app.config["DEAD_LETTER_PATH"] = os.getenv("DEAD_LETTER_PATH", "dead_letters.jsonl")
+
+    # Media assets in data/ are uploaded once and their ids cached by content
+    # hash; they are re-uploaded before WhatsApp's 30-day expiry
+    app.config["MEDIA_DATA_DIR"] = os.getenv(
+        "MEDIA_DATA_DIR", os.path.join(os.path.dirname(app.root_path), "data")
+    )
+    app.config["MEDIA_CACHE_PATH"] = os.getenv("MEDIA_CACHE_PATH", "media_cache.json")
+    app.config["MEDIA_REFRESH_DAYS"] = float(os.getenv("MEDIA_REFRESH_DAYS", "25"))
+    app.config["MEDIA_PREWARM"] = os.getenv("MEDIA_PREWARM", "true").lower() == "true"
+
+    # JSON file of further business numbers served by this app, each with
+    # its own token, pool, rate limit and flows (see number_registry.py)
+    app.config["NUMBERS_PATH"] = os.getenv("NUMBERS_PATH")
+
+    # Reply flows and their message payloads; edits are picked up without a restart
+    app.config["FLOWS_PATH"] = os.getenv("FLOWS_PATH") or os.path.join(
+        app.root_path, "flows", "flows.json"
+    )
+
+    # Local BM25 index over the PDFs in data/, built with `flask faq build`;
+    # questions it matches confidently are answered without the Assistant
+    app.config["FAQ_INDEX_PATH"] = os.getenv("FAQ_INDEX_PATH", "faq_index.bin")
+    app.config["FAQ_MIN_CONFIDENCE"] = float(os.getenv("FAQ_MIN_CONFIDENCE", "0.6"))
+    app.config["FAQ_MIN_SCORE"] = float(os.getenv("FAQ_MIN_SCORE", "6.0"))
+    app.config["FAQ_MIN_TERMS"] = int(os.getenv("FAQ_MIN_TERMS", "2"))
+
+    # Redelivered webhooks are dropped if their message id was seen within the TTL;
+    # set DEDUP_SQLITE_PATH to share seen ids between gunicorn workers
+    app.config["DEDUP_TTL_SECONDS"] = int(os.getenv("DEDUP_TTL_SECONDS", "86400"))
+    app.config["DEDUP_MAX_ENTRIES"] = int(os.getenv("DEDUP_MAX_ENTRIES", "100000"))
+    app.config["DEDUP_SQLITE_PATH"] = os.getenv("DEDUP_SQLITE_PATH")
+
+    # Webhook dispatch: "sync" replies inline, "async" acks first and replies
+    # from a background worker pool
+    app.config["DISPATCH_MODE"] = os.getenv("DISPATCH_MODE", "sync")
+    app.config["DISPATCH_WORKERS"] = int(os.getenv("DISPATCH_WORKERS", "4"))
+    app.config["DISPATCH_QUEUE_SIZE"] = int(os.getenv("DISPATCH_QUEUE_SIZE", "1000"))
+    # A sender's messages are answered together once they pause this long;
+    # off (0) by default, since every reply then waits out the window
+    app.config["INBOUND_DEBOUNCE_SECONDS"] = float(os.getenv("INBOUND_DEBOUNCE_SECONDS", "0"))
+    app.config["INBOUND_DEBOUNCE_MAX_SECONDS"] = float(os.getenv("INBOUND_DEBOUNCE_MAX_SECONDS", "6.0"))
+    # With INBOUND_QUEUE_PATH set, messages are written to a SQLite queue
+    # before Meta gets its 200 and survive a crash or redeploy; deliveries
+    # not acked within the visibility timeout are answered again
+    app.config["INBOUND_QUEUE_PATH"] = os.getenv("INBOUND_QUEUE_PATH", "")
+    app.config["INBOUND_QUEUE_VISIBILITY_SECONDS"] = float(os.getenv("INBOUND_QUEUE_VISIBILITY_SECONDS", "120"))
+    app.config["INBOUND_QUEUE_MAX_ATTEMPTS"] = int(os.getenv("INBOUND_QUEUE_MAX_ATTEMPTS", "5"))
+    app.config["INBOUND_QUEUE_SYNC"] = os.getenv("INBOUND_QUEUE_SYNC", "FULL")
+
+    # With STATUS_DB_PATH set, status updates (sent/delivered/read/failed) are
+    # buffered in memory and flushed to SQLite with hourly rollups for
+    # /analytics/statuses; by default they are only logged
+    app.config["STATUS_DB_PATH"] = os.getenv("STATUS_DB_PATH", "")
+    app.config["STATUS_BUFFER_SIZE"] = int(os.getenv("STATUS_BUFFER_SIZE", "100000"))
+    app.config["STATUS_FLUSH_SECONDS"] = float(os.getenv("STATUS_FLUSH_SECONDS", "2.0"))
+    app.config["STATUS_RETENTION_DAYS"] = int(os.getenv("STATUS_RETENTION_DAYS", "30"))
+    app.config["ANALYTICS_TOKEN"] = os.getenv("ANALYTICS_TOKEN")
+
+    # /metrics in the Prometheus text format; under gunicorn, point METRICS_DIR
+    # at a directory shared by the workers (emptied before each start) so
+    # every scrape covers all of them
+    app.config["METRICS_DIR"] = os.getenv("METRICS_DIR", "")
+    app.config["METRICS_TOKEN"] = os.getenv("METRICS_TOKEN")
+
+    # Async app (run_async.py): conversations worked on at once, threads for
+    # the blocking OpenAI SDK, and connections in the shared aiohttp session
+    app.config["ASYNC_MAX_CONVERSATIONS"] = int(os.getenv("ASYNC_MAX_CONVERSATIONS", "1000"))
+    app.config["ASYNC_AI_THREADS"] = int(os.getenv("ASYNC_AI_THREADS", "32"))
+    app.config["ASYNC_GRAPH_POOL_SIZE"] = int(os.getenv("ASYNC_GRAPH_POOL_SIZE", "100"))
 
 
 def configure_logging():
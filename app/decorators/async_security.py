@@ -0,0 +1,54 @@
+"""
+aiohttp versions of the decorators in security.py, for app/async_app.py.
+
+Kept apart so the Flask app never imports aiohttp.
+"""
+from functools import wraps
+import logging
+
+from aiohttp import web
+from flask import Flask
+
+from .security import signature_matches, token_refusal
+
+# The Flask app whose config the aiohttp app (app/async_app.py) runs on
+FLASK_APP = web.AppKey("flask_app", Flask)
+
+
+def async_signature_required(handler):
+    """
+    `signature_required` for the aiohttp app: same header, same 403 body.
+    """
+
+    @wraps(handler)
+    async def decorated_handler(request):
+        signature = request.headers.get("X-Hub-Signature-256", "")[7:]  # Removing 'sha256='
+        payload = await request.read()
+        app_secret = request.app[FLASK_APP].config["APP_SECRET"]
+        if not signature_matches(app_secret, payload, signature):
+            logging.info("Signature verification failed!")
+            return web.json_response(
+                {"status": "error", "message": "Invalid signature"}, status=403
+            )
+        return await handler(request)
+
+    return decorated_handler
+
+
+def async_token_required(config_key):
+    """`token_required` for the aiohttp app: same header, same responses."""
+
+    def decorator(handler):
+        @wraps(handler)
+        async def decorated_handler(request):
+            refusal = token_refusal(
+                request.app[FLASK_APP].config, config_key, request.headers.get("Authorization")
+            )
+            if refusal:
+                status, message = refusal
+                return web.json_response({"status": "error", "message": message}, status=status)
+            return await handler(request)
+
+        return decorated_handler
+
+    return decorator
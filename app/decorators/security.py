@@ -1,25 +1,36 @@
-from functools import wraps
+from functools import lru_cache, wraps
 from flask import current_app, jsonify, request
 import logging
 import hashlib
 import hmac
 
 
-def validate_signature(payload, signature):
-    """
-    Validate the incoming payload's signature against our expected signature
-    """
+@lru_cache(maxsize=4)
+def _signer(app_secret):
+    # HMAC keyed with the App Secret once; each request hashes on a copy
+    return hmac.new(bytes(app_secret, "latin-1"), digestmod=hashlib.sha256)
+
+
+def signature_matches(app_secret, payload, signature):
+    """Check a raw payload (bytes) against its X-Hub-Signature-256 hex digest."""
     # Use the App Secret to hash the payload
-    expected_signature = hmac.new(
-        bytes(current_app.config["APP_SECRET"], "latin-1"),
-        msg=payload.encode("utf-8"),
-        digestmod=hashlib.sha256,
-    ).hexdigest()
+    signer = _signer(app_secret).copy()
+    signer.update(payload)
+    expected_signature = signer.hexdigest()
 
     # Check if the signature matches
     return hmac.compare_digest(expected_signature, signature)
 
 
+def validate_signature(payload, signature):
+    """
+    Validate the incoming payload's signature against our expected signature
+    """
+    return signature_matches(
+        current_app.config["APP_SECRET"], payload.encode("utf-8"), signature
+    )
+
+
 def signature_required(f):
     """
     Decorator to ensure that the incoming requests to our webhook are valid and signed with the correct signature.
@@ -30,9 +41,47 @@ def signature_required(f):
         signature = request.headers.get("X-Hub-Signature-256", "")[
             7:
         ]  # Removing 'sha256='
-        if not validate_signature(request.data.decode("utf-8"), signature):
+        # The raw body, hashed as is; the view parses this same cached buffer
+        payload = request.get_data()
+        if not signature_matches(current_app.config["APP_SECRET"], payload, signature):
             logging.info("Signature verification failed!")
             return jsonify({"status": "error", "message": "Invalid signature"}), 403
         return f(*args, **kwargs)
 
     return decorated_function
+
+
+def token_refusal(config, config_key, authorization):
+    """
+    Check an Authorization header against "Bearer <config[config_key]>":
+    None if it matches, else the (status, message) to refuse with. While
+    no token is configured every request is refused.
+    """
+    token = config[config_key]
+    if not token:
+        return 403, f"Disabled until {config_key} is set"
+    if not hmac.compare_digest((authorization or "").encode(), f"Bearer {token}".encode()):
+        return 401, "Unauthorized"
+    return None
+
+
+def token_required(config_key):
+    """
+    Decorator for operator endpoints such as /metrics: requires
+    "Authorization: Bearer <token>" with the token in config[config_key].
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            refusal = token_refusal(
+                current_app.config, config_key, request.headers.get("Authorization")
+            )
+            if refusal:
+                status, message = refusal
+                return jsonify({"status": "error", "message": message}), status
+            return f(*args, **kwargs)
+
+        return decorated_function
+
+    return decorator
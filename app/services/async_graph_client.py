@@ -0,0 +1,172 @@
+"""
+aiohttp counterparts of GraphAPIClient and OutboundDelivery for the async
+app (app/async_app.py). Failure classification, backoff and the dead-letter
+log are shared with the threaded versions.
+"""
+import asyncio
+import json
+import logging
+import time
+
+import aiohttp
+
+from .delivery import (
+    RETRY,
+    THROTTLED,
+    UNCERTAIN,
+    DeliveryFailure,
+    OutboundDelivery,
+    TokenBucket,
+    _retry_after,
+    classify_failure,
+    graph_error,
+)
+
+
+class GraphResponse:
+    """The parts of a Graph API response the delivery layer looks at."""
+
+    __slots__ = ("status_code", "headers", "content")
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", "replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class AsyncGraphAPIClient:
+    """
+    GraphAPIClient on one shared `aiohttp.ClientSession`, so a single
+    process can keep thousands of sends in flight over a bounded pool of
+    keep-alive connections. `start()` must run inside the event loop.
+    """
+
+    def __init__(
+        self,
+        access_token,
+        version,
+        phone_number_id,
+        pool_size=100,
+        connect_timeout=3.05,
+        read_timeout=10,
+        base_url="https://graph.facebook.com",
+    ):
+        self.base_url = f"{base_url}/{version}"
+        self.phone_number_id = phone_number_id
+        self.messages_url = f"{self.base_url}/{phone_number_id}/messages"
+        self.pool_size = pool_size
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self.headers = {
+            "Content-type": "application/json",
+            "Authorization": f"Bearer {access_token}",
+        }
+        self.session = None
+
+    async def start(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                headers=self.headers,
+                timeout=self.timeout,
+            )
+
+    async def post_message(self, data):
+        """Send a pre-serialized message payload to the messages endpoint."""
+        async with self.session.post(self.messages_url, data=data) as response:
+            return GraphResponse(response.status, response.headers, await response.read())
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+class AsyncTokenBucket(TokenBucket):
+    """TokenBucket whose `acquire` waits with asyncio.sleep instead of blocking."""
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class AsyncOutboundDelivery(OutboundDelivery):
+    """OutboundDelivery for the async client: same limits, retries and dead letters."""
+
+    bucket_class = AsyncTokenBucket
+
+    async def send(self, data, dead_letter=True, retry_uncertain=True):
+        """
+        Same as OutboundDelivery.send. With `retry_uncertain` False, a
+        timeout or transient error after the request went out is not
+        retried, since WhatsApp may have delivered the message anyway:
+        DeliveryFailure(UNCERTAIN) is raised instead. Connection failures
+        and throttling are still retried.
+        """
+        graph_client = self.graph_client
+        phone_number_id = graph_client.phone_number_id
+        bucket = self.bucket(phone_number_id)
+        attempt = 0
+        while True:
+            await bucket.acquire()
+            response = None
+            # Whether the request may have reached WhatsApp
+            written = True
+            try:
+                response = await graph_client.post_message(data)
+            except (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError) as e:
+                reason, error, written = RETRY, {"message": str(e) or "Connect timed out"}, False
+            except asyncio.TimeoutError:
+                reason, error = RETRY, {"message": "Request timed out"}
+            except aiohttp.ClientError as e:
+                reason, error = RETRY, {"message": str(e)}
+            else:
+                if response.ok:
+                    return response
+                error = graph_error(response)
+                reason = classify_failure(response.status_code, error.get("code"))
+
+            status_code = response.status_code if response is not None else None
+            if reason == RETRY and written and not retry_uncertain:
+                logging.error(
+                    f"Not retrying a send that may have been delivered: "
+                    f"status {status_code}, error {error}"
+                )
+                raise DeliveryFailure(UNCERTAIN, status_code, error, response)
+            if reason in (RETRY, THROTTLED) and attempt < self.max_retries:
+                delay = self.backoff(attempt, _retry_after(response))
+                logging.warning(
+                    f"Send failed ({reason}, status {status_code}, "
+                    f"code {error.get('code')}); retrying in {delay:.2f}s"
+                )
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+
+            logging.error(
+                f"Giving up on message after {attempt + 1} attempt(s): "
+                f"{reason}, status {status_code}, error {error}"
+            )
+            if dead_letter and self.dead_letter is not None:
+                # A file append (and its lock) has no place on the loop
+                await asyncio.to_thread(
+                    self.dead_letter.append,
+                    data, phone_number_id, reason, status_code, error, attempt + 1,
+                )
+            raise DeliveryFailure(reason, status_code, error, response)
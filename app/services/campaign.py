@@ -0,0 +1,243 @@
+"""
+Broadcast campaigns: one template message to every number in a recipient
+list, e.g. a festival promotion to tens of thousands of opted-in users.
+
+Recipients come from CSV (a `wa_id` column; the other columns, in order,
+fill the template's body parameters) or JSONL (`{"wa_id": ..., "params":
+[...]}`). Sends go through AsyncOutboundDelivery, so they share one pooled
+aiohttp session and the per-number token bucket, with at most
+`concurrency` requests in flight.
+
+Progress is checkpointed to a JSON-lines file. Each recipient is marked
+"started" (fsynced, a chunk at a time) before its request goes out, and
+"sent" or "failed" once it is answered. A resumed campaign skips every
+number with a mark. Sends are not retried once the request may have
+reached WhatsApp (a timeout or 5xx after it went out); like the numbers a
+crash left started, those keep their "started" mark and are only retried
+when asked (--retry-uncertain): a crash or an outage can cost a message,
+but never sends one twice.
+"""
+import asyncio
+import csv
+import json
+import os
+import time
+
+from app.utils.whatsapp_utils import get_template_message_input
+from .delivery import UNCERTAIN, DeliveryFailure
+
+STARTED = "started"
+SENT = "sent"
+FAILED = "failed"
+
+
+class Recipient:
+    __slots__ = ("wa_id", "params")
+
+    def __init__(self, wa_id, params=()):
+        self.wa_id = wa_id
+        self.params = list(params)
+
+
+def read_recipients(path):
+    """Recipients from a .csv or .jsonl file, without duplicate numbers."""
+    recipients = {}
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.lower().endswith(".csv"):
+            reader = csv.DictReader(f)
+            if "wa_id" not in (reader.fieldnames or []):
+                raise ValueError(f"{path} has no wa_id column")
+            param_columns = [name for name in reader.fieldnames if name != "wa_id"]
+            # Short rows leave their missing cells None
+            rows = (
+                Recipient(row["wa_id"] or "", [row[name] or "" for name in param_columns])
+                for row in reader
+            )
+        else:
+            rows = (
+                Recipient(str(record["wa_id"] or ""), record.get("params") or [])
+                for record in map(json.loads, filter(str.strip, f))
+            )
+        for recipient in rows:
+            wa_id = recipient.wa_id.strip().lstrip("+")
+            if wa_id:
+                recipient.wa_id = wa_id
+                recipients.setdefault(wa_id, recipient)
+    return list(recipients.values())
+
+
+class CampaignCheckpoint:
+    """Append-only JSON-lines record of every recipient's state."""
+
+    def __init__(self, path):
+        self.path = path
+        self.states = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A line torn by the crash we are resuming from
+                        continue
+                    # The latest mark wins, e.g. "started" again on a retry
+                    self.states[record["wa_id"]] = record["state"]
+        self._file = open(path, "a", encoding="utf-8")
+
+    def counts(self):
+        counts = {STARTED: 0, SENT: 0, FAILED: 0}
+        for state in self.states.values():
+            counts[state] += 1
+        return counts
+
+    def mark(self, wa_id, state, **details):
+        self.states[wa_id] = state
+        record = {"wa_id": wa_id, "state": state, "at": round(time.time(), 3), **details}
+        self._file.write(json.dumps(record) + "\n")
+
+    def sync(self):
+        """Make every mark so far durable."""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+
+class CampaignStats:
+    __slots__ = ("total", "skipped", "sent", "failed", "uncertain", "failures", "started_at")
+
+    def __init__(self, total, skipped):
+        self.total = total
+        self.skipped = skipped
+        self.sent = 0
+        self.failed = 0
+        self.uncertain = 0
+        self.failures = {}
+        self.started_at = time.monotonic()
+
+    def rate(self):
+        elapsed = time.monotonic() - self.started_at
+        return (self.sent + self.failed + self.uncertain) / elapsed if elapsed > 0 else 0.0
+
+    def summary(self):
+        done = self.sent + self.failed + self.uncertain
+        remaining = self.total - self.skipped - done
+        rate = self.rate()
+        eta = f", ~{remaining / rate:.0f}s left" if rate and remaining else ""
+        failures = ", ".join(f"{reason} {count}" for reason, count in sorted(self.failures.items()))
+        return (
+            f"{done}/{self.total - self.skipped} done: {self.sent} sent, {self.failed} failed"
+            f"{f' ({failures})' if failures else ''}"
+            f"{f', {self.uncertain} uncertain' if self.uncertain else ''}, {rate:.1f}/s{eta}"
+        )
+
+
+class CampaignRunner:
+    """
+    Sends a template to a list of recipients with bounded concurrency,
+    checkpointing as it goes. `report(stats)` is called every
+    `report_interval` seconds and once at the end.
+    """
+
+    def __init__(
+        self,
+        delivery,
+        checkpoint,
+        template_name,
+        language="en_US",
+        concurrency=50,
+        report_interval=5.0,
+        report=None,
+    ):
+        self.delivery = delivery
+        self.checkpoint = checkpoint
+        self.template_name = template_name
+        self.language = language
+        self.concurrency = concurrency
+        self.report_interval = report_interval
+        self.report = report
+
+    def pending(self, recipients, retry_failed=False, retry_uncertain=False):
+        """The recipients a (resumed) run still has to send to."""
+        retry = {None}
+        if retry_failed:
+            retry.add(FAILED)
+        if retry_uncertain:
+            retry.add(STARTED)
+        states = self.checkpoint.states
+        return [recipient for recipient in recipients if states.get(recipient.wa_id) in retry]
+
+    async def run(self, recipients, total=None):
+        """Send to `recipients` (see `pending`) and return the CampaignStats."""
+        total = total if total is not None else len(recipients)
+        stats = CampaignStats(total, total - len(recipients))
+        queue = asyncio.Queue(maxsize=self.concurrency)
+        reporter = asyncio.create_task(self._report_periodically(stats))
+        workers = [
+            asyncio.create_task(self._worker(queue, stats)) for _ in range(self.concurrency)
+        ]
+        try:
+            # Started marks are made durable a chunk at a time, before any
+            # request of that chunk goes out
+            for start in range(0, len(recipients), self.concurrency):
+                chunk = recipients[start:start + self.concurrency]
+                for recipient in chunk:
+                    self.checkpoint.mark(recipient.wa_id, STARTED)
+                # One fsync per chunk (a few ms), on the loop so marks from
+                # the workers never interleave with it
+                self.checkpoint.sync()
+                for recipient in chunk:
+                    await queue.put(recipient)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            reporter.cancel()
+            for worker in workers:
+                worker.cancel()
+            self.checkpoint.sync()
+        if self.report is not None:
+            self.report(stats)
+        return stats
+
+    async def _worker(self, queue, stats):
+        while True:
+            recipient = await queue.get()
+            if recipient is None:
+                return
+            payload = get_template_message_input(
+                recipient.wa_id, self.template_name, self.language, recipient.params
+            )
+            try:
+                response = await self.delivery.send(
+                    payload, dead_letter=False, retry_uncertain=False
+                )
+            except DeliveryFailure as e:
+                if e.reason == UNCERTAIN:
+                    # Keeps its "started" mark, so only --retry-uncertain resends it
+                    stats.uncertain += 1
+                    continue
+                stats.failed += 1
+                stats.failures[e.reason] = stats.failures.get(e.reason, 0) + 1
+                self.checkpoint.mark(
+                    recipient.wa_id,
+                    FAILED,
+                    reason=e.reason,
+                    status_code=e.status_code,
+                    code=e.error.get("code"),
+                )
+                continue
+            stats.sent += 1
+            message_id = None
+            try:
+                message_id = response.json()["messages"][0]["id"]
+            except (ValueError, KeyError, IndexError, TypeError):
+                pass
+            self.checkpoint.mark(recipient.wa_id, SENT, message_id=message_id)
+
+    async def _report_periodically(self, stats):
+        while self.report is not None:
+            await asyncio.sleep(self.report_interval)
+            self.report(stats)
@@ -0,0 +1,135 @@
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class MessageDeduplicator:
+    """
+    Remembers recently handled WhatsApp message ids so redelivered webhooks
+    are not answered twice.
+
+    Entries live in a bounded in-process dict and expire after `ttl_seconds`.
+    With `sqlite_path` set, ids are also recorded in a small SQLite table so
+    every gunicorn worker on the host shares the same view.
+    """
+
+    # Expired rows are purged from SQLite once every this many inserts
+    PURGE_EVERY = 1000
+
+    def __init__(self, ttl_seconds=86400, max_entries=100000, sqlite_path=None):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.sqlite_path = sqlite_path
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._inserts = 0
+        if sqlite_path:
+            self._init_db()
+
+    def seen(self, message_id):
+        """
+        Return True if `message_id` was already handled, otherwise record it
+        and return False. Events without an id are never treated as duplicates.
+        """
+        if not message_id:
+            return False
+
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            if message_id in self._entries:
+                self.hits += 1
+                return True
+            # Reserve the id before any I/O so concurrent redeliveries lose
+            self._entries[message_id] = now + self.ttl_seconds
+
+        duplicate = bool(self.sqlite_path) and self._seen_in_db(message_id)
+
+        with self._lock:
+            if duplicate:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return duplicate
+
+    def forget(self, message_id):
+        """Un-mark an id whose handling was refused, so a redelivery is processed."""
+        if not message_id:
+            return
+        with self._lock:
+            self._entries.pop(message_id, None)
+        if self.sqlite_path:
+            try:
+                self._connection().execute(
+                    "DELETE FROM seen_messages WHERE message_id = ?", (message_id,)
+                )
+            except sqlite3.Error as e:
+                logging.error(f"Dedup store unavailable: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+            }
+
+    def _evict(self, now):
+        # Every entry gets the same TTL, so insertion order is expiry order
+        entries = self._entries
+        while entries:
+            expires_at = next(iter(entries.values()))
+            if expires_at > now and len(entries) < self.max_entries:
+                break
+            entries.popitem(last=False)
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.sqlite_path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _init_db(self):
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS seen_messages ("
+            "message_id TEXT PRIMARY KEY, expires_at REAL NOT NULL)"
+        )
+
+    def _seen_in_db(self, message_id):
+        now = time.time()
+        try:
+            conn = self._connection()
+            # Inserts a new id, or revives an expired one; a live duplicate
+            # matches the conflict clause without updating any row.
+            cursor = conn.execute(
+                "INSERT INTO seen_messages (message_id, expires_at) VALUES (?, ?) "
+                "ON CONFLICT(message_id) DO UPDATE SET expires_at = excluded.expires_at "
+                "WHERE seen_messages.expires_at <= ?",
+                (message_id, now + self.ttl_seconds, now),
+            )
+            self._inserts += 1
+            if self._inserts % self.PURGE_EVERY == 0:
+                conn.execute("DELETE FROM seen_messages WHERE expires_at <= ?", (now,))
+            return cursor.rowcount == 0
+        except sqlite3.Error as e:
+            # Fall back to the in-process cache rather than dropping the message
+            logging.error(f"Dedup store unavailable: {e}")
+            return False
+
+
+def init_deduplicator(app):
+    deduplicator = MessageDeduplicator(
+        ttl_seconds=app.config["DEDUP_TTL_SECONDS"],
+        max_entries=app.config["DEDUP_MAX_ENTRIES"],
+        sqlite_path=app.config["DEDUP_SQLITE_PATH"],
+    )
+    app.extensions["message_deduplicator"] = deduplicator
+    return deduplicator
@@ -0,0 +1,291 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+import requests
+
+
+# Graph API error codes, see
+# https://developers.facebook.com/docs/whatsapp/cloud-api/support/error-codes
+THROTTLE_ERROR_CODES = {
+    4,  # Application request limit reached
+    80007,  # WhatsApp Business Account rate limit
+    130429,  # Cloud API throughput reached
+    131048,  # Spam rate limit hit
+    131056,  # Pair rate limit: too many messages to the same user
+}
+TRANSIENT_ERROR_CODES = {
+    1,  # Unknown API error
+    2,  # API service temporarily unavailable
+    131000,  # Something went wrong
+    131016,  # Service unavailable
+    133004,  # Server temporarily unavailable
+}
+AUTH_ERROR_CODES = {
+    0,  # Authentication exception
+    10,  # Permission denied
+    190,  # Access token expired
+    200,  # Permission error
+}
+
+# Outcomes of classify_failure
+RETRY = "retry"
+THROTTLED = "throttled"
+PERMANENT = "permanent"
+AUTH = "auth"
+# Given up on without retrying because the request may already have been
+# delivered (see AsyncOutboundDelivery.send)
+UNCERTAIN = "uncertain"
+
+
+def graph_error(response):
+    """Return the `error` object of a Graph API error response, or {}."""
+    try:
+        body = response.json()
+    except ValueError:
+        return {}
+    error = body.get("error") if isinstance(body, dict) else None
+    return error if isinstance(error, dict) else {}
+
+
+def classify_failure(status_code, error_code=None):
+    """
+    Decide what to do with a failed send: RETRY and THROTTLED are worth
+    another attempt, PERMANENT and AUTH are not.
+    """
+    if error_code in THROTTLE_ERROR_CODES or status_code == 429:
+        return THROTTLED
+    if error_code in AUTH_ERROR_CODES or status_code in (401, 403):
+        return AUTH
+    if error_code in TRANSIENT_ERROR_CODES or status_code >= 500:
+        return RETRY
+    return PERMANENT
+
+
+class DeliveryFailure(Exception):
+    """A send that was given up on, with its failure classification."""
+
+    def __init__(self, reason, status_code, error, response=None):
+        super().__init__(f"{reason}: status {status_code}, error {error}")
+        self.reason = reason
+        self.status_code = status_code
+        self.error = error
+        self.response = response
+
+
+class TokenBucket:
+    """Blocking token bucket: `rate` sends per second with bursts up to `burst`."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class DeadLetterLog:
+    """Append-only JSON-lines file of payloads that could not be delivered."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def append(self, payload, phone_number_id, reason, status_code=None, error=None, attempts=0):
+        if isinstance(payload, bytes):
+            payload = payload.decode("utf-8")
+        record = {
+            "failed_at": time.time(),
+            "phone_number_id": phone_number_id,
+            "reason": reason,
+            "status_code": status_code,
+            "error": error,
+            "attempts": attempts,
+            "payload": payload,
+        }
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+
+    def __len__(self):
+        if not os.path.exists(self.path):
+            return 0
+        with open(self.path, encoding="utf-8") as f:
+            return sum(1 for line in f if line.strip())
+
+    def take(self):
+        """
+        Move the current log aside and return its records for replaying,
+        along with any that an interrupted replay left aside.
+        """
+        replaying = f"{self.path}.replaying"
+        with self._lock:
+            if os.path.exists(self.path):
+                if os.path.exists(replaying):
+                    # Add to the leftover file rather than overwrite it
+                    with open(self.path, encoding="utf-8") as f:
+                        pending = f.read()
+                    with open(replaying, "a", encoding="utf-8") as f:
+                        f.write(pending)
+                    os.remove(self.path)
+                else:
+                    os.replace(self.path, replaying)
+            elif not os.path.exists(replaying):
+                return []
+        with open(replaying, encoding="utf-8") as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        os.remove(replaying)
+        return records
+
+
+class OutboundDelivery:
+    """
+    Delivery layer in front of the Graph API client.
+
+    Every send waits for a token from the bucket of its phone_number_id, is
+    retried with jittered exponential backoff on 429/5xx/timeouts and on
+    throttling error codes, and lands in the dead-letter log once retries
+    run out or the Graph API rejects it for good.
+    """
+
+    bucket_class = TokenBucket
+
+    def __init__(
+        self,
+        graph_client,
+        rate_per_second=80,
+        burst=80,
+        max_retries=4,
+        base_delay=0.5,
+        max_delay=30,
+        dead_letter=None,
+    ):
+        self.graph_client = graph_client
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.dead_letter = dead_letter
+        self._buckets = {}
+        self._buckets_lock = threading.Lock()
+
+    def bucket(self, phone_number_id):
+        with self._buckets_lock:
+            bucket = self._buckets.get(phone_number_id)
+            if bucket is None:
+                bucket = self.bucket_class(self.rate_per_second, self.burst)
+                self._buckets[phone_number_id] = bucket
+            return bucket
+
+    def backoff(self, attempt, retry_after=None):
+        if retry_after:
+            return min(retry_after, self.max_delay)
+        # "Full jitter" so retries from many workers don't line up
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def send(self, data, dead_letter=True):
+        """
+        Deliver a message payload and return the successful response.
+
+        Raises DeliveryFailure once the send is given up on; by then the
+        payload is already in the dead-letter log (unless `dead_letter` is
+        False).
+        """
+        graph_client = self.graph_client
+        phone_number_id = graph_client.phone_number_id
+        bucket = self.bucket(phone_number_id)
+        attempt = 0
+        while True:
+            bucket.acquire()
+            response = None
+            try:
+                response = graph_client.post_message(data)
+            except requests.Timeout:
+                reason, error = RETRY, {"message": "Request timed out"}
+            except requests.RequestException as e:
+                reason, error = RETRY, {"message": str(e)}
+            else:
+                if response.ok:
+                    return response
+                error = graph_error(response)
+                reason = classify_failure(response.status_code, error.get("code"))
+
+            status_code = response.status_code if response is not None else None
+            if reason in (RETRY, THROTTLED) and attempt < self.max_retries:
+                retry_after = _retry_after(response)
+                delay = self.backoff(attempt, retry_after)
+                logging.warning(
+                    f"Send failed ({reason}, status {status_code}, "
+                    f"code {error.get('code')}); retrying in {delay:.2f}s"
+                )
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            logging.error(
+                f"Giving up on message after {attempt + 1} attempt(s): "
+                f"{reason}, status {status_code}, error {error}"
+            )
+            if dead_letter and self.dead_letter is not None:
+                self.dead_letter.append(
+                    data, phone_number_id, reason, status_code, error, attempt + 1
+                )
+            raise DeliveryFailure(reason, status_code, error, response)
+
+    def replay_dead_letters(self):
+        """Resend everything in the dead-letter log; failures are logged again."""
+        if self.dead_letter is None:
+            return 0, 0
+        return self.replay_records(self.dead_letter.take())
+
+    def replay_records(self, records):
+        """Resend dead-letter records taken from the log; returns (delivered, failed)."""
+        delivered = failed = 0
+        for record in records:
+            try:
+                self.send(record["payload"])
+                delivered += 1
+            except DeliveryFailure:
+                failed += 1
+        return delivered, failed
+
+
+def _retry_after(response):
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("Retry-After", ""))
+    except ValueError:
+        return None
+
+
+def init_delivery(app):
+    dead_letter_path = app.config["DEAD_LETTER_PATH"]
+    delivery = OutboundDelivery(
+        app.extensions["graph_client"],
+        rate_per_second=app.config["OUTBOUND_RATE_PER_SECOND"],
+        burst=app.config["OUTBOUND_BURST"],
+        max_retries=app.config["OUTBOUND_MAX_RETRIES"],
+        dead_letter=DeadLetterLog(dead_letter_path) if dead_letter_path else None,
+    )
+    app.extensions["outbound_delivery"] = delivery
+    return delivery
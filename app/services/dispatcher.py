@@ -0,0 +1,92 @@
+from concurrent.futures import wait
+
+from app.utils.debounce import KeyedDebouncer
+from app.utils.whatsapp_utils import process_burst
+from .scheduler import KeyedScheduler
+
+
+class WebhookDispatcher:
+    """
+    Runs the reply flow on a keyed worker pool.
+
+    Jobs are keyed by wa_id, so one user's replies always go out in order
+    (the greeting image before the tour buttons, a document before its
+    contact text) even across separate webhook deliveries, while different
+    users are served in parallel up to DISPATCH_WORKERS at a time.
+
+    In "sync" mode the webhook waits for its jobs before answering. In
+    "async" mode it only enqueues them and returns, so Meta gets its 200
+    right away.
+    """
+
+    def __init__(self, app, mode="sync", workers=4, queue_size=1000):
+        self.app = app
+        self.mode = mode
+        self.scheduler = KeyedScheduler(
+            max_concurrency=workers, capacity=queue_size, name="webhook-worker"
+        )
+
+    @property
+    def is_async(self):
+        return self.mode == "async"
+
+    def queue_depth(self):
+        return self.scheduler.pending()
+
+    def submit(self, key, fn, *args):
+        """
+        Run `fn(*args)` after any earlier jobs for `key`.
+
+        Raises QueueFullError when the queue is at capacity, so the caller
+        can answer with a retryable status instead of blocking.
+        """
+        self.submit_all([(key, fn, args)])
+
+    def submit_all(self, jobs):
+        """Queue independent `(key, fn, args)` jobs, e.g. one per sender in a batch."""
+        futures = self.scheduler.submit_many(
+            [(key, self._run_in_app_context, (fn, args)) for key, fn, args in jobs]
+        )
+        if not self.is_async:
+            # A batched delivery costs its slowest sender rather than the sum
+            wait(futures)
+
+    def enqueue(self, key, fn, *args):
+        """Queue `fn(*args)` behind earlier jobs for `key` without waiting, in either mode."""
+        return self.scheduler.submit(key, self._run_in_app_context, fn, args)
+
+    def _run_in_app_context(self, fn, args):
+        with self.app.app_context():
+            return fn(*args)
+
+
+def init_dispatcher(app):
+    dispatcher = WebhookDispatcher(
+        app,
+        mode=app.config["DISPATCH_MODE"],
+        workers=app.config["DISPATCH_WORKERS"],
+        queue_size=app.config["DISPATCH_QUEUE_SIZE"],
+    )
+    app.extensions["webhook_dispatcher"] = dispatcher
+    return dispatcher
+
+
+def init_inbound_debouncer(app):
+    """
+    Collect each sender's messages until they pause for
+    INBOUND_DEBOUNCE_SECONDS, so "hi", "hello", "namaste" get one greeting.
+    """
+    window = app.config["INBOUND_DEBOUNCE_SECONDS"]
+    if window <= 0:
+        app.extensions["inbound_debouncer"] = None
+        return None
+    dispatcher = app.extensions["webhook_dispatcher"]
+    debouncer = KeyedDebouncer(
+        process_burst,
+        window=window,
+        max_wait=app.config["INBOUND_DEBOUNCE_MAX_SECONDS"],
+        submit=dispatcher.enqueue,
+        name="inbound-debouncer",
+    )
+    app.extensions["inbound_debouncer"] = debouncer
+    return debouncer
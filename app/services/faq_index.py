@@ -0,0 +1,351 @@
+"""
+Local BM25 index over the PDFs in data/, for answering FAQs without a
+round trip to the OpenAI Assistant.
+
+`flask faq build` extracts the text of every PDF, splits it into passages
+(one per "Q: ... A: ..." pair, or overlapping word windows for other
+documents) and writes a single index file:
+
+    magic | header length | JSON header | postings | passage texts
+
+The JSON header holds the term dictionary and passage table and is small;
+postings (uint32 passage id / term frequency pairs) and the passage texts
+stay in the file and are read through mmap, so workers share them through
+the page cache. Rebuilding is incremental: PDFs whose SHA-256 matches the
+existing index reuse its passages instead of being extracted again.
+"""
+import hashlib
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+import time
+from array import array
+from collections import Counter
+
+from app.utils.intents import STOPWORDS, tokenize
+
+MAGIC = b"FAQIDX01"
+HEADER_LENGTH = struct.Struct("<I")
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+QA_PAIR = re.compile(
+    r"(?:\d+\s+)?Q\s*:\s*(?P<question>.+?)\s+A\s*:\s*(?P<answer>.+?)"
+    r"(?=\s+(?:\d+\s+)?Q\s*:|$)",
+    re.S,
+)
+# Section headings that end up glued to the previous answer ("... locked. Accommodation Details")
+TRAILING_HEADING = re.compile(r"(?<=[.!?])(?:\s+[A-Z][\w/-]*){1,4}$")
+
+# "Wi-Fi" is also indexed as "wifi", "check-in" as "checkin"
+HYPHENATED = re.compile(r"\b\w+(?:-\w+)+\b")
+
+WINDOW_WORDS = 80
+WINDOW_OVERLAP = 20
+
+
+def index_terms(text):
+    tokens = tokenize(text)
+    tokens += [word.replace("-", "") for word in tokenize_hyphenated(text)]
+    return [token for token in tokens if token not in STOPWORDS]
+
+
+def tokenize_hyphenated(text):
+    return [match.group().casefold() for match in HYPHENATED.finditer(text)]
+
+
+def extract_pdf_text(path):
+    # Only needed when building, so serving doesn't depend on pypdf
+    from pypdf import PdfReader
+
+    reader = PdfReader(path)
+    return "\n".join(page.extract_text() or "" for page in reader.pages)
+
+
+def split_passages(text):
+    """Return (text, answer) passages; answer is None for plain text windows."""
+    text = " ".join(text.split())
+    pairs = list(QA_PAIR.finditer(text))
+    if pairs:
+        passages = []
+        for pair in pairs:
+            answer = TRAILING_HEADING.sub("", pair.group("answer"))
+            passages.append((f"{pair.group('question')} {answer}", answer))
+        return passages
+
+    words = text.split()
+    step = WINDOW_WORDS - WINDOW_OVERLAP
+    return [
+        (" ".join(words[start:start + WINDOW_WORDS]), None)
+        for start in range(0, max(len(words) - WINDOW_OVERLAP, 1), step)
+    ]
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+class FaqIndex:
+    """Read-only view of an index file written by `build_index`."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a FAQ index")
+        (header_length,) = HEADER_LENGTH.unpack_from(self._mmap, len(MAGIC))
+        start = len(MAGIC) + HEADER_LENGTH.size
+        header = json.loads(self._mmap[start:start + header_length])
+        if header["byteorder"] != sys.byteorder:
+            raise ValueError(f"{path} was built on a {header['byteorder']}-endian machine")
+        self.documents = header["documents"]
+        self.passages = header["passages"]
+        self.terms = header["terms"]
+        self.average_length = header["average_length"]
+        self._postings_offset = header["postings_offset"]
+        self._texts_offset = header["texts_offset"]
+        self._view = memoryview(self._mmap)
+
+    def close(self):
+        self._view.release()
+        self._mmap.close()
+
+    def idf(self, term):
+        count = len(self.passages)
+        df = self.terms[term][1] if term in self.terms else 0
+        return math.log(1 + (count - df + 0.5) / (df + 0.5))
+
+    def postings(self, term):
+        offset, df = self.terms[term]
+        start = self._postings_offset + offset * 8
+        # Native byte order, checked against the header when opening
+        return self._view[start:start + df * 8].cast("I")
+
+    def passage(self, passage_id):
+        """Return (document, text, answer) for a passage."""
+        document, offset, length, answer_length, _ = self.passages[passage_id]
+        start = self._texts_offset + offset
+        text = bytes(self._view[start:start + length]).decode("utf-8")
+        answer = None
+        if answer_length:
+            end = start + length
+            answer = bytes(self._view[end:end + answer_length]).decode("utf-8")
+        return document, text, answer
+
+    def search(self, query, limit=3):
+        """
+        Return up to `limit` (passage_id, score, confidence, matched) hits,
+        best first.
+
+        Confidence is the share of the query's IDF weight that the passage
+        contains (1.0 when every query word is in it), so words the index
+        has never seen lower it while the score still ranks the hits.
+        `matched` counts the query terms found in the passage; terms the
+        index doesn't know never count.
+        """
+        terms = set(index_terms(query))
+        if not terms:
+            return []
+        scores, matched_idf, matched = Counter(), Counter(), Counter()
+        for term in terms:
+            if term not in self.terms:
+                continue
+            idf = self.idf(term)
+            postings = self.postings(term)
+            for i in range(0, len(postings), 2):
+                passage_id, frequency = postings[i], postings[i + 1]
+                length = self.passages[passage_id][4]
+                norm = K1 * (1 - B + B * length / self.average_length)
+                scores[passage_id] += idf * frequency * (K1 + 1) / (frequency + norm)
+                matched_idf[passage_id] += idf
+                matched[passage_id] += 1
+        total = sum(self.idf(term) for term in terms)
+        return [
+            (passage_id, score, matched_idf[passage_id] / total, matched[passage_id])
+            for passage_id, score in scores.most_common(limit)
+        ]
+
+
+def build_index(data_dir, path):
+    """
+    (Re)build the index file at `path` from the PDFs in `data_dir`.
+
+    Returns (extracted, reused, passages): how many PDFs were read, how
+    many were carried over from the existing index, and the passage count.
+    """
+    previous = None
+    if os.path.exists(path):
+        try:
+            previous = FaqIndex(path)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Rebuilding FAQ index from scratch: {e}")
+
+    documents, passages = {}, []
+    extracted = reused = 0
+    try:
+        for filename in sorted(os.listdir(data_dir)):
+            if not filename.lower().endswith(".pdf"):
+                continue
+            digest = file_sha256(os.path.join(data_dir, filename))
+            old = previous.documents.get(filename) if previous else None
+            if old and old["sha256"] == digest:
+                start, end = old["passages"]
+                document_passages = [previous.passage(i)[1:] for i in range(start, end)]
+                reused += 1
+            else:
+                text = extract_pdf_text(os.path.join(data_dir, filename))
+                document_passages = split_passages(text)
+                extracted += 1
+            documents[filename] = {
+                "sha256": digest,
+                "passages": [len(passages), len(passages) + len(document_passages)],
+            }
+            passages.extend((filename, text, answer) for text, answer in document_passages)
+    finally:
+        if previous is not None:
+            previous.close()
+
+    _write_index(path, documents, passages)
+    return extracted, reused, len(passages)
+
+
+def _write_index(path, documents, passages):
+    postings = {}
+    table = []
+    texts = bytearray()
+    total_length = 0
+    for passage_id, (document, text, answer) in enumerate(passages):
+        terms = Counter(index_terms(text))
+        length = sum(terms.values())
+        total_length += length
+        for term, frequency in terms.items():
+            postings.setdefault(term, []).extend((passage_id, frequency))
+        encoded = text.encode("utf-8")
+        encoded_answer = answer.encode("utf-8") if answer else b""
+        table.append([document, len(texts), len(encoded), len(encoded_answer), length])
+        texts += encoded + encoded_answer
+
+    terms = {}
+    packed = array("I")
+    for term in sorted(postings):
+        terms[term] = [len(packed) // 2, len(postings[term]) // 2]
+        packed.extend(postings[term])
+
+    header = {
+        "byteorder": sys.byteorder,
+        "built_at": time.time(),
+        "documents": documents,
+        "passages": table,
+        "terms": terms,
+        "average_length": total_length / len(passages) if passages else 0.0,
+    }
+    # Offsets depend on the header's own length, so size it with placeholders first
+    header["postings_offset"] = header["texts_offset"] = 0
+    prefix = len(MAGIC) + HEADER_LENGTH.size
+    encoded = json.dumps(header, ensure_ascii=False).encode("utf-8")
+    postings_offset = prefix + len(encoded) + 32
+    postings_offset += -postings_offset % 8
+    header["postings_offset"] = postings_offset
+    header["texts_offset"] = postings_offset + len(packed) * packed.itemsize
+    encoded = json.dumps(header, ensure_ascii=False).encode("utf-8").ljust(
+        postings_offset - prefix
+    )
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(HEADER_LENGTH.pack(len(encoded)))
+        f.write(encoded)
+        packed.tofile(f)
+        f.write(texts)
+    os.replace(tmp_path, path)
+
+
+class FaqResponder:
+    """
+    Answers a question from the index when the best passage is a Q/A pair
+    that matches at least `min_terms` of its words, with a BM25 score of at
+    least `min_score` and at least `min_confidence`; otherwise returns None
+    so the caller can fall back to the Assistant. A one-word question like
+    "time" matches its passage with full confidence, so confidence alone
+    is not enough; two words ("wifi password") are. Picks up a rebuilt index file without a restart.
+    """
+
+    def __init__(self, path, min_confidence=0.6, min_score=6.0, min_terms=2, reload_interval=5.0):
+        self.path = path
+        self.min_confidence = min_confidence
+        self.min_score = min_score
+        self.min_terms = min_terms
+        self.reload_interval = reload_interval
+        self.index = None
+        self._mtime = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def answer(self, question):
+        self._maybe_reload()
+        index = self.index
+        if index is None:
+            return None
+        hits = index.search(question, limit=1)
+        if not hits:
+            return None
+        passage_id, score, confidence, matched = hits[0]
+        if matched < self.min_terms or score < self.min_score or confidence < self.min_confidence:
+            return None
+        document, _, answer = index.passage(passage_id)
+        if answer is None:
+            return None
+        logging.info(
+            f"Answered from {document} passage {passage_id} "
+            f"(score {score:.2f}, confidence {confidence:.2f}, {matched} terms)"
+        )
+        return answer
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now - self._checked_at < self.reload_interval:
+            return
+        self._checked_at = now
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        with self._lock:
+            if mtime == self._mtime:
+                return
+            try:
+                index = FaqIndex(self.path)
+            except (OSError, ValueError) as e:
+                logging.error(f"Not loading FAQ index {self.path}: {e}")
+                self._mtime = mtime
+                return
+            # The old mapping is left to the garbage collector, a search may still hold it
+            self.index, self._mtime = index, mtime
+            logging.info(f"Loaded FAQ index with {len(index.passages)} passages")
+
+
+def init_faq(app):
+    responder = FaqResponder(
+        app.config["FAQ_INDEX_PATH"],
+        min_confidence=app.config["FAQ_MIN_CONFIDENCE"],
+        min_score=app.config["FAQ_MIN_SCORE"],
+        min_terms=app.config["FAQ_MIN_TERMS"],
+    )
+    app.extensions["faq_responder"] = responder
+    return responder
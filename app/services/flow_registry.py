@@ -0,0 +1,225 @@
+"""
+Declarative reply flows loaded from `app/flows/flows.json`.
+
+The file maps button ids to flow names, keyword intents (see
+app/utils/intents.py) to the flow that answers them, and each flow name to
+a list of steps. "cooldowns" name flows that a user shouldn't get twice in
+a row, and what to send instead within the cooldown. A step is either a complete Graph API message payload or
+`{"flow": "<name>"}` to include another flow. Strings in payloads may use
+placeholders that are filled in per send:
+
+    {{to}}            the recipient's wa_id
+    {{name}}          the sender's profile name
+    {{media:<asset>}} the current media id of a data/ asset
+
+At load time every payload is serialized once and split around its
+placeholders, so a send only JSON-escapes the few dynamic values and joins
+pre-encoded byte segments. The file is reloaded when its mtime changes.
+"""
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from app.utils.intents import IntentMatcher
+
+PLACEHOLDER = re.compile(r"\{\{(\w+)(?::([\w.-]+))?\}\}")
+
+
+class PayloadTemplate:
+    """A message payload pre-serialized to bytes, with holes for placeholders."""
+
+    __slots__ = ("segments", "fields")
+
+    def __init__(self, payload):
+        text = json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+        segments, fields = [], []
+        position = 0
+        for match in PLACEHOLDER.finditer(text):
+            segments.append(text[position:match.start()].encode("utf-8"))
+            fields.append((match.group(1), match.group(2)))
+            position = match.end()
+        segments.append(text[position:].encode("utf-8"))
+        self.segments = segments
+        self.fields = fields
+
+    def render(self, context, resolve_media=None):
+        segments = self.segments
+        if not self.fields:
+            return segments[0]
+        parts = [segments[0]]
+        for (field, argument), segment in zip(self.fields, segments[1:]):
+            if field == "media":
+                value = resolve_media(argument)
+                if value is None:
+                    # No usable media id; never send "None" as one
+                    return None
+            else:
+                value = context[field]
+            # Placeholders always sit inside a JSON string, so only escape
+            parts.append(json.dumps(str(value), ensure_ascii=False)[1:-1].encode("utf-8"))
+            parts.append(segment)
+        return b"".join(parts)
+
+
+class FlowRegistry:
+    def __init__(self, path, reload_interval=1.0):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._mtime = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self.flows = {}
+        self.buttons = {}
+        self.cooldowns = {}
+        self.intents = IntentMatcher({})
+        self._load()
+
+    def flow_for_button(self, button_id):
+        self._maybe_reload()
+        return self.buttons.get(button_id)
+
+    def flow_for_text(self, text):
+        """Flow of the highest-priority intent in a text message, or None."""
+        self._maybe_reload()
+        return self.intents.flow_for(text)
+
+    def cooldown_for(self, flow_name):
+        self._maybe_reload()
+        return self.cooldowns.get(flow_name)
+
+    def render(self, flow_name, to, name="", resolve_media=None):
+        """
+        Return the flow's message payloads for one recipient, as bytes.
+        Messages whose media has no id are left out.
+        """
+        self._maybe_reload()
+        context = {"to": to, "name": name}
+        payloads = []
+        for template in self.flows[flow_name]:
+            payload = template.render(context, resolve_media)
+            if payload is None:
+                logging.warning(f"Skipping a message of flow {flow_name}: its media has no id")
+                continue
+            payloads.append(payload)
+        return payloads
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now - self._checked_at < self.reload_interval:
+            return
+        self._checked_at = now
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime != self._mtime:
+            with self._lock:
+                if mtime != self._mtime:
+                    self._load()
+
+    def _load(self):
+        mtime = None
+        try:
+            mtime = os.path.getmtime(self.path)
+            with open(self.path, encoding="utf-8") as f:
+                definition = json.load(f)
+            flows = compile_flows(definition.get("flows", {}))
+            buttons = dict(definition.get("buttons", {}))
+            unknown = [flow for flow in buttons.values() if flow not in flows]
+            if unknown:
+                raise ValueError(f"buttons point at unknown flows: {unknown}")
+            intents = IntentMatcher(definition.get("intents", {}))
+            unknown = [
+                flow for flow in intents.flows.values() if flow and flow not in flows
+            ]
+            if unknown:
+                raise ValueError(f"intents point at unknown flows: {unknown}")
+            cooldowns = dict(definition.get("cooldowns", {}))
+            unknown = [
+                flow
+                for name, rule in cooldowns.items()
+                for flow in (name, rule.get("instead"))
+                if flow and flow not in flows
+            ]
+            if unknown:
+                raise ValueError(f"cooldowns point at unknown flows: {unknown}")
+        except (OSError, ValueError) as e:
+            if self._mtime is None:
+                raise
+            # Keep serving the last good definition while the file is being
+            # edited, and don't retry this version of it on every message
+            logging.error(f"Not reloading flows from {self.path}: {e}")
+            self._mtime = mtime
+            return
+        self.flows, self.buttons, self.intents = flows, buttons, intents
+        self.cooldowns = cooldowns
+        self._mtime = mtime
+        logging.info(f"Loaded {len(flows)} flows from {self.path}")
+
+
+class FlowCooldowns:
+    """
+    Remembers when each user last got a flow that has a cooldown, e.g. so a
+    second "hi" within half an hour gets the tour buttons without the large
+    greeting image again. Kept per process for the latest `max_entries`
+    users.
+    """
+
+    def __init__(self, registry, max_entries=100000):
+        self.registry = registry
+        self.max_entries = max_entries
+        self._sent = OrderedDict()
+        self._lock = threading.Lock()
+
+    def choose(self, wa_id, flow_name):
+        """Return the flow to send instead of `flow_name` (None to send nothing)."""
+        rule = self.registry.cooldown_for(flow_name)
+        if rule is None:
+            return flow_name
+        key = (wa_id, flow_name)
+        now = time.time()
+        with self._lock:
+            sent_at = self._sent.get(key)
+            if sent_at is not None and now - sent_at < rule["minutes"] * 60:
+                return rule.get("instead")
+            self._sent[key] = now
+            self._sent.move_to_end(key)
+            while len(self._sent) > self.max_entries:
+                self._sent.popitem(last=False)
+        return flow_name
+
+
+def compile_flows(definitions):
+    """Expand flow includes and turn every payload into a PayloadTemplate."""
+    compiled = {}
+
+    def expand(name, stack):
+        if name in compiled:
+            return compiled[name]
+        if name in stack:
+            raise ValueError(f"flow {name} includes itself")
+        if name not in definitions:
+            raise ValueError(f"unknown flow {name}")
+        templates = []
+        for step in definitions[name]:
+            if set(step) == {"flow"}:
+                templates.extend(expand(step["flow"], stack + [name]))
+            else:
+                templates.append(PayloadTemplate(step))
+        compiled[name] = templates
+        return templates
+
+    for name in definitions:
+        expand(name, [])
+    return compiled
+
+
+def init_flow_registry(app):
+    registry = FlowRegistry(app.config["FLOWS_PATH"])
+    app.extensions["flow_registry"] = registry
+    app.extensions["flow_cooldowns"] = FlowCooldowns(registry)
+    return registry
@@ -0,0 +1,64 @@
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class GraphAPIClient:
+    """
+    Long-lived client for the WhatsApp Cloud API.
+
+    Holds one `requests.Session` so connections to graph.facebook.com are
+    pooled and kept alive between sends, and builds the auth headers and the
+    messages URL once instead of on every call.
+    """
+
+    def __init__(
+        self,
+        access_token,
+        version,
+        phone_number_id,
+        pool_size=10,
+        connect_timeout=3.05,
+        read_timeout=10,
+        base_url="https://graph.facebook.com",
+    ):
+        self.base_url = f"{base_url}/{version}"
+        self.phone_number_id = phone_number_id
+        self.messages_url = f"{self.base_url}/{phone_number_id}/messages"
+        self.timeout = (connect_timeout, read_timeout)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update(
+            {
+                "Content-type": "application/json",
+                "Authorization": f"Bearer {access_token}",
+            }
+        )
+
+    def post_message(self, data):
+        """Send a pre-serialized message payload to the messages endpoint."""
+        return self.session.post(self.messages_url, data=data, timeout=self.timeout)
+
+    def post(self, path, **kwargs):
+        """POST to an arbitrary Graph API path, e.g. "<phone_number_id>/media"."""
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.post(f"{self.base_url}/{path}", **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+def init_graph_client(app):
+    client = GraphAPIClient(
+        access_token=app.config["ACCESS_TOKEN"],
+        version=app.config["VERSION"],
+        phone_number_id=app.config["PHONE_NUMBER_ID"],
+        pool_size=app.config["GRAPH_POOL_SIZE"],
+        connect_timeout=app.config["GRAPH_CONNECT_TIMEOUT"],
+        read_timeout=app.config["GRAPH_READ_TIMEOUT"],
+        base_url=app.config["GRAPH_BASE_URL"],
+    )
+    app.extensions["graph_client"] = client
+    return client
@@ -0,0 +1,448 @@
+"""
+Durable queue between the webhook's 200 and the reply.
+
+With INBOUND_QUEUE_PATH set, the webhook writes each delivery (its raw
+body plus the ids of the messages that passed deduplication) to a SQLite
+table in WAL mode and only then answers Meta. Consumer threads claim rows,
+answer their messages and delete the rows once every reply, including an
+Assistant run, has been sent. While it works on a row the consumer keeps
+renewing its lease, so a slow run is not claimed a second time; a worker
+that dies mid-way leaves its rows claimed until the visibility timeout
+runs out, after which any worker picks them up again: delivery is at
+least once.
+
+Writes are group-committed: webhook threads hand their rows to one writer
+thread, which commits whatever has piled up in a single transaction (and
+a single fsync) and then wakes every waiting thread. Acks, lease renewals
+and retries ride along in the same transactions.
+"""
+import logging
+import sqlite3
+import threading
+import time
+
+from app.utils.webhook_parser import load_body, parse_webhook
+from app.utils.whatsapp_utils import process_burst
+from .scheduler import QueueFullError
+
+READY = "ready"
+DEAD = "dead"
+
+
+class QueueWriteError(Exception):
+    """The delivery could not be made durable; the webhook should be retried."""
+
+
+class Receipt:
+    """
+    Counts the pieces of work still holding a queued delivery. When the
+    last one is released, `on_done(ok)` is called once; `ok` is False if
+    any of them failed.
+    """
+
+    def __init__(self, on_done):
+        self.on_done = on_done
+        self._holds = 1
+        self._ok = True
+        self._lock = threading.Lock()
+
+    def hold(self):
+        with self._lock:
+            self._holds += 1
+        return self
+
+    def release(self, ok=True):
+        with self._lock:
+            self._holds -= 1
+            self._ok = self._ok and ok
+            done = self._holds == 0
+        if done:
+            self.on_done(self._ok)
+
+
+class QueuedDelivery:
+    __slots__ = ("id", "payload", "message_ids", "attempts")
+
+    def __init__(self, id, payload, message_ids, attempts):
+        self.id = id
+        self.payload = payload
+        self.message_ids = message_ids
+        self.attempts = attempts
+
+
+class _PendingWrite:
+    __slots__ = ("row", "done", "error")
+
+    def __init__(self, row):
+        self.row = row
+        self.done = threading.Event()
+        self.error = None
+
+
+class InboundQueue:
+    """
+    SQLite-backed queue of webhook deliveries.
+
+    `delay` holds new rows back for a moment, so a sender's quick follow-up
+    messages are claimed (and answered) together. Rows that fail are
+    retried with backoff; after `max_attempts` they are kept as "dead" for
+    `flask inbound-queue` to inspect and requeue.
+    """
+
+    def __init__(
+        self,
+        sqlite_path,
+        visibility_timeout=120,
+        max_attempts=5,
+        delay=0.0,
+        synchronous="FULL",
+        write_timeout=10,
+    ):
+        self.sqlite_path = sqlite_path
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.delay = delay
+        self.synchronous = synchronous
+        self.write_timeout = write_timeout
+        self.commits = 0
+        self.rows_written = 0
+        self._local = threading.local()
+        self._condition = threading.Condition()
+        self._writes = []
+        self._acks = []
+        self._extensions = []
+        self._retries = []
+        self._writer = None
+        self._init_db()
+
+    def put(self, payload, message_ids):
+        """Store a delivery durably; raises QueueWriteError if that failed."""
+        now = time.time()
+        write = _PendingWrite((payload, ",".join(message_ids), now, now + self.delay))
+        with self._condition:
+            self._writes.append(write)
+            self._condition.notify()
+        self._ensure_writer()
+        if not write.done.wait(self.write_timeout):
+            raise QueueWriteError("timed out waiting for the queue writer")
+        if write.error is not None:
+            raise QueueWriteError(str(write.error))
+
+    def claim(self, limit=100):
+        """Lease up to `limit` visible deliveries for the visibility timeout."""
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "UPDATE inbound SET visible_at = ?, claimed_at = ?, attempts = attempts + 1 "
+                "WHERE id IN (SELECT id FROM inbound WHERE state = ? AND visible_at <= ? "
+                "ORDER BY id LIMIT ?) "
+                "RETURNING id, payload, message_ids, attempts",
+                (now + self.visibility_timeout, now, READY, now, limit),
+            ).fetchall()
+        rows.sort()
+        return [
+            QueuedDelivery(id, payload, message_ids.split(",") if message_ids else [], attempts)
+            for id, payload, message_ids, attempts in rows
+        ]
+
+    def ack(self, delivery):
+        """Forget a delivery that has been answered."""
+        with self._condition:
+            self._acks.append(delivery.id)
+            self._condition.notify()
+        self._ensure_writer()
+
+    def extend(self, deliveries):
+        """Renew the lease of claimed deliveries that are still being answered."""
+        if not deliveries:
+            return
+        visible_at = time.time() + self.visibility_timeout
+        with self._condition:
+            self._extensions.extend((visible_at, delivery.id) for delivery in deliveries)
+            self._condition.notify()
+        self._ensure_writer()
+
+    def retry(self, delivery, error=None):
+        """Make a delivery visible again after a backoff, or park it as dead."""
+        if delivery.attempts >= self.max_attempts:
+            state, visible_at = DEAD, None
+            logging.error(f"Inbound delivery {delivery.id} failed {delivery.attempts} times, parking it")
+        else:
+            state, visible_at = READY, time.time() + min(2 ** delivery.attempts, 300)
+        with self._condition:
+            self._retries.append((state, visible_at, error, delivery.id))
+            self._condition.notify()
+        self._ensure_writer()
+
+    def stats(self):
+        """
+        Deliveries by state: ready to claim, claimed and not acked yet
+        (in_flight), held back by the debounce delay or a retry's backoff
+        (delayed), and dead.
+        """
+        now = time.time()
+        row = self._connection().execute(
+            "SELECT "
+            "COALESCE(SUM(state = ? AND visible_at <= ?), 0), "
+            "COALESCE(SUM(state = ? AND visible_at > ? AND claimed_at IS NOT NULL), 0), "
+            "COALESCE(SUM(state = ? AND visible_at > ? AND claimed_at IS NULL), 0), "
+            "COALESCE(SUM(state = ?), 0), "
+            "MIN(CASE WHEN state = ? THEN enqueued_at END) "
+            "FROM inbound",
+            (READY, now, READY, now, READY, now, DEAD, READY),
+        ).fetchone()
+        ready, in_flight, delayed, dead, oldest = row
+        return {
+            "ready": ready,
+            "in_flight": in_flight,
+            "delayed": delayed,
+            "dead": dead,
+            "oldest_age_seconds": now - oldest if oldest else None,
+        }
+
+    def list(self, state=READY, limit=20):
+        """(id, message_ids, attempts, enqueued_at, visible_at, last_error) rows, oldest first."""
+        return self._connection().execute(
+            "SELECT id, message_ids, attempts, enqueued_at, visible_at, last_error "
+            "FROM inbound WHERE state = ? ORDER BY id LIMIT ?",
+            (state, limit),
+        ).fetchall()
+
+    def payload(self, delivery_id):
+        row = self._connection().execute(
+            "SELECT payload FROM inbound WHERE id = ?", (delivery_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def requeue(self, ids=None):
+        """Make dead deliveries (all, or the given ids) ready again; returns how many."""
+        conn = self._connection()
+        sql = (
+            "UPDATE inbound SET state = ?, attempts = 0, visible_at = ?, claimed_at = NULL "
+            "WHERE state = ?"
+        )
+        params = [READY, time.time(), DEAD]
+        if ids:
+            sql += f" AND id IN ({','.join('?' * len(ids))})"
+            params.extend(ids)
+        return conn.execute(sql, params).rowcount
+
+    def purge_dead(self):
+        return self._connection().execute("DELETE FROM inbound WHERE state = ?", (DEAD,)).rowcount
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.sqlite_path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # FULL fsyncs every commit, which group commit keeps affordable;
+            # NORMAL survives process crashes but not power loss
+            conn.execute(f"PRAGMA synchronous={self.synchronous}")
+            self._local.conn = conn
+        return conn
+
+    def _init_db(self):
+        conn = self._connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS inbound ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, payload BLOB NOT NULL, "
+            "message_ids TEXT NOT NULL, enqueued_at REAL NOT NULL, "
+            "visible_at REAL, attempts INTEGER NOT NULL DEFAULT 0, "
+            f"state TEXT NOT NULL DEFAULT '{READY}', last_error TEXT, claimed_at REAL)"
+        )
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(inbound)")}
+        if "claimed_at" not in columns:
+            # Queues created before stats() told leases from backoffs
+            conn.execute("ALTER TABLE inbound ADD COLUMN claimed_at REAL")
+        conn.execute("CREATE INDEX IF NOT EXISTS inbound_visible ON inbound (state, visible_at)")
+
+    def _ensure_writer(self):
+        if self._writer is not None:
+            return
+        with self._condition:
+            if self._writer is None:
+                self._writer = threading.Thread(
+                    target=self._write_loop, name="inbound-queue-writer", daemon=True
+                )
+                self._writer.start()
+
+    def _write_loop(self):
+        while True:
+            with self._condition:
+                while not (self._writes or self._acks or self._extensions or self._retries):
+                    self._condition.wait()
+                # Everything that arrived during the previous commit goes
+                # into this one
+                writes, self._writes = self._writes, []
+                acks, self._acks = self._acks, []
+                extensions, self._extensions = self._extensions, []
+                retries, self._retries = self._retries, []
+            error = None
+            try:
+                conn = self._connection()
+                with conn:
+                    conn.execute("BEGIN IMMEDIATE")
+                    conn.executemany(
+                        "INSERT INTO inbound (payload, message_ids, enqueued_at, visible_at) "
+                        "VALUES (?, ?, ?, ?)",
+                        [write.row for write in writes],
+                    )
+                    conn.executemany("DELETE FROM inbound WHERE id = ?", [(id,) for id in acks])
+                    # Only rows still leased: a retry in this same batch wins
+                    conn.executemany(
+                        "UPDATE inbound SET visible_at = ? WHERE id = ? AND claimed_at IS NOT NULL",
+                        extensions,
+                    )
+                    conn.executemany(
+                        "UPDATE inbound SET state = ?, visible_at = ?, last_error = ?, "
+                        "claimed_at = NULL WHERE id = ?",
+                        retries,
+                    )
+                self.commits += 1
+                self.rows_written += len(writes)
+            except sqlite3.Error as e:
+                # Unacked rows simply become visible again after their timeout
+                logging.error(f"Inbound queue commit failed: {e}")
+                error = e
+            for write in writes:
+                write.error = error
+                write.done.set()
+
+
+class QueueConsumer:
+    """
+    Claims queued deliveries and answers them on the webhook dispatcher,
+    one job per sender so each sender's replies stay in order. A delivery
+    is acked once every job (and Assistant run) for it has finished; until
+    then its lease is renewed every `heartbeat_interval` seconds (a quarter
+    of the visibility timeout by default).
+    """
+
+    def __init__(
+        self, queue, app, batch_size=100, poll_interval=0.2, max_backlog=None, heartbeat_interval=None
+    ):
+        self.queue = queue
+        self.app = app
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.dispatcher = app.extensions["webhook_dispatcher"]
+        self.max_backlog = max_backlog or app.config["DISPATCH_QUEUE_SIZE"] // 2
+        if heartbeat_interval is None:
+            heartbeat_interval = queue.visibility_timeout / 4
+        self.heartbeat_interval = heartbeat_interval
+        self._held = {}
+        self._held_lock = threading.Lock()
+        self._heartbeat_at = 0.0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._loop, name="inbound-queue-consumer", daemon=True
+                )
+                self._thread.start()
+
+    def _loop(self):
+        while True:
+            try:
+                self.heartbeat()
+                claimed = self.drain_once()
+            except Exception:
+                logging.exception("Inbound queue consumer failed")
+                claimed = 0
+            if not claimed:
+                time.sleep(self.poll_interval)
+
+    def heartbeat(self):
+        """Renew the leases of deliveries still being answered, at most every `heartbeat_interval`."""
+        now = time.monotonic()
+        if now - self._heartbeat_at < self.heartbeat_interval:
+            return
+        self._heartbeat_at = now
+        with self._held_lock:
+            held = list(self._held.values())
+        self.queue.extend(held)
+
+    def drain_once(self):
+        """Claim one batch and hand it to the dispatcher; returns how many were claimed."""
+        if self.dispatcher.queue_depth() >= self.max_backlog:
+            return 0
+        deliveries = self.queue.claim(self.batch_size)
+        senders = {}
+        receipts = []
+        with self._held_lock:
+            self._held.update((delivery.id, delivery) for delivery in deliveries)
+        for delivery in deliveries:
+            receipt = Receipt(self._finisher(delivery))
+            receipts.append(receipt)
+            try:
+                batch = parse_webhook(load_body(delivery.payload))
+            except ValueError as e:
+                logging.error(f"Dropping unreadable inbound delivery {delivery.id}: {e}")
+                continue
+            wanted = set(delivery.message_ids)
+            for event in batch.messages:
+                if event.message_id in wanted:
+                    events, holds = senders.setdefault(event.wa_id, ([], []))
+                    events.append(event)
+                    if not holds or holds[-1] is not receipt:
+                        holds.append(receipt.hold())
+
+        for wa_id, (events, holds) in senders.items():
+            receipt = Receipt(lambda ok, holds=holds: [hold.release(ok) for hold in holds])
+            try:
+                self.dispatcher.enqueue(wa_id, self._answer, wa_id, events, receipt)
+            except QueueFullError:
+                receipt.release(ok=False)
+        for receipt in receipts:
+            receipt.release()
+        return len(deliveries)
+
+    @staticmethod
+    def _answer(wa_id, events, receipt):
+        try:
+            process_burst(wa_id, events, receipt=receipt)
+        except Exception:
+            receipt.release(ok=False)
+            raise
+        receipt.release()
+
+    def _finisher(self, delivery):
+        def finish(ok):
+            with self._held_lock:
+                self._held.pop(delivery.id, None)
+            if ok:
+                self.queue.ack(delivery)
+            else:
+                self.queue.retry(delivery, "reply failed")
+        return finish
+
+
+def init_inbound_queue(app):
+    path = app.config["INBOUND_QUEUE_PATH"]
+    if not path:
+        app.extensions["inbound_queue"] = None
+        return None
+    queue = InboundQueue(
+        path,
+        visibility_timeout=app.config["INBOUND_QUEUE_VISIBILITY_SECONDS"],
+        max_attempts=app.config["INBOUND_QUEUE_MAX_ATTEMPTS"],
+        # The queue takes the place of the in-memory debouncer
+        delay=app.config["INBOUND_DEBOUNCE_SECONDS"],
+        synchronous=app.config["INBOUND_QUEUE_SYNC"],
+    )
+    app.extensions["inbound_queue"] = queue
+    # Started by start_serving as soon as the server is up, so a restarted
+    # server replays what the last one left without waiting for a webhook,
+    # and `flask` commands never lease deliveries they won't answer. The
+    # first request starts it under servers that don't call start_serving.
+    consumer = QueueConsumer(queue, app)
+    app.extensions["serving_hooks"].append(consumer.start)
+    app.before_request(consumer.start)
+    return queue
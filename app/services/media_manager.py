@@ -0,0 +1,241 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+
+
+# Logical asset name -> (file in the data directory, mime type, media id
+# that was uploaded by hand and is used until the file has been uploaded)
+DEFAULT_ASSETS = {
+    "intro_image": ("intro.jpeg", "image/jpeg", "792434643189920"),
+    "yuva_yatra_1": ("yuva_yatra_1.pdf", "application/pdf", "1311569197013460"),
+    "yuva_yatra_2": ("yuva_yatra_2.pdf", "application/pdf", "683872947367766"),
+    "parivar_pravaas": ("Parivar Pravaas.pdf", "application/pdf", "1813897679248489"),
+}
+
+# Uploaded media is kept by WhatsApp for 30 days
+MEDIA_TTL_SECONDS = 30 * 24 * 3600
+
+# After a failed upload, sends use the fallback id for this long before retrying
+UPLOAD_RETRY_SECONDS = 300
+
+
+class MediaManager:
+    """
+    Uploads the files in `data/` to the WhatsApp media endpoint and hands
+    out their media ids by logical name.
+
+    Ids are cached in a JSON file keyed by the SHA-256 of the file content,
+    so an unchanged file is never uploaded twice and an edited file gets a
+    fresh upload. A background thread re-uploads assets before WhatsApp
+    expires them, which keeps uploads off the send path.
+    """
+
+    def __init__(
+        self,
+        graph_client,
+        data_dir,
+        cache_path="media_cache.json",
+        refresh_after=25 * 24 * 3600,
+        assets=None,
+    ):
+        self.graph_client = graph_client
+        self.data_dir = data_dir
+        self.cache_path = cache_path
+        self.refresh_after = refresh_after
+        self.assets = dict(assets or DEFAULT_ASSETS)
+        self._cache = {}
+        self._cache_mtime = None
+        self._hashes = {}
+        self._lock = threading.Lock()
+        self._upload_locks = {name: threading.Lock() for name in self.assets}
+        self._failed_at = {}
+        self._refresher = None
+        self._load_cache()
+
+    def resolve(self, name):
+        """
+        Return the media id for a logical asset name, or None if there is
+        none to send (no file, no fixed id, or an unknown name).
+
+        Only uploads when the asset has never been uploaded (e.g. prewarming
+        is off); ids that are merely getting old are refreshed in the
+        background.
+        """
+        if name not in self.assets:
+            logging.error(f"Unknown media asset {name}")
+            return None
+        filename, mime_type, fallback_id = self.assets[name]
+        path = os.path.join(self.data_dir, filename)
+        if not os.path.exists(path):
+            return fallback_id
+
+        self._reload_cache_if_changed()
+        entry = self._cache.get(self._file_hash(path))
+        if entry is None or self._expired(entry):
+            failed_at = self._failed_at.get(name)
+            if failed_at is None or time.time() - failed_at >= UPLOAD_RETRY_SECONDS:
+                entry = self._upload(name)
+        if entry is not None and self._expired(entry):
+            # WhatsApp has dropped that id, so a send with it would fail
+            logging.warning(
+                f"Media id of {name} has expired and could not be re-uploaded, "
+                f"using {'its fixed media id' if fallback_id else 'none'}"
+            )
+            entry = None
+        return entry["media_id"] if entry else fallback_id
+
+    def validate(self):
+        """
+        Log assets whose file is missing from data_dir, and return the
+        names of those that have no fixed media id either: messages that
+        use them are skipped.
+        """
+        unsendable = []
+        for name, (filename, _, fallback_id) in self.assets.items():
+            if os.path.exists(os.path.join(self.data_dir, filename)):
+                continue
+            if fallback_id:
+                logging.warning(f"Media asset {name} missing ({filename}), using its fixed media id")
+            else:
+                logging.error(
+                    f"Media asset {name} missing ({filename}) and has no fixed media id; "
+                    f"messages that use it will be skipped"
+                )
+                unsendable.append(name)
+        return unsendable
+
+    def prewarm(self):
+        """Upload every asset that has no fresh cached id yet."""
+        for name in self.assets:
+            filename = self.assets[name][0]
+            # Reported once at startup by validate()
+            if os.path.exists(os.path.join(self.data_dir, filename)):
+                self.refresh(name)
+
+    def refresh(self, name, force=False):
+        path = os.path.join(self.data_dir, self.assets[name][0])
+        entry = self._cache.get(self._file_hash(path))
+        if force or entry is None or self._due_for_refresh(entry):
+            return self._upload(name)
+        return entry
+
+    def start_refresher(self, interval=3600):
+        """Prewarm, then keep re-uploading assets ahead of expiry."""
+        if self._refresher is not None:
+            return
+
+        def run():
+            while True:
+                try:
+                    self.prewarm()
+                except Exception:
+                    logging.exception("Media refresh failed")
+                time.sleep(interval)
+
+        self._refresher = threading.Thread(target=run, name="media-refresher", daemon=True)
+        self._refresher.start()
+
+    def _upload(self, name):
+        filename, mime_type, _ = self.assets[name]
+        path = os.path.join(self.data_dir, filename)
+        with self._upload_locks[name]:
+            # Another thread (or worker, via the cache file) may have just done it
+            self._reload_cache_if_changed()
+            digest = self._file_hash(path)
+            entry = self._cache.get(digest)
+            if entry is not None and not self._due_for_refresh(entry):
+                return entry
+
+            try:
+                with open(path, "rb") as f:
+                    response = self.graph_client.post(
+                        f"{self.graph_client.phone_number_id}/media",
+                        files={"file": (filename, f, mime_type)},
+                        data={"messaging_product": "whatsapp", "type": mime_type},
+                        # Drop the session's JSON content type so requests
+                        # sets the multipart one
+                        headers={"Content-type": None},
+                    )
+                response.raise_for_status()
+                media_id = response.json()["id"]
+            except (requests.RequestException, ValueError, KeyError) as e:
+                logging.error(f"Failed to upload media asset {name}: {e}")
+                self._failed_at[name] = time.time()
+                return entry
+
+            self._failed_at.pop(name, None)
+            entry = {"media_id": media_id, "uploaded_at": time.time(), "filename": filename}
+            with self._lock:
+                self._cache[digest] = entry
+                self._save_cache()
+            logging.info(f"Uploaded media asset {name} as {media_id}")
+            return entry
+
+    def _expired(self, entry):
+        return time.time() - entry["uploaded_at"] >= MEDIA_TTL_SECONDS
+
+    def _due_for_refresh(self, entry):
+        return time.time() - entry["uploaded_at"] >= self.refresh_after
+
+    def _file_hash(self, path):
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        cached = self._hashes.get(path)
+        if cached and cached[0] == key:
+            return cached[1]
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 16), b""):
+                sha256.update(block)
+        digest = sha256.hexdigest()
+        self._hashes[path] = (key, digest)
+        return digest
+
+    def _load_cache(self):
+        try:
+            mtime = os.path.getmtime(self.cache_path)
+            with open(self.cache_path) as f:
+                self._cache = json.load(f)
+            self._cache_mtime = mtime
+        except FileNotFoundError:
+            self._cache = {}
+        except (OSError, ValueError) as e:
+            logging.error(f"Ignoring unreadable media cache {self.cache_path}: {e}")
+            self._cache = {}
+
+    def _reload_cache_if_changed(self):
+        # Other gunicorn workers share the cache file
+        try:
+            mtime = os.path.getmtime(self.cache_path)
+        except OSError:
+            return
+        if mtime != self._cache_mtime:
+            with self._lock:
+                self._load_cache()
+
+    def _save_cache(self):
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._cache, f, indent=2)
+        os.replace(tmp_path, self.cache_path)
+        self._cache_mtime = os.path.getmtime(self.cache_path)
+
+
+def init_media_manager(app):
+    media_manager = MediaManager(
+        app.extensions["graph_client"],
+        data_dir=app.config["MEDIA_DATA_DIR"],
+        cache_path=app.config["MEDIA_CACHE_PATH"],
+        refresh_after=app.config["MEDIA_REFRESH_DAYS"] * 24 * 3600,
+    )
+    app.extensions["media_manager"] = media_manager
+    media_manager.validate()
+    if app.config["MEDIA_PREWARM"]:
+        # In the serving process only, never for `flask` commands
+        app.extensions["serving_hooks"].append(media_manager.start_refresher)
+    return media_manager
@@ -0,0 +1,455 @@
+"""
+Latency histograms, counters and queue-depth gauges, served at /metrics
+in the Prometheus text format.
+
+Recording is lock-free on the hot path: every thread adds to its own
+array of bucket counts, and the arrays are only summed when /metrics is
+scraped. Queue depths are read from the services at scrape time.
+
+With METRICS_DIR set (one directory shared by all gunicorn workers, emptied
+before each start), every worker writes a snapshot of its metrics to
+METRICS_DIR/metrics.<pid>.json every few seconds and at exit. /metrics,
+whichever worker answers it, adds them up: counters and histograms from
+every file, including workers that have exited; gauges only from workers
+that are still running.
+"""
+import atexit
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        # A second create_app() replaces its gauges rather than adding more
+        self.metrics[metric.name] = metric
+        return metric
+
+    def snapshot(self):
+        """Every metric's samples in this process, as JSON-ready dicts."""
+        snapshot = {}
+        for name, metric in list(self.metrics.items()):
+            try:
+                snapshot[name] = metric.describe()
+            except Exception as e:
+                logging.error(f"Could not collect metric {name}: {e}")
+        return snapshot
+
+
+REGISTRY = MetricsRegistry()
+
+
+class _Shards:
+    """Per-thread arrays of `size` numbers, summed on read."""
+
+    def __init__(self, size):
+        self.size = size
+        self._local = threading.local()
+        self._shards = []
+        # What threads that have exited had added up
+        self._retired = [0] * size
+        self._lock = threading.Lock()
+
+    def get(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = [0] * self.size
+            with self._lock:
+                self._retire_exited()
+                self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    def total(self):
+        with self._lock:
+            self._retire_exited()
+            totals = list(self._retired)
+            shards = [shard for _, shard in self._shards]
+        for shard in shards:
+            for i, value in enumerate(shard):
+                totals[i] += value
+        return totals
+
+    def _retire_exited(self):
+        live = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                for i, value in enumerate(shard):
+                    self._retired[i] += value
+        self._shards = live
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self._child()
+        return child
+
+    def describe(self):
+        return {
+            "type": self.type,
+            "help": self.help,
+            "labelnames": list(self.labelnames),
+            "samples": [
+                [list(values), child.value()] for values, child in list(self._children.items())
+            ],
+        }
+
+
+class _CounterChild:
+    __slots__ = ("_shards",)
+
+    def __init__(self):
+        self._shards = _Shards(1)
+
+    def inc(self, amount=1):
+        self._shards.get()[0] += amount
+
+    def value(self):
+        return self._shards.total()[0]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def _child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "_shards")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # One count per bucket, one for +Inf, then the sum
+        self._shards = _Shards(len(bounds) + 2)
+
+    def observe(self, value):
+        shard = self._shards.get()
+        shard[bisect_left(self.bounds, value)] += 1
+        shard[-1] += value
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def value(self):
+        return self._shards.total()
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labelnames, registry)
+
+    def _child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def describe(self):
+        description = super().describe()
+        description["buckets"] = list(self.buckets)
+        return description
+
+
+class Gauge(_Metric):
+    """
+    A value read at scrape time from `read()`: a number, or a dict from
+    label-value tuples to numbers. Across workers the values are added up
+    ("sum", for per-process queues) or the largest is taken ("max", for
+    state every worker sees, like the SQLite inbound queue).
+    """
+
+    type = "gauge"
+
+    def __init__(self, name, help, read, labelnames=(), multiprocess_mode="sum", registry=REGISTRY):
+        self.read = read
+        self.multiprocess_mode = multiprocess_mode
+        super().__init__(name, help, labelnames, registry)
+
+    def describe(self):
+        value = self.read()
+        samples = value.items() if isinstance(value, dict) else [((), value)]
+        return {
+            "type": self.type,
+            "help": self.help,
+            "labelnames": list(self.labelnames),
+            "mode": self.multiprocess_mode,
+            "samples": [[list(values), value] for values, value in samples if value is not None],
+        }
+
+
+# Hot paths instrumented across the app
+WEBHOOK_SECONDS = Histogram(
+    "whatsapp_webhook_seconds",
+    "Time to handle a POST /webhook delivery, by what it carried.",
+    ["event"],
+)
+SEND_SECONDS = Histogram(
+    "whatsapp_send_message_seconds",
+    "Time to send one message to the Graph API, retries included, by final status.",
+    ["status"],
+)
+RUN_SECONDS = Histogram(
+    "openai_run_seconds",
+    "Duration of Assistant runs, by final status and whether they streamed.",
+    ["status", "mode"],
+    buckets=(0.5, 1.0, 2.0, 3.0, 5.0, 8.0, 13.0, 20.0, 30.0, 45.0, 60.0, 90.0),
+)
+RUN_POLLS = Histogram(
+    "openai_run_polls",
+    "Status polls per polled Assistant run.",
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34),
+)
+THREAD_LOOKUP_SECONDS = Histogram(
+    "thread_store_lookup_seconds",
+    "wa_id -> thread id lookups, by where the answer came from.",
+    ["source"],
+    buckets=(0.00001, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5),
+)
+
+
+def webhook_event(batch):
+    """The `event` label of a parsed delivery."""
+    if not batch.is_whatsapp:
+        return "other"
+    if batch.messages:
+        return "message"
+    if batch.statuses:
+        return "status"
+    return "other"
+
+
+def merge(snapshots, live_pids=None):
+    """
+    Add up snapshots from several processes. Gauges only count from
+    processes in `live_pids` (all of them when it is None).
+    """
+    merged = {}
+    for pid, snapshot in snapshots:
+        for name, metric in snapshot.items():
+            is_gauge = metric["type"] == "gauge"
+            if is_gauge and live_pids is not None and pid not in live_pids:
+                continue
+            target = merged.setdefault(name, {**metric, "samples": {}})
+            for values, value in metric["samples"]:
+                key = tuple(values)
+                current = target["samples"].get(key)
+                if current is None:
+                    target["samples"][key] = value
+                elif isinstance(value, list):
+                    target["samples"][key] = [a + b for a, b in zip(current, value)]
+                elif is_gauge and metric.get("mode") == "max":
+                    target["samples"][key] = max(current, value)
+                else:
+                    target["samples"][key] = current + value
+    return merged
+
+
+def render(merged):
+    """Prometheus text exposition of `merge()`d metrics."""
+    lines = []
+    for name, metric in sorted(merged.items()):
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        labelnames = metric["labelnames"]
+        for values, value in sorted(metric["samples"].items()):
+            labels = list(zip(labelnames, values))
+            if metric["type"] != "histogram":
+                lines.append(f"{name}{_labels(labels)} {_number(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(metric["buckets"] + ["+Inf"], value[:-1]):
+                cumulative += count
+                le = bound if bound == "+Inf" else _number(float(bound))
+                lines.append(f"{name}_bucket{_labels(labels + [('le', le)])} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {_number(value[-1])}")
+            lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+def _labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsExporter:
+    """
+    Serves the registry's metrics, and with `directory` set shares them
+    between worker processes through one snapshot file per pid.
+    """
+
+    def __init__(self, registry=REGISTRY, directory=None, write_interval=5.0):
+        self.registry = registry
+        self.directory = directory
+        self.write_interval = write_interval
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start writing this process's snapshots (after gunicorn forks it)."""
+        if self.directory is None or self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                os.makedirs(self.directory, exist_ok=True)
+                self._thread = threading.Thread(
+                    target=self._write_loop, name="metrics-writer", daemon=True
+                )
+                self._thread.start()
+                atexit.register(self.write)
+
+    def collect(self):
+        if self.directory is None:
+            return merge([(os.getpid(), self.registry.snapshot())])
+        self.write()
+        snapshots = []
+        for path in glob.glob(os.path.join(self.directory, "metrics.*.json")):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                # Being replaced right now, or left half-written by a crash
+                continue
+            snapshots.append((snapshot["pid"], snapshot["metrics"]))
+        live_pids = {pid for pid, _ in snapshots if _is_running(pid)}
+        return merge(snapshots, live_pids)
+
+    def render(self):
+        return render(self.collect())
+
+    def write(self):
+        pid = os.getpid()
+        path = os.path.join(self.directory, f"metrics.{pid}.json")
+        temporary = f"{path}.tmp"
+        try:
+            with open(temporary, "w", encoding="utf-8") as f:
+                json.dump({"pid": pid, "metrics": self.registry.snapshot()}, f)
+            os.replace(temporary, path)
+        except (OSError, TypeError, ValueError) as e:
+            # Logged and retried on the next interval; the writer thread keeps going
+            logging.error(f"Could not write metrics to {path}: {e}")
+
+    def _write_loop(self):
+        while True:
+            self.write()
+            time.sleep(self.write_interval)
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def init_metrics(app):
+    """Queue-depth gauges over this app's services, and the exporter behind /metrics."""
+    extensions = app.extensions
+
+    def inbound_queue_states():
+        inbound_queue = extensions.get("inbound_queue")
+        if inbound_queue is None:
+            return {}
+        stats = inbound_queue.stats()
+        return {(state,): stats[state] for state in ("ready", "delayed", "in_flight", "dead")}
+
+    def inbound_backlog():
+        debouncer = extensions.get("inbound_debouncer")
+        return debouncer.backlog() if debouncer is not None else 0
+
+    def status_buffer():
+        pipeline = extensions.get("status_pipeline")
+        return pipeline.pending() if pipeline is not None else 0
+
+    Gauge(
+        "whatsapp_dispatch_queue_depth",
+        "Reply jobs queued or running on the webhook dispatcher.",
+        lambda: extensions["webhook_dispatcher"].queue_depth(),
+    )
+    Gauge(
+        "whatsapp_dispatch_active_conversations",
+        "Senders with reply jobs queued or running.",
+        lambda: extensions["webhook_dispatcher"].scheduler.active_keys(),
+    )
+    Gauge(
+        "whatsapp_inbound_debounce_pending",
+        "Messages waiting for their sender to pause.",
+        inbound_backlog,
+    )
+    Gauge(
+        "whatsapp_ai_debounce_pending",
+        "Questions waiting for their user's next Assistant run.",
+        lambda: extensions["run_coordinator"].debouncer.backlog(),
+    )
+    Gauge(
+        "whatsapp_status_buffer_pending",
+        "Status updates buffered for the next SQLite flush.",
+        status_buffer,
+    )
+    Gauge(
+        "whatsapp_inbound_queue_deliveries",
+        "Deliveries in the durable inbound queue, by state.",
+        inbound_queue_states,
+        ["state"],
+        # Every worker sees the same SQLite file
+        multiprocess_mode="max",
+    )
+    exporter = MetricsExporter(REGISTRY, app.config["METRICS_DIR"] or None)
+    app.extensions["metrics"] = exporter
+    # Started in the worker process that serves requests, after any fork
+    app.extensions["serving_hooks"].append(exporter.start)
+    app.before_request(exporter.start)
+    return exporter
@@ -0,0 +1,240 @@
+"""
+Several WhatsApp business numbers served by one deployment.
+
+Each number gets its own Graph API client (credentials and connection
+pool), delivery rate-limit bucket, media uploads and flow definition.
+Numbers are read from the JSON file at NUMBERS_PATH:
+
+    {"numbers": {
+        "118360017864937": {
+            "label": "Dev Deepawali",
+            "access_token_env": "DEVDEEPAWALI_ACCESS_TOKEN",
+            "flows_path": "flows/devdeepawali.json",
+            "rate_per_second": 80, "burst": 80, "pool_size": 10
+        }, ...}}
+
+Only the phone_number_id keys are required. "access_token" may be given
+inline instead of naming an environment variable. Relative paths are
+resolved against the file's directory, and anything left out falls back
+to the single-number settings (ACCESS_TOKEN, FLOWS_PATH, OUTBOUND_*, ...).
+The number in PHONE_NUMBER_ID is always registered with the app's default
+client, delivery, media manager and flows.
+
+Webhooks are routed on their `metadata.phone_number_id`. While the reply
+flow runs for a number, `current_number()` returns it, so send_message,
+send_flow and the intent lookups use that number's clients and flows.
+"""
+import json
+import logging
+import os
+from contextlib import contextmanager
+
+from flask import current_app, g
+
+from .delivery import OutboundDelivery
+from .flow_registry import FlowCooldowns, FlowRegistry
+from .graph_client import GraphAPIClient
+from .media_manager import DEFAULT_ASSETS, MediaManager
+
+
+class BusinessNumber:
+    """The clients, limits and flows of one WhatsApp business number."""
+
+    def __init__(
+        self,
+        phone_number_id,
+        graph_client,
+        delivery,
+        media_manager,
+        flows,
+        cooldowns,
+        access_token=None,
+        pool_size=10,
+        label=None,
+    ):
+        self.phone_number_id = phone_number_id
+        self.graph_client = graph_client
+        self.delivery = delivery
+        self.media_manager = media_manager
+        self.flows = flows
+        self.cooldowns = cooldowns
+        # Kept to build the async client for this number (app/async_app.py)
+        self.access_token = access_token
+        self.pool_size = pool_size
+        self.label = label or phone_number_id
+
+    def __repr__(self):
+        return f"BusinessNumber({self.phone_number_id!r}, label={self.label!r})"
+
+
+class NumberRegistry:
+    """
+    Business numbers by phone_number_id.
+
+    Without a numbers file every webhook is answered from the default
+    number, as before. With one, webhooks for numbers it doesn't list are
+    ignored rather than answered from the wrong number.
+    """
+
+    def __init__(self, default=None, strict=False):
+        self.default = default
+        self.strict = strict
+        self.numbers = {}
+        if default is not None and default.phone_number_id:
+            self.numbers[default.phone_number_id] = default
+
+    def add(self, number):
+        self.numbers[number.phone_number_id] = number
+
+    def get(self, phone_number_id):
+        """The number a webhook was sent to, or None if this app doesn't serve it."""
+        number = self.numbers.get(phone_number_id)
+        if number is None and not self.strict:
+            return self.default
+        return number
+
+    def __iter__(self):
+        return iter(self.numbers.values())
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def replay_dead_letters(self):
+        """Resend dead-lettered payloads, each from the number it was meant to go out from."""
+        dead_letter = self.default.delivery.dead_letter if self.default else None
+        if dead_letter is None:
+            return 0, 0
+        delivered = failed = 0
+        for record in dead_letter.take():
+            number = self.get(record.get("phone_number_id"))
+            if number is None:
+                # Put it back for when that number is configured again
+                dead_letter.append(
+                    record["payload"], record.get("phone_number_id"), record.get("reason"),
+                    record.get("status_code"), record.get("error"), record.get("attempts", 0),
+                )
+                failed += 1
+                continue
+            delivered_now, failed_now = number.delivery.replay_records([record])
+            delivered += delivered_now
+            failed += failed_now
+        return delivered, failed
+
+
+def current_number():
+    """The number the current reply flow is answering from (default: PHONE_NUMBER_ID)."""
+    number = g.get("business_number")
+    if number is None:
+        number = current_app.extensions["number_registry"].default
+    return number
+
+
+@contextmanager
+def sending_from(number):
+    """Make `number` the current number for the block."""
+    previous = g.get("business_number")
+    g.business_number = number
+    try:
+        yield number
+    finally:
+        g.business_number = previous
+
+
+def load_numbers(path):
+    with open(path, encoding="utf-8") as f:
+        numbers = json.load(f).get("numbers", {})
+    if not isinstance(numbers, dict):
+        raise ValueError(f"{path}: \"numbers\" must map phone_number_id to settings")
+    return numbers
+
+
+def build_number(app, phone_number_id, settings, base_dir, flow_registries):
+    config = app.config
+
+    def path_setting(key, default):
+        value = settings.get(key)
+        return os.path.join(base_dir, value) if value else default
+
+    access_token = settings.get("access_token")
+    if access_token is None and settings.get("access_token_env"):
+        access_token = os.getenv(settings["access_token_env"])
+    if not access_token:
+        if settings.get("access_token_env"):
+            logging.warning(f"{settings['access_token_env']} is not set, using ACCESS_TOKEN")
+        access_token = config["ACCESS_TOKEN"]
+
+    pool_size = int(settings.get("pool_size", config["GRAPH_POOL_SIZE"]))
+    graph_client = GraphAPIClient(
+        access_token=access_token,
+        version=config["VERSION"],
+        phone_number_id=phone_number_id,
+        pool_size=pool_size,
+        connect_timeout=config["GRAPH_CONNECT_TIMEOUT"],
+        read_timeout=config["GRAPH_READ_TIMEOUT"],
+        base_url=config["GRAPH_BASE_URL"],
+    )
+    default_delivery = app.extensions["outbound_delivery"]
+    delivery = OutboundDelivery(
+        graph_client,
+        rate_per_second=float(settings.get("rate_per_second", config["OUTBOUND_RATE_PER_SECOND"])),
+        burst=int(settings.get("burst", config["OUTBOUND_BURST"])),
+        max_retries=config["OUTBOUND_MAX_RETRIES"],
+        # One log for every number; records say which number they were for
+        dead_letter=default_delivery.dead_letter,
+    )
+    media_manager = MediaManager(
+        graph_client,
+        data_dir=path_setting("media_data_dir", config["MEDIA_DATA_DIR"]),
+        cache_path=path_setting("media_cache_path", f"media_cache.{phone_number_id}.json"),
+        refresh_after=config["MEDIA_REFRESH_DAYS"] * 24 * 3600,
+        # The hand-uploaded fallback ids belong to the default number
+        assets={
+            name: (filename, mime_type, None)
+            for name, (filename, mime_type, _) in DEFAULT_ASSETS.items()
+        },
+    )
+    media_manager.validate()
+    flows_path = path_setting("flows_path", config["FLOWS_PATH"])
+    if flows_path not in flow_registries:
+        flow_registries[flows_path] = FlowRegistry(flows_path)
+    flows = flow_registries[flows_path]
+    return BusinessNumber(
+        phone_number_id,
+        graph_client,
+        delivery,
+        media_manager,
+        flows,
+        FlowCooldowns(flows),
+        access_token=access_token,
+        pool_size=pool_size,
+        label=settings.get("label"),
+    )
+
+
+def init_number_registry(app):
+    config = app.config
+    default = BusinessNumber(
+        config["PHONE_NUMBER_ID"],
+        app.extensions["graph_client"],
+        app.extensions["outbound_delivery"],
+        app.extensions["media_manager"],
+        app.extensions["flow_registry"],
+        app.extensions["flow_cooldowns"],
+        access_token=config["ACCESS_TOKEN"],
+        pool_size=config["GRAPH_POOL_SIZE"],
+    )
+    path = config["NUMBERS_PATH"]
+    registry = NumberRegistry(default, strict=bool(path))
+    if path:
+        base_dir = os.path.dirname(os.path.abspath(path))
+        flow_registries = {config["FLOWS_PATH"]: default.flows}
+        for phone_number_id, settings in load_numbers(path).items():
+            if phone_number_id == default.phone_number_id and not settings:
+                continue
+            number = build_number(app, phone_number_id, settings or {}, base_dir, flow_registries)
+            registry.add(number)
+            if config["MEDIA_PREWARM"]:
+                app.extensions["serving_hooks"].append(number.media_manager.start_refresher)
+        logging.info(f"Serving {len(registry)} WhatsApp numbers from {path}")
+    app.extensions["number_registry"] = registry
+    return registry
@@ -1,13 +1,30 @@
-from openai import OpenAI
-import shelve
+from openai import APITimeoutError, OpenAI, OpenAIError
 from dotenv import load_dotenv
+import functools
+import hashlib
 import os
 import time
 import logging
 
+from .metrics import RUN_POLLS, RUN_SECONDS
+from .response_cache import answer_cache_enabled, get_response_cache
+from .thread_store import get_thread_store
+
 load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_ASSISTANT_ID = os.getenv("OPENAI_ASSISTANT_ID")
+# Hard limit on a single assistant run, and the polling backoff used when
+# streaming is unavailable or disabled
+RUN_DEADLINE_SECONDS = float(os.getenv("RUN_DEADLINE_SECONDS", "60"))
+RUN_POLL_INITIAL_DELAY = float(os.getenv("RUN_POLL_INITIAL_DELAY", "0.2"))
+RUN_POLL_MAX_DELAY = float(os.getenv("RUN_POLL_MAX_DELAY", "2.0"))
+RUN_STREAMING = os.getenv("RUN_STREAMING", "true").lower() == "true"
+# Threads with this many messages are replaced by a fresh one seeded with a
+# summary, so long conversations don't make every run slower (0 disables)
+THREAD_MAX_MESSAGES = int(os.getenv("THREAD_MAX_MESSAGES", "40"))
+THREAD_SUMMARY_MODEL = os.getenv("THREAD_SUMMARY_MODEL", "gpt-4o-mini")
+# How many of the latest messages the summary is written from
+THREAD_SUMMARY_SOURCE_MESSAGES = 20
 client = OpenAI(api_key=OPENAI_API_KEY)
 
 
@@ -32,66 +49,310 @@ def create_assistant(file):
     return assistant
 
 
-# Use context manager to ensure the shelf file is closed properly
+# Thread ids live in a shared store with an in-process LRU in front of it
 def check_if_thread_exists(wa_id):
-    with shelve.open("threads_db") as threads_shelf:
-        return threads_shelf.get(wa_id, None)
+    return get_thread_store().get(wa_id)
 
 
 def store_thread(wa_id, thread_id):
-    with shelve.open("threads_db", writeback=True) as threads_shelf:
-        threads_shelf[wa_id] = thread_id
+    get_thread_store().set(wa_id, thread_id)
+
+
+# A run in any of these states will not change any more
+TERMINAL_RUN_STATUSES = {"completed", "failed", "cancelled", "expired", "incomplete"}
+
+
+class RunStats:
+    """Outcome of one assistant run, for logging and metrics."""
+
+    __slots__ = ("run_id", "status", "elapsed", "polls", "streamed")
+
+    def __init__(self, run_id=None, status=None, elapsed=0.0, polls=0, streamed=False):
+        self.run_id = run_id
+        self.status = status
+        self.elapsed = elapsed
+        self.polls = polls
+        self.streamed = streamed
+
+
+@functools.lru_cache(maxsize=1)
+def get_assistant():
+    """Retrieve the Assistant once per process instead of once per message."""
+    return client.beta.assistants.retrieve(OPENAI_ASSISTANT_ID)
+
+
+@functools.lru_cache(maxsize=1)
+def assistant_fingerprint():
+    """
+    Hash of the Assistant's model, instructions, tools and files; answers
+    cached under another fingerprint are never served.
+    """
+    assistant = get_assistant()
+    parts = [
+        assistant.id,
+        assistant.model,
+        assistant.instructions,
+        repr(getattr(assistant, "tools", None)),
+        repr(getattr(assistant, "tool_resources", None)),
+        repr(getattr(assistant, "file_ids", None)),
+    ]
+    return hashlib.sha256(repr(parts).encode("utf-8")).hexdigest()[:16]
+
+
+def get_answer_cache():
+    """The answer cache for the current Assistant, or None if it is off."""
+    if not answer_cache_enabled():
+        return None
+    try:
+        fingerprint = assistant_fingerprint()
+    except Exception as e:
+        logging.error(f"Not using the answer cache, assistant unavailable: {e}")
+        return None
+    return get_response_cache(fingerprint)
 
 
-def run_assistant(thread, name):
-    # Retrieve the Assistant
-    assistant = client.beta.assistants.retrieve(OPENAI_ASSISTANT_ID)
+def warm_assistant():
+    """Fetch the Assistant at startup so the first reply doesn't pay for it."""
+    try:
+        get_assistant()
+    except Exception as e:
+        logging.error(f"Could not retrieve assistant {OPENAI_ASSISTANT_ID}: {e}")
 
-    # Run the assistant
+
+def cancel_run(thread_id, run_id):
+    try:
+        client.beta.threads.runs.cancel(run_id, thread_id=thread_id)
+    except Exception as e:
+        logging.error(f"Failed to cancel run {run_id}: {e}")
+
+
+def _stream_run(thread_id, deadline, stats, on_text=None):
+    """Follow the run through server-sent events, no polling needed."""
+    run = None
+    with client.beta.threads.runs.stream(
+        thread_id=thread_id,
+        assistant_id=get_assistant().id,
+        timeout=RUN_DEADLINE_SECONDS,
+    ) as stream:
+        for event in stream:
+            if event.event.startswith("thread.run."):
+                run = event.data
+                stats.run_id = run.id
+                stats.status = run.status
+                if run.status in TERMINAL_RUN_STATUSES or run.status == "requires_action":
+                    break
+            elif event.event == "thread.message.delta" and on_text is not None:
+                for part in event.data.delta.content or []:
+                    if part.type == "text" and part.text and part.text.value:
+                        on_text(part.text.value)
+            if time.monotonic() > deadline:
+                stats.status = "deadline_exceeded"
+                break
+    return run
+
+
+def _poll_run(thread_id, deadline, stats):
+    """Poll with adaptive backoff: quick at first, backing off for long runs."""
     run = client.beta.threads.runs.create(
-        thread_id=thread.id,
-        assistant_id=assistant.id,
+        thread_id=thread_id,
+        assistant_id=get_assistant().id,
         # instructions=f"You are having a conversation with {name}",
     )
-
-    # Wait for completion
+    stats.run_id = run.id
+    delay = RUN_POLL_INITIAL_DELAY
     # https://platform.openai.com/docs/assistants/how-it-works/runs-and-run-steps#:~:text=under%20failed_at.-,Polling%20for%20updates,-In%20order%20to
-    while run.status != "completed":
-        # Be nice to the API
-        time.sleep(0.5)
-        run = client.beta.threads.runs.retrieve(thread_id=thread.id, run_id=run.id)
-
-    # Retrieve the Messages
-    messages = client.beta.threads.messages.list(thread_id=thread.id)
-    new_message = messages.data[0].content[0].text.value
+    while run.status not in TERMINAL_RUN_STATUSES and run.status != "requires_action":
+        if time.monotonic() + delay > deadline:
+            stats.status = "deadline_exceeded"
+            return run
+        time.sleep(delay)
+        delay = min(delay * 1.5, RUN_POLL_MAX_DELAY)
+        run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
+        stats.polls += 1
+    stats.status = run.status
+    return run
+
+
+def execute_run(thread_id, on_text=None):
+    """
+    Run the assistant on a thread until it reaches a final state or the
+    RUN_DEADLINE_SECONDS deadline passes.
+
+    Streams run events when the SDK supports it (calling `on_text` with each
+    text delta), otherwise polls. Runs that need tool outputs or that blow
+    the deadline are cancelled, since this bot registers no functions.
+    """
+    stats = RunStats()
+    started = time.monotonic()
+    deadline = started + RUN_DEADLINE_SECONDS
+    run = None
+    try:
+        if RUN_STREAMING and hasattr(client.beta.threads.runs, "stream"):
+            stats.streamed = True
+            run = _stream_run(thread_id, deadline, stats, on_text)
+        else:
+            run = _poll_run(thread_id, deadline, stats)
+    except APITimeoutError:
+        stats.status = "deadline_exceeded"
+    except OpenAIError as e:
+        logging.error(f"Assistant run on thread {thread_id} failed: {e}")
+        stats.status = "error"
+
+    if run is not None and stats.status in ("requires_action", "deadline_exceeded"):
+        cancel_run(thread_id, run.id)
+
+    stats.elapsed = time.monotonic() - started
+    logging.info(
+        f"Run {stats.run_id} finished as {stats.status} in {stats.elapsed:.2f}s "
+        f"({stats.polls} polls, streamed={stats.streamed})"
+    )
+    return stats
+
+
+def run_assistant(thread_id, name, on_text=None):
+    streamed = []
+
+    def collect(delta):
+        streamed.append(delta)
+        if on_text is not None:
+            on_text(delta)
+
+    stats = execute_run(thread_id, on_text=collect)
+    RUN_SECONDS.labels(str(stats.status), "stream" if stats.streamed else "poll").observe(stats.elapsed)
+    if not stats.streamed:
+        RUN_POLLS.observe(stats.polls)
+    if stats.status != "completed":
+        logging.error(f"No reply for {name}: run {stats.run_id} ended as {stats.status}")
+        return None
+
+    if streamed:
+        # The streamed deltas already add up to the reply
+        new_message = "".join(streamed)
+    else:
+        # Retrieve the newest message, which is the assistant's reply
+        messages = client.beta.threads.messages.list(thread_id=thread_id, limit=1)
+        new_message = messages.data[0].content[0].text.value
     logging.info(f"Generated message: {new_message}")
     return new_message
 
 
-def generate_response(message_body, wa_id, name):
-    # Check if there is already a thread_id for the wa_id
-    thread_id = check_if_thread_exists(wa_id)
+def message_text(message):
+    return " ".join(
+        part.text.value for part in message.content if part.type == "text" and part.text
+    )
+
+
+def summarize_thread(thread_id):
+    """A few lines capturing what the conversation on `thread_id` was about."""
+    messages = client.beta.threads.messages.list(
+        thread_id=thread_id, limit=THREAD_SUMMARY_SOURCE_MESSAGES, order="desc"
+    )
+    transcript = "\n".join(
+        f"{message.role.capitalize()}: {message_text(message)}"
+        for message in reversed(messages.data)
+    )
+    try:
+        completion = client.chat.completions.create(
+            model=THREAD_SUMMARY_MODEL,
+            messages=[
+                {
+                    "role": "system",
+                    "content": "Summarize this WhatsApp conversation between a traveller and "
+                    "a tour assistant in at most five short bullet points. Keep names, "
+                    "dates, group size, chosen tours, preferences and open questions.",
+                },
+                {"role": "user", "content": transcript},
+            ],
+            max_tokens=200,
+        )
+        return completion.choices[0].message.content.strip()
+    except OpenAIError as e:
+        # Carry over the tail of the conversation rather than nothing
+        logging.error(f"Could not summarize thread {thread_id}: {e}")
+        return transcript[-1500:]
+
+
+def rotate_thread(wa_id, thread_id, name):
+    """
+    Move `wa_id` to a new thread that starts with a summary of the old one.
+    Returns the thread id to use from now on.
+    """
+    summary = summarize_thread(thread_id)
+    new_thread = client.beta.threads.create(
+        messages=[
+            {
+                "role": "user",
+                "content": f"Summary of our conversation so far, for context:\n{summary}",
+            }
+        ]
+    )
+    store = get_thread_store()
+    if store.replace_thread(wa_id, thread_id, new_thread.id, message_count=1):
+        logging.info(f"Rotated {name}'s thread {thread_id} to {new_thread.id}")
+        return new_thread.id
+
+    # Another worker rotated it first; use theirs and drop ours
+    try:
+        client.beta.threads.delete(new_thread.id)
+    except OpenAIError as e:
+        logging.error(f"Failed to delete unused thread {new_thread.id}: {e}")
+    return store.get(wa_id)
+
+
+def generate_response(message_body, wa_id, name, on_text=None):
+    """
+    Add the user's message to their thread and return the assistant's reply.
+
+    `on_text`, if given, is called with each text delta while the run streams.
+    Questions answered before are served from the answer cache without
+    touching OpenAI at all.
+    """
+    cache = get_answer_cache()
+    cached = cache.get(message_body) if cache is not None else None
+    if cached is not None:
+        logging.info(f"Answered {name} from the answer cache")
+        return cached
+
+    store = get_thread_store()
 
-    # If a thread doesn't exist, create one and store it
+    # Check if there is already a thread_id for the wa_id. Read it from the
+    # shared store, not this worker's cache: another worker may have rotated
+    # the thread since, and messages added to the old one would be lost.
+    thread_id, message_count = store.current(wa_id)
+    new_thread = thread_id is None
+
+    # If a thread doesn't exist, create one and store it; get_or_create makes
+    # sure two workers handling the same new user end up on one thread
     if thread_id is None:
         logging.info(f"Creating new thread for {name} with wa_id {wa_id}")
-        thread = client.beta.threads.create()
-        store_thread(wa_id, thread.id)
-        thread_id = thread.id
+        thread_id = store.get_or_create(
+            wa_id, lambda: client.beta.threads.create().id
+        )
 
-    # Otherwise, retrieve the existing thread
-    else:
-        logging.info(f"Retrieving existing thread for {name} with wa_id {wa_id}")
-        thread = client.beta.threads.retrieve(thread_id)
+    # Otherwise use it as is: the API only needs its id, so there is nothing
+    # to retrieve. Long threads are swapped for a summarized fresh one first.
+    elif THREAD_MAX_MESSAGES and message_count >= THREAD_MAX_MESSAGES:
+        try:
+            thread_id = rotate_thread(wa_id, thread_id, name)
+        except OpenAIError as e:
+            logging.error(f"Could not rotate thread {thread_id}, continuing on it: {e}")
 
     # Add message to thread
-    message = client.beta.threads.messages.create(
+    client.beta.threads.messages.create(
         thread_id=thread_id,
         role="user",
         content=message_body,
     )
+    store.add_messages(wa_id, thread_id)
 
     # Run the assistant and get the new message
-    new_message = run_assistant(thread, name)
+    new_message = run_assistant(thread_id, name, on_text=on_text)
+    if new_message:
+        store.add_messages(wa_id, thread_id)
+
+    # Only an opening question is answered without earlier context, so only
+    # that answer is safe to hand to other users
+    if cache is not None and new_thread and new_message:
+        cache.set(message_body, new_message)
 
     return new_message
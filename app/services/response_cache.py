@@ -0,0 +1,265 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from app.utils.intents import STOPWORDS, content_words
+
+# "When is the pickup?" and "Where is the pickup?" need different answers,
+# so question words stay in the key
+KEY_STOPWORDS = STOPWORDS - {"how", "what", "when", "where", "which", "who", "why"}
+
+
+def normalize_question(text):
+    """Cache key for a question: case-folded words without punctuation or stopwords."""
+    return " ".join(content_words(text, KEY_STOPWORDS))
+
+
+class CachedAnswer:
+    __slots__ = ("answer", "created_at", "hits", "size")
+
+    def __init__(self, answer, created_at, hits=0, size=0):
+        self.answer = answer
+        self.created_at = created_at
+        self.hits = hits
+        self.size = size
+
+
+class ResponseCache:
+    """
+    Assistant answers keyed by normalized question, so "What is the price?"
+    and "what is your price" share one run.
+
+    The in-process front is an LRU bounded by `max_entries` whose entries
+    expire after `ttl_seconds`. With `sqlite_path` set, answers (and their
+    hit counts) are also kept in SQLite, shared by every worker and kept
+    across restarts.
+
+    Entries belong to a namespace, normally a fingerprint of the Assistant
+    and its files, so changing either starts a fresh cache. `invalidate()`
+    drops everything explicitly, in every worker.
+    """
+
+    def __init__(self, ttl_seconds=21600, max_entries=5000, sqlite_path=None, namespace=""):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.sqlite_path = sqlite_path
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+        self.bytes_used = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._generation = None
+        if sqlite_path:
+            self._init_db()
+
+    def get(self, question):
+        key = normalize_question(question)
+        if not key:
+            return None
+
+        now = time.time()
+        if self.sqlite_path:
+            self._check_generation()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry.created_at >= self.ttl_seconds:
+                self._remove(key)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                entry.hits += 1
+                self.hits += 1
+
+        if entry is None and self.sqlite_path:
+            entry = self._load(key, now)
+            if entry is not None:
+                entry.hits += 1
+                with self._lock:
+                    self.hits += 1
+                    self._store(key, entry)
+
+        if entry is None:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        if self.sqlite_path:
+            self._execute(
+                "UPDATE answers SET hits = hits + 1 WHERE namespace = ? AND question = ?",
+                (self.namespace, key),
+            )
+        return entry.answer
+
+    def set(self, question, answer):
+        key = normalize_question(question)
+        if not key or not answer:
+            return
+        entry = CachedAnswer(answer, time.time())
+        with self._lock:
+            self._store(key, entry)
+        if self.sqlite_path:
+            self._execute(
+                "INSERT OR REPLACE INTO answers (namespace, question, answer, created_at, hits) "
+                "VALUES (?, ?, ?, ?, 0)",
+                (self.namespace, key, answer, entry.created_at),
+            )
+
+    def invalidate(self):
+        """Forget every answer, e.g. after the Assistant's files were replaced."""
+        with self._lock:
+            self._entries.clear()
+            self.bytes_used = 0
+        if self.sqlite_path:
+            conn = self._connection()
+            try:
+                with conn:
+                    conn.execute("BEGIN IMMEDIATE")
+                    conn.execute("DELETE FROM answers")
+                    # Other workers compare this to drop their in-process copies
+                    conn.execute("UPDATE cache_meta SET generation = generation + 1")
+                self._generation = self._read_generation()
+            except sqlite3.Error as e:
+                logging.error(f"Answer cache store unavailable: {e}")
+        logging.info("Answer cache invalidated")
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self.bytes_used,
+            }
+
+    def top_questions(self, limit=10):
+        """(question, hits) pairs, most asked first."""
+        if self.sqlite_path:
+            try:
+                return self._connection().execute(
+                    "SELECT question, hits FROM answers WHERE namespace = ? "
+                    "ORDER BY hits DESC LIMIT ?",
+                    (self.namespace, limit),
+                ).fetchall()
+            except sqlite3.Error as e:
+                logging.error(f"Answer cache store unavailable: {e}")
+        with self._lock:
+            ranked = sorted(self._entries.items(), key=lambda item: -item[1].hits)
+            return [(key, entry.hits) for key, entry in ranked[:limit]]
+
+    def _store(self, key, entry):
+        # Caller holds the lock
+        self._remove(key)
+        entry.size = len(key.encode("utf-8")) + len(entry.answer.encode("utf-8"))
+        self._entries[key] = entry
+        self.bytes_used += entry.size
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes_used -= entry.size
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.sqlite_path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.data_version = None
+        return conn
+
+    def _init_db(self):
+        conn = self._connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            "namespace TEXT NOT NULL, question TEXT NOT NULL, answer TEXT NOT NULL, "
+            "created_at REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0, "
+            "PRIMARY KEY (namespace, question))"
+        )
+        conn.execute("CREATE TABLE IF NOT EXISTS cache_meta (generation INTEGER NOT NULL)")
+        conn.execute(
+            "INSERT INTO cache_meta (generation) SELECT 0 "
+            "WHERE NOT EXISTS (SELECT 1 FROM cache_meta)"
+        )
+        conn.execute("DELETE FROM answers WHERE created_at <= ?", (time.time() - self.ttl_seconds,))
+        self._generation = self._read_generation()
+
+    def _read_generation(self):
+        return self._connection().execute("SELECT generation FROM cache_meta").fetchone()[0]
+
+    def _check_generation(self):
+        """Drop the in-process entries if another worker invalidated the cache."""
+        try:
+            conn = self._connection()
+            # data_version only moves when another connection commits, so
+            # the generation is re-read just after writes elsewhere
+            data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+            if data_version == self._local.data_version:
+                return
+            self._local.data_version = data_version
+            generation = self._read_generation()
+        except sqlite3.Error as e:
+            logging.error(f"Answer cache store unavailable: {e}")
+            return
+        if generation != self._generation:
+            with self._lock:
+                self._entries.clear()
+                self.bytes_used = 0
+            self._generation = generation
+
+    def _load(self, key, now):
+        try:
+            row = self._connection().execute(
+                "SELECT answer, created_at, hits FROM answers "
+                "WHERE namespace = ? AND question = ? AND created_at > ?",
+                (self.namespace, key, now - self.ttl_seconds),
+            ).fetchone()
+        except sqlite3.Error as e:
+            logging.error(f"Answer cache store unavailable: {e}")
+            return None
+        return CachedAnswer(*row) if row else None
+
+    def _execute(self, sql, params):
+        try:
+            self._connection().execute(sql, params)
+        except sqlite3.Error as e:
+            # The in-process cache still works without the shared store
+            logging.error(f"Answer cache store unavailable: {e}")
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def answer_cache_enabled():
+    return os.getenv("ANSWER_CACHE", "on") != "off"
+
+
+def get_response_cache(namespace=""):
+    """
+    Process-wide cache configured from the environment, or None when
+    ANSWER_CACHE=off: ANSWER_CACHE_TTL_SECONDS, ANSWER_CACHE_SIZE and
+    ANSWER_CACHE_PATH (SQLite file; empty keeps answers in process only).
+    """
+    global _cache
+    if not answer_cache_enabled():
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResponseCache(
+                    ttl_seconds=int(os.getenv("ANSWER_CACHE_TTL_SECONDS", "21600")),
+                    max_entries=int(os.getenv("ANSWER_CACHE_SIZE", "5000")),
+                    sqlite_path=os.getenv("ANSWER_CACHE_PATH", "answers.db") or None,
+                    namespace=namespace,
+                )
+    return _cache
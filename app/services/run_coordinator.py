@@ -0,0 +1,78 @@
+import logging
+import threading
+
+from app.utils.debounce import KeyedDebouncer
+from app.utils.whatsapp_utils import send_ai_reply
+
+
+class RunCoordinator:
+    """
+    Makes sure a user has at most one Assistant run at a time.
+
+    Free-text messages are collected per wa_id for a short debounce window
+    and answered together by one run. Messages that arrive while that run
+    is still going are held back and answered by exactly one follow-up run
+    once it finishes, instead of each starting a run of its own on the
+    same thread.
+
+    Runs are queued on the dispatcher under their own "ai:<wa_id>" lane, so
+    a slow run doesn't hold up the user's button replies. The coordinator
+    lives in each process; it can't stop two gunicorn workers from running
+    for the same user at once.
+    """
+
+    def __init__(self, reply, window=1.0, max_wait=5.0, submit=None):
+        self.reply = reply
+        self.runs = 0
+        self.messages = 0
+        self._stats_lock = threading.Lock()
+        self.debouncer = KeyedDebouncer(
+            self._run, window=window, max_wait=max_wait, submit=submit, name="ai-debouncer"
+        )
+
+    def submit(self, wa_id, name, text, phone_number_id=None, receipt=None):
+        """
+        Queue a message for the user's next run on the number it was sent to.
+        `receipt` is released once that run has been answered.
+        """
+        self.debouncer.push((phone_number_id, wa_id), (name, text, receipt))
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "runs": self.runs,
+                "messages": self.messages,
+                "coalesced": self.messages - self.runs,
+            }
+
+    def _run(self, key, messages):
+        phone_number_id, wa_id = key
+        name = messages[-1][0]
+        text = "\n".join(text for _, text, _ in messages)
+        receipts = [receipt for _, _, receipt in messages if receipt is not None]
+        with self._stats_lock:
+            self.runs += 1
+            self.messages += len(messages)
+        if len(messages) > 1:
+            logging.info(f"Answering {len(messages)} messages from {wa_id} with one run")
+        try:
+            self.reply(wa_id, name, text, phone_number_id)
+        except Exception:
+            for receipt in receipts:
+                receipt.release(ok=False)
+            raise
+        for receipt in receipts:
+            receipt.release()
+
+
+def init_run_coordinator(app):
+    dispatcher = app.extensions["webhook_dispatcher"]
+    coordinator = RunCoordinator(
+        send_ai_reply,
+        window=app.config["AI_DEBOUNCE_SECONDS"],
+        max_wait=app.config["AI_DEBOUNCE_MAX_SECONDS"],
+        # One lane per user, whichever number they wrote to
+        submit=lambda key, fn, *args: dispatcher.enqueue(f"ai:{key[1]}", fn, *args),
+    )
+    app.extensions["run_coordinator"] = coordinator
+    return coordinator
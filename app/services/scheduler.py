@@ -0,0 +1,94 @@
+import logging
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+
+class QueueFullError(Exception):
+    """Raised when the scheduler has no room for another job."""
+
+
+class KeyedScheduler:
+    """
+    Runs jobs in parallel across keys but strictly one at a time, in FIFO
+    order, within a key.
+
+    Each key (a wa_id) gets a lane of pending jobs. A lane is handed to at
+    most one worker at a time, and goes to the back of the ready queue after
+    each job so one busy conversation cannot starve the others. At most
+    `max_concurrency` jobs run at once and at most `capacity` wait.
+    """
+
+    def __init__(self, max_concurrency=4, capacity=1000, name="scheduler"):
+        self.max_concurrency = max_concurrency
+        self.capacity = capacity
+        self.name = name
+        self._lanes = {}
+        self._ready = queue.SimpleQueue()
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def pending(self):
+        return self._pending
+
+    def active_keys(self):
+        return len(self._lanes)
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.max_concurrency):
+                thread = threading.Thread(
+                    target=self._worker, name=f"{self.name}-{i}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+        logging.info(f"Started {self.max_concurrency} {self.name} workers")
+
+    def submit(self, key, fn, *args):
+        """Queue `fn(*args)` behind earlier jobs for `key`; returns a Future."""
+        return self.submit_many([(key, fn, args)])[0]
+
+    def submit_many(self, jobs):
+        """
+        Queue several `(key, fn, args)` jobs atomically: either all of them
+        fit within capacity or none is queued. Returns their Futures.
+        """
+        if not self._threads:
+            self.start()
+        futures = [Future() for _ in jobs]
+        with self._lock:
+            if self._pending + len(jobs) > self.capacity:
+                raise QueueFullError(f"{self.name} queue is full")
+            self._pending += len(jobs)
+            for (key, fn, args), future in zip(jobs, futures):
+                lane = self._lanes.get(key)
+                if lane is None:
+                    self._lanes[key] = deque([(fn, args, future)])
+                    self._ready.put(key)
+                else:
+                    lane.append((fn, args, future))
+        return futures
+
+    def _worker(self):
+        while True:
+            key = self._ready.get()
+            with self._lock:
+                fn, args, future = self._lanes[key].popleft()
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args))
+                except Exception as e:
+                    logging.exception(f"Job for {key} failed")
+                    future.set_exception(e)
+            with self._lock:
+                self._pending -= 1
+                # The lane stays registered while its job runs, so new jobs
+                # for this key queue behind it instead of running alongside
+                if self._lanes[key]:
+                    self._ready.put(key)
+                else:
+                    del self._lanes[key]
@@ -0,0 +1,335 @@
+"""
+Delivery analytics from sent/delivered/read/failed status webhooks.
+
+The webhook only appends each status to an in-memory ring buffer and
+answers. A background flusher drains the buffer in batches into SQLite:
+
+    statuses        raw rows, kept for STATUS_RETENTION_DAYS
+    message_times   when each message was sent/delivered/read/failed, to
+                    pair up events that arrive in separate webhooks
+    status_hourly   per hour and phone number: counts and latency sums
+    status_errors   per hour and phone number: failures by error code
+
+The rollup tables are updated in the same transaction as the raw rows, so
+`aggregates()` answers from a few dozen rows per day instead of scanning
+raw data. Meta redelivers statuses; each state counts once per message.
+"""
+import atexit
+import logging
+import sqlite3
+import threading
+import time
+from collections import deque
+
+HOUR = 3600
+
+# Column in message_times for each status that is counted
+STATUS_COLUMNS = {
+    "sent": "sent_at",
+    "delivered": "delivered_at",
+    "read": "read_at",
+    "failed": "failed_at",
+}
+
+
+class StatusPipeline:
+    """
+    Ring buffer of status updates plus the thread that flushes it.
+
+    `record` never blocks on I/O: when the flusher falls behind and the
+    buffer holds `buffer_size` statuses, the oldest are dropped and counted.
+    """
+
+    def __init__(
+        self,
+        sqlite_path,
+        buffer_size=100000,
+        flush_interval=2.0,
+        batch_size=5000,
+        retention_days=30,
+    ):
+        self.sqlite_path = sqlite_path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.retention_seconds = retention_days * 86400
+        self.dropped = 0
+        self.flushed = 0
+        self._buffer = deque(maxlen=buffer_size)
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._local = threading.local()
+        self._thread = None
+        self._pruned_at = 0.0
+        self._init_db()
+
+    def record(self, statuses):
+        """Queue StatusUpdate events for the next flush."""
+        rows = []
+        for status in statuses:
+            errors = status.errors or []
+            error_code = errors[0].get("code") if errors and isinstance(errors[0], dict) else None
+            rows.append((
+                status.message_id,
+                status.status,
+                _timestamp(status.timestamp),
+                status.wa_id,
+                status.phone_number_id,
+                error_code,
+            ))
+        with self._condition:
+            overflow = len(self._buffer) + len(rows) - self._buffer.maxlen
+            if overflow > 0:
+                self.dropped += overflow
+            self._buffer.extend(rows)
+            if len(self._buffer) >= self.batch_size:
+                self._condition.notify()
+        self._ensure_thread()
+
+    def pending(self):
+        return len(self._buffer)
+
+    def flush(self):
+        """Write everything buffered so far; returns the number of statuses written."""
+        written = 0
+        with self._flush_lock:
+            while True:
+                with self._condition:
+                    batch = [
+                        self._buffer.popleft()
+                        for _ in range(min(self.batch_size, len(self._buffer)))
+                    ]
+                if not batch:
+                    break
+                try:
+                    self._write(batch)
+                except sqlite3.Error as e:
+                    # The buffer keeps filling meanwhile; this batch is lost
+                    logging.error(f"Could not store {len(batch)} status updates: {e}")
+                    break
+                written += len(batch)
+            self.flushed += written
+            if time.time() - self._pruned_at > HOUR:
+                self._prune()
+        return written
+
+    def aggregates(self, hours=24, phone_number_id=None):
+        """Rolling delivery metrics over the last `hours`, from the hourly rollups."""
+        since = int(time.time()) // HOUR * HOUR - (hours - 1) * HOUR
+        where = "hour >= ?"
+        params = [since]
+        if phone_number_id:
+            where += " AND phone_number_id = ?"
+            params.append(phone_number_id)
+        conn = self._connection()
+        row = conn.execute(
+            "SELECT COALESCE(SUM(sent), 0), COALESCE(SUM(delivered), 0), "
+            "COALESCE(SUM(read), 0), COALESCE(SUM(failed), 0), "
+            "COALESCE(SUM(delivery_latency_sum), 0), COALESCE(SUM(delivery_latency_count), 0), "
+            "COALESCE(SUM(read_latency_sum), 0), COALESCE(SUM(read_latency_count), 0) "
+            f"FROM status_hourly WHERE {where}",
+            params,
+        ).fetchone()
+        sent, delivered, read, failed, delivery_sum, delivery_count, read_sum, read_count = row
+        errors = conn.execute(
+            f"SELECT error_code, SUM(count) FROM status_errors WHERE {where} "
+            "GROUP BY error_code ORDER BY SUM(count) DESC",
+            params,
+        ).fetchall()
+        return {
+            "hours": hours,
+            "sent": sent,
+            "delivered": delivered,
+            "read": read,
+            "failed": failed,
+            "delivery_rate": delivered / sent if sent else None,
+            "read_rate": read / delivered if delivered else None,
+            "avg_delivery_seconds": delivery_sum / delivery_count if delivery_count else None,
+            "avg_read_seconds": read_sum / read_count if read_count else None,
+            "failures_by_error_code": {str(code): count for code, count in errors},
+            "buffer": {"pending": self.pending(), "dropped": self.dropped},
+        }
+
+    def _ensure_thread(self):
+        if self._thread is not None:
+            return
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._loop, name="status-flusher", daemon=True
+                )
+                self._thread.start()
+                # Don't lose the last interval's statuses on a clean shutdown
+                atexit.register(self.flush)
+
+    def _loop(self):
+        while True:
+            with self._condition:
+                if len(self._buffer) < self.batch_size:
+                    self._condition.wait(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("Status flush failed")
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.sqlite_path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _init_db(self):
+        conn = self._connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS statuses ("
+            "message_id TEXT, status TEXT, timestamp INTEGER, recipient_id TEXT, "
+            "phone_number_id TEXT, error_code INTEGER)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS statuses_timestamp ON statuses (timestamp)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS message_times ("
+            "message_id TEXT PRIMARY KEY, sent_at INTEGER, delivered_at INTEGER, "
+            "read_at INTEGER, failed_at INTEGER, updated_at INTEGER NOT NULL)"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS message_times_updated ON message_times (updated_at)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS status_hourly ("
+            "hour INTEGER NOT NULL, phone_number_id TEXT NOT NULL, "
+            "sent INTEGER NOT NULL DEFAULT 0, delivered INTEGER NOT NULL DEFAULT 0, "
+            "read INTEGER NOT NULL DEFAULT 0, failed INTEGER NOT NULL DEFAULT 0, "
+            "delivery_latency_sum REAL NOT NULL DEFAULT 0, "
+            "delivery_latency_count INTEGER NOT NULL DEFAULT 0, "
+            "read_latency_sum REAL NOT NULL DEFAULT 0, "
+            "read_latency_count INTEGER NOT NULL DEFAULT 0, "
+            "PRIMARY KEY (hour, phone_number_id))"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS status_errors ("
+            "hour INTEGER NOT NULL, phone_number_id TEXT NOT NULL, "
+            "error_code INTEGER NOT NULL, count INTEGER NOT NULL DEFAULT 0, "
+            "PRIMARY KEY (hour, phone_number_id, error_code))"
+        )
+
+    def _write(self, batch):
+        conn = self._connection()
+        hourly = {}
+        errors = {}
+        now = int(time.time())
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany("INSERT INTO statuses VALUES (?, ?, ?, ?, ?, ?)", batch)
+            known = self._message_times(
+                conn, {row[0] for row in batch if row[0] and row[1] in STATUS_COLUMNS}
+            )
+            changed = set()
+            for message_id, status, timestamp, _, phone_number_id, error_code in batch:
+                column = STATUS_COLUMNS.get(status)
+                if column is None or not message_id:
+                    continue
+                times = known.setdefault(message_id, dict.fromkeys(STATUS_COLUMNS.values()))
+                if times[column] is not None:
+                    # Redelivered status, already counted
+                    continue
+                times[column] = timestamp
+                changed.add(message_id)
+
+                key = (timestamp // HOUR * HOUR, phone_number_id or "")
+                counts = hourly.setdefault(key, [0] * 8)
+                counts[list(STATUS_COLUMNS).index(status)] += 1
+                # Latencies are complete once both ends are known, in whichever
+                # order their webhooks arrived
+                if column in ("sent_at", "delivered_at") and None not in (
+                    times["sent_at"], times["delivered_at"]
+                ):
+                    counts[4] += max(times["delivered_at"] - times["sent_at"], 0)
+                    counts[5] += 1
+                if column in ("delivered_at", "read_at") and None not in (
+                    times["delivered_at"], times["read_at"]
+                ):
+                    counts[6] += max(times["read_at"] - times["delivered_at"], 0)
+                    counts[7] += 1
+                if status == "failed" and error_code is not None:
+                    error_key = key + (error_code,)
+                    errors[error_key] = errors.get(error_key, 0) + 1
+
+            conn.executemany(
+                "INSERT INTO message_times (message_id, sent_at, delivered_at, read_at, "
+                "failed_at, updated_at) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(message_id) DO UPDATE SET sent_at = excluded.sent_at, "
+                "delivered_at = excluded.delivered_at, read_at = excluded.read_at, "
+                "failed_at = excluded.failed_at, updated_at = excluded.updated_at",
+                [
+                    (message_id, *known[message_id].values(), now)
+                    for message_id in changed
+                ],
+            )
+            conn.executemany(
+                "INSERT INTO status_hourly VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(hour, phone_number_id) DO UPDATE SET "
+                "sent = sent + excluded.sent, delivered = delivered + excluded.delivered, "
+                "read = read + excluded.read, failed = failed + excluded.failed, "
+                "delivery_latency_sum = delivery_latency_sum + excluded.delivery_latency_sum, "
+                "delivery_latency_count = delivery_latency_count + excluded.delivery_latency_count, "
+                "read_latency_sum = read_latency_sum + excluded.read_latency_sum, "
+                "read_latency_count = read_latency_count + excluded.read_latency_count",
+                [key + tuple(counts) for key, counts in hourly.items()],
+            )
+            conn.executemany(
+                "INSERT INTO status_errors VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(hour, phone_number_id, error_code) DO UPDATE SET "
+                "count = count + excluded.count",
+                [key + (count,) for key, count in errors.items()],
+            )
+
+    @staticmethod
+    def _message_times(conn, message_ids):
+        """message_id -> {column: timestamp} for the ids already in message_times."""
+        message_ids = list(message_ids)
+        known = {}
+        # Chunked to stay under SQLite's limit on bound parameters
+        for start in range(0, len(message_ids), 500):
+            chunk = message_ids[start:start + 500]
+            rows = conn.execute(
+                "SELECT message_id, sent_at, delivered_at, read_at, failed_at FROM message_times "
+                f"WHERE message_id IN ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+            for message_id, *times in rows:
+                known[message_id] = dict(zip(STATUS_COLUMNS.values(), times))
+        return known
+
+    def _prune(self):
+        cutoff = int(time.time()) - self.retention_seconds
+        try:
+            conn = self._connection()
+            conn.execute("DELETE FROM statuses WHERE timestamp < ?", (cutoff,))
+            conn.execute("DELETE FROM message_times WHERE updated_at < ?", (cutoff,))
+        except sqlite3.Error as e:
+            logging.error(f"Could not prune status updates: {e}")
+            return
+        self._pruned_at = time.time()
+
+
+def _timestamp(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return int(time.time())
+
+
+def init_status_pipeline(app):
+    path = app.config["STATUS_DB_PATH"]
+    pipeline = None
+    if path:
+        pipeline = StatusPipeline(
+            path,
+            buffer_size=app.config["STATUS_BUFFER_SIZE"],
+            flush_interval=app.config["STATUS_FLUSH_SECONDS"],
+            retention_days=app.config["STATUS_RETENTION_DAYS"],
+        )
+    app.extensions["status_pipeline"] = pipeline
+    return pipeline
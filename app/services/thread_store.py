@@ -0,0 +1,385 @@
+import logging
+import os
+import shelve
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from .metrics import THREAD_LOOKUP_SECONDS
+
+
+class LRUCache:
+    """Small thread-safe LRU map used as the in-process front of a store."""
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class ThreadStore:
+    """
+    Maps a WhatsApp id to its OpenAI thread id.
+
+    Subclasses implement `_load`, `_load_current`, `_insert_if_absent`,
+    `_save`, the message counting of `message_count`/`_add_messages`/
+    `_replace`, plus bulk `export_threads`/`import_threads`; the LRU front
+    and the get-or-create logic live here.
+    """
+
+    def __init__(self, cache_size=10000):
+        self.cache = LRUCache(cache_size)
+        self._key_locks = {}
+        self._key_locks_guard = threading.Lock()
+
+    def get(self, wa_id):
+        started = time.perf_counter()
+        source = "cache"
+        thread_id = self.cache.get(wa_id)
+        if thread_id is None:
+            thread_id = self._load(wa_id)
+            if thread_id is not None:
+                source = "store"
+                self.cache.set(wa_id, thread_id)
+            else:
+                source = "missing"
+        THREAD_LOOKUP_SECONDS.labels(source).observe(time.perf_counter() - started)
+        return thread_id
+
+    def current(self, wa_id):
+        """
+        (thread_id, message_count) as the shared store has them now, or
+        (None, 0). Skips the cache, which is stale once another worker has
+        rotated the thread, and refreshes it.
+        """
+        started = time.perf_counter()
+        thread_id, message_count = self._load_current(wa_id)
+        if thread_id is not None:
+            self.cache.set(wa_id, thread_id)
+        else:
+            self.cache.pop(wa_id)
+        THREAD_LOOKUP_SECONDS.labels("store" if thread_id is not None else "missing").observe(
+            time.perf_counter() - started
+        )
+        return thread_id, message_count
+
+    def set(self, wa_id, thread_id):
+        self._save(wa_id, thread_id)
+        self.cache.set(wa_id, thread_id)
+
+    def get_or_create(self, wa_id, create_thread):
+        """
+        Return the thread id for `wa_id`, calling `create_thread()` only if
+        there is none yet.
+
+        Concurrent callers in this process wait on a per-wa_id lock, and the
+        insert is conditional, so across processes the first stored thread
+        wins and every caller gets the same id back.
+        """
+        thread_id = self.get(wa_id)
+        if thread_id is not None:
+            return thread_id
+
+        lock = self._key_lock(wa_id)
+        try:
+            with lock:
+                thread_id = self.get(wa_id)
+                if thread_id is None:
+                    thread_id = self._insert_if_absent(wa_id, create_thread())
+                    self.cache.set(wa_id, thread_id)
+        finally:
+            self._release_key_lock(wa_id)
+        return thread_id
+
+    def replace_thread(self, wa_id, old_thread_id, new_thread_id, message_count=0):
+        """
+        Point `wa_id` at a new thread, but only if it is still on
+        `old_thread_id`, so two workers rotating the same conversation
+        don't both win. Returns whether the swap happened.
+        """
+        replaced = self._replace(wa_id, old_thread_id, new_thread_id, message_count)
+        if replaced:
+            self.cache.set(wa_id, new_thread_id)
+        else:
+            self.cache.pop(wa_id)
+        return replaced
+
+    def message_count(self, wa_id):
+        """Messages added to the user's current thread (0 if unknown)."""
+        raise NotImplementedError
+
+    def add_messages(self, wa_id, thread_id, count=1):
+        """
+        Count messages added to `thread_id`; returns the new total. If the
+        user has moved on to another thread meanwhile, nothing is counted
+        and the cached thread id is dropped so the next `get` reloads it.
+        """
+        total = self._add_messages(wa_id, thread_id, count)
+        if total is None:
+            self.cache.pop(wa_id)
+            return self.message_count(wa_id)
+        return total
+
+    def _key_lock(self, wa_id):
+        with self._key_locks_guard:
+            lock, users = self._key_locks.get(wa_id, (None, 0))
+            if lock is None:
+                lock = threading.Lock()
+            self._key_locks[wa_id] = (lock, users + 1)
+            return lock
+
+    def _release_key_lock(self, wa_id):
+        with self._key_locks_guard:
+            lock, users = self._key_locks[wa_id]
+            if users <= 1:
+                del self._key_locks[wa_id]
+            else:
+                self._key_locks[wa_id] = (lock, users - 1)
+
+    def _load(self, wa_id):
+        raise NotImplementedError
+
+    def _load_current(self, wa_id):
+        raise NotImplementedError
+
+    def _save(self, wa_id, thread_id):
+        raise NotImplementedError
+
+    def _add_messages(self, wa_id, thread_id, count):
+        """The new total, or None if `wa_id` is no longer on `thread_id`."""
+        raise NotImplementedError
+
+    def _insert_if_absent(self, wa_id, thread_id):
+        """Store `thread_id` unless one exists; return whichever is stored."""
+        raise NotImplementedError
+
+    def _replace(self, wa_id, old_thread_id, new_thread_id, message_count):
+        raise NotImplementedError
+
+    def export_threads(self):
+        raise NotImplementedError
+
+    def import_threads(self, mapping):
+        raise NotImplementedError
+
+
+class MemoryThreadStore(ThreadStore):
+    """Process-local store, handy for development and single-worker runs."""
+
+    def __init__(self, cache_size=10000):
+        super().__init__(cache_size)
+        self._threads = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def _load(self, wa_id):
+        with self._lock:
+            return self._threads.get(wa_id)
+
+    def _load_current(self, wa_id):
+        with self._lock:
+            return self._threads.get(wa_id), self._counts.get(wa_id, 0)
+
+    def _save(self, wa_id, thread_id):
+        with self._lock:
+            if self._threads.get(wa_id) != thread_id:
+                self._counts.pop(wa_id, None)
+            self._threads[wa_id] = thread_id
+
+    def _insert_if_absent(self, wa_id, thread_id):
+        with self._lock:
+            return self._threads.setdefault(wa_id, thread_id)
+
+    def _replace(self, wa_id, old_thread_id, new_thread_id, message_count):
+        with self._lock:
+            if self._threads.get(wa_id) != old_thread_id:
+                return False
+            self._threads[wa_id] = new_thread_id
+            self._counts[wa_id] = message_count
+            return True
+
+    def message_count(self, wa_id):
+        with self._lock:
+            return self._counts.get(wa_id, 0)
+
+    def _add_messages(self, wa_id, thread_id, count):
+        with self._lock:
+            if self._threads.get(wa_id) != thread_id:
+                return None
+            self._counts[wa_id] = self._counts.get(wa_id, 0) + count
+            return self._counts[wa_id]
+
+    def export_threads(self):
+        with self._lock:
+            return dict(self._threads)
+
+    def import_threads(self, mapping):
+        with self._lock:
+            for wa_id, thread_id in mapping.items():
+                if self._threads.get(wa_id) != thread_id:
+                    self._counts.pop(wa_id, None)
+            self._threads.update(mapping)
+        self.cache.clear()
+        return len(mapping)
+
+
+class SQLiteThreadStore(ThreadStore):
+    """
+    SQLite-backed store in WAL mode, safe for several gunicorn workers
+    reading and writing the same file.
+    """
+
+    def __init__(self, path="threads.db", cache_size=10000):
+        super().__init__(cache_size)
+        self.path = path
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS threads ("
+            "wa_id TEXT PRIMARY KEY, thread_id TEXT NOT NULL, created_at REAL NOT NULL, "
+            "message_count INTEGER NOT NULL DEFAULT 0)"
+        )
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(threads)")]
+        if "message_count" not in columns:
+            # Stores created before messages were counted
+            try:
+                conn.execute(
+                    "ALTER TABLE threads ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0"
+                )
+            except sqlite3.OperationalError:
+                # Another worker added it first
+                pass
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _load(self, wa_id):
+        row = self._connection().execute(
+            "SELECT thread_id FROM threads WHERE wa_id = ?", (wa_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def _load_current(self, wa_id):
+        row = self._connection().execute(
+            "SELECT thread_id, message_count FROM threads WHERE wa_id = ?", (wa_id,)
+        ).fetchone()
+        return (row[0], row[1]) if row else (None, 0)
+
+    def _save(self, wa_id, thread_id):
+        self._connection().execute(
+            "INSERT INTO threads (wa_id, thread_id, created_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(wa_id) DO UPDATE SET thread_id = excluded.thread_id, "
+            "created_at = excluded.created_at, message_count = 0 "
+            "WHERE threads.thread_id != excluded.thread_id",
+            (wa_id, thread_id, time.time()),
+        )
+
+    def _insert_if_absent(self, wa_id, thread_id):
+        conn = self._connection()
+        conn.execute(
+            "INSERT OR IGNORE INTO threads (wa_id, thread_id, created_at) VALUES (?, ?, ?)",
+            (wa_id, thread_id, time.time()),
+        )
+        return self._load(wa_id)
+
+    def _replace(self, wa_id, old_thread_id, new_thread_id, message_count):
+        cursor = self._connection().execute(
+            "UPDATE threads SET thread_id = ?, created_at = ?, message_count = ? "
+            "WHERE wa_id = ? AND thread_id = ?",
+            (new_thread_id, time.time(), message_count, wa_id, old_thread_id),
+        )
+        return cursor.rowcount == 1
+
+    def message_count(self, wa_id):
+        row = self._connection().execute(
+            "SELECT message_count FROM threads WHERE wa_id = ?", (wa_id,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def _add_messages(self, wa_id, thread_id, count):
+        # fetchall steps the statement to completion, which ends the implicit transaction
+        rows = self._connection().execute(
+            "UPDATE threads SET message_count = message_count + ? "
+            "WHERE wa_id = ? AND thread_id = ? RETURNING message_count",
+            (count, wa_id, thread_id),
+        ).fetchall()
+        return rows[0][0] if rows else None
+
+    def export_threads(self):
+        rows = self._connection().execute("SELECT wa_id, thread_id FROM threads")
+        return dict(rows)
+
+    def import_threads(self, mapping):
+        conn = self._connection()
+        now = time.time()
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany(
+                "INSERT INTO threads (wa_id, thread_id, created_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(wa_id) DO UPDATE SET thread_id = excluded.thread_id, "
+                "message_count = 0 WHERE threads.thread_id != excluded.thread_id",
+                [(wa_id, thread_id, now) for wa_id, thread_id in mapping.items()],
+            )
+        self.cache.clear()
+        return len(mapping)
+
+
+def migrate_shelve(shelve_path, store):
+    """Copy every wa_id -> thread_id pair from the old `threads_db` shelve file."""
+    with shelve.open(shelve_path, flag="r") as threads_shelf:
+        mapping = dict(threads_shelf.items())
+    count = store.import_threads(mapping)
+    logging.info(f"Migrated {count} threads from {shelve_path}")
+    return count
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_thread_store():
+    """
+    Process-wide store configured from the environment: THREAD_STORE=sqlite
+    (default) or memory, THREAD_STORE_PATH and THREAD_CACHE_SIZE.
+    """
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                cache_size = int(os.getenv("THREAD_CACHE_SIZE", "10000"))
+                if os.getenv("THREAD_STORE", "sqlite") == "memory":
+                    _store = MemoryThreadStore(cache_size)
+                else:
+                    _store = SQLiteThreadStore(
+                        os.getenv("THREAD_STORE_PATH", "threads.db"), cache_size
+                    )
+    return _store
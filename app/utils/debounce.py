@@ -0,0 +1,207 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+
+class KeyedDebouncer:
+    """
+    Collects items per key and hands each key's batch to `flush(key, items)`
+    once no new item has arrived for `window` seconds (or `max_wait` after
+    the first one, so a chatty sender is still answered).
+
+    At most one flush per key is in flight. Items that arrive meanwhile are
+    held back and delivered together in a single follow-up flush as soon as
+    the current one returns.
+
+    `submit(key, fn, *args)` decides where flushes run, e.g. on the webhook
+    dispatcher's pool; by default they run on the debouncer's own thread.
+    """
+
+    def __init__(self, flush, window=1.0, max_wait=5.0, submit=None, name="debouncer"):
+        self.flush = flush
+        self.window = window
+        self.max_wait = max_wait
+        self.submit = submit
+        self.name = name
+        self._states = {}
+        self._timers = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def push(self, key, item):
+        now = time.monotonic()
+        with self._condition:
+            state = self._states.get(key)
+            if state is None:
+                state = self._states[key] = _KeyState(now)
+            state.items.append(item)
+            if state.flushing:
+                # Picked up by the follow-up flush
+                return
+            if len(state.items) == 1:
+                state.first_at = now
+            state.due_at = min(now + self.window, state.first_at + self.max_wait)
+            heapq.heappush(self._timers, (state.due_at, next(self._sequence), key))
+            self._condition.notify()
+        self._ensure_thread()
+
+    def pending(self, key):
+        """Items waiting for `key`, not counting a flush in progress."""
+        with self._condition:
+            state = self._states.get(key)
+            return len(state.items) if state else 0
+
+    def backlog(self):
+        """Items waiting across all keys, not counting flushes in progress."""
+        with self._condition:
+            return sum(len(state.items) for state in self._states.values())
+
+    def _ensure_thread(self):
+        if self._thread is not None:
+            return
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+                self._thread.start()
+
+    def _loop(self):
+        while True:
+            with self._condition:
+                while True:
+                    now = time.monotonic()
+                    if self._timers and self._timers[0][0] <= now:
+                        _, _, key = heapq.heappop(self._timers)
+                        state = self._states.get(key)
+                        # Stale timers of keys that were pushed again are skipped
+                        if state and not state.flushing and state.items and state.due_at <= now:
+                            break
+                        continue
+                    timeout = self._timers[0][0] - now if self._timers else None
+                    self._condition.wait(timeout)
+                items, state.items = state.items, []
+                state.flushing = True
+            self._dispatch(key, items)
+
+    def _dispatch(self, key, items):
+        if self.submit is None:
+            self._run(key, items)
+            return
+        try:
+            self.submit(key, self._run, key, items)
+        except Exception:
+            logging.exception(f"Could not queue {self.name} flush for {key}, retrying")
+            with self._condition:
+                state = self._states[key]
+                state.items[:0] = items
+                state.flushing = False
+                state.due_at = time.monotonic() + max(self.window, 1.0)
+                heapq.heappush(self._timers, (state.due_at, next(self._sequence), key))
+                self._condition.notify()
+
+    def _run(self, key, items):
+        try:
+            self.flush(key, items)
+        finally:
+            with self._condition:
+                state = self._states[key]
+                state.flushing = False
+                if state.items:
+                    # Everything that came in meanwhile, in one follow-up flush
+                    state.due_at = time.monotonic()
+                    heapq.heappush(self._timers, (state.due_at, next(self._sequence), key))
+                    self._condition.notify()
+                else:
+                    del self._states[key]
+
+
+class AsyncKeyedDebouncer:
+    """
+    KeyedDebouncer for an asyncio event loop: `flush(key, items)` is a
+    coroutine and timers are loop callbacks instead of a thread. Same
+    window, max_wait and one-flush-per-key rules.
+
+    Create and use it from the loop's thread only.
+    """
+
+    def __init__(self, flush, window=1.0, max_wait=5.0, name="debouncer"):
+        self.flush = flush
+        self.window = window
+        self.max_wait = max_wait
+        self.name = name
+        self._states = {}
+        self._tasks = set()
+        self._backlog = 0
+
+    def push(self, key, item):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = _KeyState(now)
+        state.items.append(item)
+        self._backlog += 1
+        if state.flushing:
+            # Picked up by the follow-up flush
+            return
+        if len(state.items) == 1:
+            state.first_at = now
+        state.due_at = min(now + self.window, state.first_at + self.max_wait)
+        if state.timer is not None:
+            state.timer.cancel()
+        state.timer = loop.call_at(state.due_at, self._start, key)
+
+    def pending(self, key):
+        """Items waiting for `key`, not counting a flush in progress."""
+        state = self._states.get(key)
+        return len(state.items) if state else 0
+
+    def backlog(self):
+        """Items pushed but not flushed yet, including flushes in progress."""
+        return self._backlog
+
+    async def close(self):
+        """Drop pending timers and wait for flushes in progress."""
+        for state in self._states.values():
+            if state.timer is not None:
+                state.timer.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _start(self, key):
+        state = self._states[key]
+        state.timer = None
+        items, state.items = state.items, []
+        state.flushing = True
+        task = asyncio.get_running_loop().create_task(self._run(key, items))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, key, items):
+        try:
+            await self.flush(key, items)
+        except Exception:
+            logging.exception(f"{self.name} flush for {key} failed")
+        finally:
+            self._backlog -= len(items)
+            state = self._states[key]
+            state.flushing = False
+            if state.items:
+                # Everything that came in meanwhile, in one follow-up flush
+                state.timer = asyncio.get_running_loop().call_soon(self._start, key)
+            else:
+                del self._states[key]
+
+
+class _KeyState:
+    __slots__ = ("items", "first_at", "due_at", "flushing", "timer")
+
+    def __init__(self, now):
+        self.items = []
+        self.first_at = now
+        self.due_at = now
+        self.flushing = False
+        self.timer = None
@@ -0,0 +1,99 @@
+"""
+Keyword intent matching for incoming text.
+
+Keywords are matched on whole words only, so "hi" no longer fires on
+"this", "ship" or "which". The keywords of all intents are compiled once
+into a single trie of words; matching walks it from each word of the
+message, so a message costs the same however many keywords there are.
+"""
+import re
+import unicodedata
+from itertools import islice
+
+# \w alone splits Devanagari words at their vowel signs (e.g. "नमस्ते"),
+# so the whole Devanagari block counts as word characters too
+WORD = re.compile(r"[\w\u0900-\u097F]+")
+
+
+# Words too common in questions to say anything about the topic
+STOPWORDS = frozenset(
+    "a an and are as at be can do does for from how i in is it its me my "
+    "of on or the there this to we what when where which who why will with "
+    "you your".split()
+)
+
+
+def tokenize(text):
+    """Case-fold, normalize and split text into words."""
+    return WORD.findall(unicodedata.normalize("NFC", text).casefold())
+
+
+def content_words(text, stopwords=STOPWORDS):
+    """The words of `text` minus `stopwords`, in order."""
+    return [word for word in tokenize(text) if word not in stopwords]
+
+
+class IntentMatcher:
+    """
+    Resolves text to intents defined as
+
+        {"greeting": {"keywords": ["hi", "good morning", ...],
+                      "exact": ["1"],
+                      "flow": "greeting"}, ...}
+
+    `keywords` match anywhere in the message on word boundaries, `exact`
+    only when they are the whole message. Intents are ranked in the order
+    they are defined.
+    """
+
+    def __init__(self, definitions):
+        self.flows = {}
+        self._trie = {}
+        self._exact = {}
+        self._priority = {}
+        for rank, (intent, definition) in enumerate(definitions.items()):
+            self._priority[intent] = rank
+            self.flows[intent] = definition.get("flow")
+            for keyword in definition.get("keywords", []):
+                words = tokenize(keyword)
+                if words:
+                    node = self._trie
+                    for word in words:
+                        node = node.setdefault(word, {})
+                    # The None key marks the end of a keyword
+                    node.setdefault(None, intent)
+            for keyword in definition.get("exact", []):
+                words = tuple(tokenize(keyword))
+                if words:
+                    self._exact.setdefault(words, intent)
+
+    def match(self, text):
+        """Return every intent found in `text`, highest priority first."""
+        words = tokenize(text)
+        found = set()
+        exact = self._exact.get(tuple(words))
+        if exact:
+            found.add(exact)
+
+        trie = self._trie
+        for start in range(len(words)):
+            node = trie
+            for word in islice(words, start, None):
+                node = node.get(word)
+                if node is None:
+                    break
+                if None in node:
+                    found.add(node[None])
+        return sorted(found, key=self._priority.__getitem__)
+
+    def best(self, text):
+        """The highest-priority intent in `text`, or None."""
+        intents = self.match(text)
+        return intents[0] if intents else None
+
+    def flow_for(self, text):
+        """The flow of the highest-priority intent that has one, or None."""
+        for intent in self.match(text):
+            if self.flows.get(intent):
+                return self.flows[intent]
+        return None
@@ -1,3 +1,33 @@
+import logging
+from flask import current_app, jsonify
+import json
+import re
+import time
+
+from app.services.delivery import DeliveryFailure
+from app.services.metrics import SEND_SECONDS
+from app.services.number_registry import current_number, sending_from
+from .webhook_parser import ButtonReply, TextMessage, UnknownMessage, parse_webhook
+
+
+def log_http_response(response):
+    logging.info(f"Status: {response.status_code}")
+    logging.info(f"Content-type: {response.headers.get('content-type')}")
+    logging.info(f"Body: {response.text}")
+
+
+def get_text_message_input(recipient, text):
+    return json.dumps(
+        {
+            "messaging_product": "whatsapp",
+            "recipient_type": "individual",
+            "to": recipient,
+            "type": "text",
+            "text": {"preview_url": False, "body": text},
+        }
+    )
+
+
 def get_interactive_reply_button_input(recipient, body_text, button1_id, button1_title, button2_id, button2_title):
     return json.dumps({
         "messaging_product": "whatsapp",
@@ -15,27 +45,23 @@ def get_interactive_reply_button_input(recipient, body_text, button1_id, button1
         }
     })
 
-import logging
-from flask import current_app, jsonify
-import json
-import requests
-import re
-
-
-def log_http_response(response):
-    logging.info(f"Status: {response.status_code}")
-    logging.info(f"Content-type: {response.headers.get('content-type')}")
-    logging.info(f"Body: {response.text}")
-
 
-def get_text_message_input(recipient, text):
+def get_template_message_input(recipient, template_name, language="en_US", parameters=()):
+    """A template message; `parameters` fill the body's {{1}}, {{2}}, ... in order."""
+    template = {"name": template_name, "language": {"code": language}}
+    if parameters:
+        template["components"] = [
+            {
+                "type": "body",
+                "parameters": [{"type": "text", "text": value} for value in parameters],
+            }
+        ]
     return json.dumps(
         {
             "messaging_product": "whatsapp",
-            "recipient_type": "individual",
             "to": recipient,
-            "type": "text",
-            "text": {"preview_url": False, "body": text},
+            "type": "template",
+            "template": template,
         }
     )
 
@@ -46,32 +72,33 @@ def generate_response(response):
 
 
 def send_message(data):
-    headers = {
-        "Content-type": "application/json",
-        "Authorization": f"Bearer {current_app.config['ACCESS_TOKEN']}",
-    }
-
-    url = f"https://graph.facebook.com/{current_app.config['VERSION']}/{current_app.config['PHONE_NUMBER_ID']}/messages"
+    # The business number the current reply is sent from
+    delivery = current_number().delivery
 
+    started = time.perf_counter()
     try:
-        response = requests.post(
-            url, data=data, headers=headers, timeout=10
-        )  # 10 seconds timeout as an example
-        response.raise_for_status()  # Raises an HTTPError if the HTTP request returned an unsuccessful status code
-    except requests.Timeout:
-        logging.error("Timeout occurred while sending message")
-        return jsonify({"status": "error", "message": "Request timed out"}), 408
-    except (
-        requests.RequestException
-    ) as e:  # This will catch any general request exception
+        # Rate limited per phone number, retried on 429/5xx/timeouts, and
+        # dead-lettered if it still can't be delivered
+        response = delivery.send(data)
+    except DeliveryFailure as e:
+        SEND_SECONDS.labels(str(e.status_code or e.reason)).observe(time.perf_counter() - started)
         logging.error(f"Request failed due to: {e}")
-        return jsonify({"status": "error", "message": "Failed to send message"}), 500
+        return (
+            jsonify({"status": "error", "message": "Failed to send message", "reason": e.reason}),
+            e.status_code or 500,
+        )
     else:
+        SEND_SECONDS.labels(str(response.status_code)).observe(time.perf_counter() - started)
         # Process the response as normal
         log_http_response(response)
         return response
 
 
+def get_media_id(asset_name):
+    """Media id for a file in data/, uploaded and refreshed by the media manager."""
+    return current_number().media_manager.resolve(asset_name)
+
+
 def process_text_for_whatsapp(text):
     # Remove brackets
     pattern = r"\【.*?\】"
@@ -90,244 +117,300 @@ def process_text_for_whatsapp(text):
     return whatsapp_style_text
 
 
+# WhatsApp rejects text bodies longer than this
+MAX_TEXT_LENGTH = 4096
+
+PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+SENTENCE_END = re.compile(r"[.!?।](?=\s)")
+
+
+def split_for_whatsapp(text, limit=MAX_TEXT_LENGTH):
+    """Split text into pieces WhatsApp accepts, preferring line and word breaks."""
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = text.rfind(" ", 0, limit)
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text:
+        chunks.append(text)
+    return chunks
+
+
+class WhatsAppTextStream:
+    """
+    Incremental version of `process_text_for_whatsapp` for streamed replies.
+
+    Feed it text deltas as they arrive; it returns formatted chunks once a
+    paragraph is complete (or a sentence, when enough text is buffered). A
+    chunk is never cut inside a 【…】 citation or between a pair of **, so
+    both are handled exactly as in the one-shot version.
+    """
+
+    def __init__(self, min_sentence_chunk=300, limit=MAX_TEXT_LENGTH):
+        self.min_sentence_chunk = min_sentence_chunk
+        self.limit = limit
+        self._buffer = ""
+
+    def feed(self, delta):
+        self._buffer += delta
+        cut = self._find_cut()
+        if cut is None:
+            return []
+        ready, self._buffer = self._buffer[:cut], self._buffer[cut:].lstrip()
+        return self._format(ready)
+
+    def flush(self):
+        ready, self._buffer = self._buffer, ""
+        return self._format(ready)
+
+    def _find_cut(self):
+        buffer = self._buffer
+        candidates = [match.end() for match in PARAGRAPH_BREAK.finditer(buffer)]
+        if not candidates and len(buffer) >= self.min_sentence_chunk:
+            candidates = [match.end() for match in SENTENCE_END.finditer(buffer)]
+        # Prefer the latest boundary that doesn't split a citation or bold span
+        for cut in reversed(candidates):
+            if self._is_safe_cut(buffer[:cut]):
+                return cut
+        if len(buffer) > self.limit:
+            # No usable boundary and too long to hold back: cut at a word break
+            cut = buffer.rfind(" ", 0, self.limit)
+            return cut if cut > 0 else self.limit
+        return None
+
+    @staticmethod
+    def _is_safe_cut(text):
+        unclosed_citation = text.rfind("【") > text.rfind("】")
+        return not unclosed_citation and text.count("**") % 2 == 0
+
+    def _format(self, text):
+        text = process_text_for_whatsapp(text)
+        return split_for_whatsapp(text, self.limit) if text else []
+
+
+def send_ai_reply(wa_id, name, message_text, phone_number_id=None):
+    """
+    Answer free text with the OpenAI Assistant, from the business number
+    the question was sent to.
+
+    With AI_REPLIES=stream, paragraphs are sent as soon as the run produces
+    them instead of after the whole run finishes.
+    """
+    number = current_app.extensions["number_registry"].get(phone_number_id)
+    if number is None:
+        return
+    with sending_from(number):
+        _send_ai_reply(wa_id, name, message_text)
+
+
+def _send_ai_reply(wa_id, name, message_text):
+    from app.services import openai_service
+
+    if current_app.config["AI_REPLIES"] != "stream":
+        response = openai_service.generate_response(message_text, wa_id, name)
+        if response:
+            send_text(wa_id, response)
+        return
+
+    stream = WhatsAppTextStream()
+    streamed = []
+
+    def on_text(delta):
+        streamed.append(delta)
+        for chunk in stream.feed(delta):
+            send_message(get_text_message_input(wa_id, chunk))
+
+    try:
+        response = openai_service.generate_response(
+            message_text, wa_id, name, on_text=on_text
+        )
+    except Exception:
+        if streamed:
+            logging.error(
+                f"Streamed reply to {wa_id} broke off after {len(streamed)} deltas; "
+                f"dropping its unsent tail"
+            )
+        raise
+    if response is None and streamed:
+        # The run failed midway (generate_response logged which one): what
+        # is still buffered is a fragment, not the end of the answer
+        logging.error(f"Streamed reply to {wa_id} is incomplete; dropping its unsent tail")
+        return
+    # Polling runs produce no deltas, so format the finished reply in one go
+    chunks = stream.feed(response) if not streamed and response else []
+    for chunk in chunks + stream.flush():
+        send_message(get_text_message_input(wa_id, chunk))
+
+
+def send_text(wa_id, text):
+    """Send text formatted for WhatsApp, split if it is too long."""
+    for chunk in split_for_whatsapp(process_text_for_whatsapp(text)):
+        send_message(get_text_message_input(wa_id, chunk))
+
+
+def send_flow(flow_name, wa_id, name="", already_sent=None):
+    """
+    Send every message of a flow from app/flows/flows.json, in order.
+
+    Payloads in `already_sent` are skipped and the sent ones are added, so
+    flows that share steps (e.g. the tour buttons) don't repeat them.
+    """
+    registry = current_number().flows
+    for payload in registry.render(flow_name, wa_id, name, get_media_id):
+        if already_sent is not None:
+            if payload in already_sent:
+                continue
+            already_sent.add(payload)
+        send_message(payload)
+
+
 def send_tour_options(wa_id):
     """Send the tour option buttons"""
-    # First message with 3 buttons (Options 1, 2, 3)
-    button_msg_1 = json.dumps({
-        "messaging_product": "whatsapp",
-        "to": wa_id,
-        "type": "interactive",
-        "interactive": {
-            "type": "button",
-            "body": {"text": "Choose your experience:"},
-            "action": {
-                "buttons": [
-                    {
-                        "type": "reply",
-                        "reply": {
-                            "id": "yuva_yatra_1_btn",
-                            "title": "1️⃣ Yuva Yatra 1 "
-                        }
-                    },
-                    {
-                        "type": "reply",
-                        "reply": {
-                            "id": "yuva_yatra_2_btn",
-                            "title": "2️⃣ Yuva Yatra 2 "
-                        }
-                    },
-                    {
-                        "type": "reply",
-                        "reply": {
-                            "id": "parivar_pravaas_btn",
-                            "title": "3️⃣ Parivaar Pravaas"
-                        }
-                    }
-                ]
-            }
-        }
-    })
-    send_message(button_msg_1)
-    
-    # Second message with 1 button (Option 4)
-    button_msg_2 = json.dumps({
-        "messaging_product": "whatsapp",
-        "to": wa_id,
-        "type": "interactive",
-        "interactive": {
-            "type": "button",
-            "body": {"text": "Or choose a customized option:"},
-            "action": {
-                "buttons": [
-                    {
-                        "type": "reply",
-                        "reply": {
-                            "id": "customized_tour_btn",
-                            "title": "4️⃣ Customized Tour"
-                        }
-                    }
-                ]
-            }
-        }
-    })
-    send_message(button_msg_2)
+    send_flow("tour_options", wa_id)
 
 
 def is_greeting_message(message_text):
     """Check if the message is a greeting that should trigger welcome flow"""
-    greeting_keywords = [
-        'hi', 'hello', 'hey', 'start', 'begin', 'namaste', 'namaskar',
-        'good morning', 'good afternoon', 'good evening', 'greetings'
-    ]
-    
-    # Convert to lowercase and check if it matches any greeting
-    message_lower = message_text.lower().strip()
-    
-    # Check for exact matches or if message contains greeting words
-    return any(keyword in message_lower for keyword in greeting_keywords)
+    intents = current_number().flows.intents
+    # Whole words only, so "this ship" is not a "hi"
+    return "greeting" in intents.match(message_text)
 
 
-def process_whatsapp_message(body):
-    wa_id = body["entry"][0]["changes"][0]["value"]["contacts"][0]["wa_id"]
-    name = body["entry"][0]["changes"][0]["value"]["contacts"][0]["profile"]["name"]
-    message = body["entry"][0]["changes"][0]["value"]["messages"][0]
-    message_type = message.get("type")
+# Sent when nothing more specific applies; one is enough per burst
+FALLBACK_REPLIES = (("flow", "help"), ("flow", "unsupported"))
 
-    # Handle interactive button replies FIRST
-    if message_type == "interactive":
-        interactive = message.get("interactive", {})
-        if interactive.get("type") == "button_reply":
-            button_reply_id = interactive["button_reply"].get("id")
-            
-            if button_reply_id == "yuva_yatra_1_btn":
-                # Send Yuva Yatra 1 PDF
-                data = json.dumps({
-                    "messaging_product": "whatsapp",
-                    "recipient_type": "individual",
-                    "to": wa_id,
-                    "type": "document",
-                    "document": {
-                        "id": "1311569197013460",
-                        "caption": "🏕️ Yuva Yatra 1 – Stay carefree with separate men’s and women’s dorms plus private unattached washrooms for complete comfort, hygiene, and peace of mind.",
-                        "filename": "yuva_yatra_1.pdf"
-                    }
-                })
-                send_message(data)
-                
-                # Send contact message
-                contact_msg = (
-                     "🌍 Need guidance? 8800969741 \n\n"
-                    "🎟️ Lock your seat? 7054400500\n\n"
-                    "Travel dreams, one call away!"
-                )
-                send_message(get_text_message_input(wa_id, contact_msg))
-                
-            elif button_reply_id == "yuva_yatra_2_btn":
-                # Send Yuva Yatra 2 PDF
-                data = json.dumps({
-                    "messaging_product": "whatsapp",
-                    "recipient_type": "individual",
-                    "to": wa_id,
-                    "type": "document",
-                    "document": {
-                        "id": "683872947367766",
-                        "caption": "🏕️ Yuva Yatra 2 – Stay easy in mixed 👫 and female 👩 dorms, designed with attached washrooms 🚿 for convenience, comfort, and a relaxed journey ✨🛏️.",
-                        "filename": "yuva_yatra_2.pdf"
-                    }
-                })
-                send_message(data)
-                
-                # Send contact message
-                contact_msg = (
-                    "🌍 Need guidance? 8800969741 \n\n"
-                    "🎟️ Lock your seat? 7054400500\n\n"
-                    "Travel dreams, one call away!"
-                )
-                send_message(get_text_message_input(wa_id, contact_msg))
-                
-            elif button_reply_id == "parivar_pravaas_btn":
-                # Send Parivaar Pravas PDF
-                data = json.dumps({
-                    "messaging_product": "whatsapp",
-                    "recipient_type": "individual",
-                    "to": wa_id,
-                    "type": "document",
-                    "document": {
-                        "id": "1813897679248489",
-                        "caption": "Parivaar Pravaas – Stay at ease with family stays that blend comfort, privacy, and a homely touch for your perfect getaway. 🌿🏡✨",
-                        "filename": "parivar_pravaas.pdf"
-                    }
-                })
-                send_message(data)
-                
-                # Send contact message
-                contact_msg = (
-                    "🌍 Need guidance? 8800969741 \n"
-                    "🎟️ Lock your seat? 7054400500\n\n"
-                    "Travel dreams, one call away!\n"
-                )
-                send_message(get_text_message_input(wa_id, contact_msg))
-                
-            elif button_reply_id == "customized_tour_btn":
-                # Send custom message for Customized Tour
-                custom_msg = (
-                    "Customized Tour – From Your City 🌟\n"
-                    "Your journey, your rules. ✨\n\n"
-                    "Start right from your hometown 🏠\n\n"
-                    "Handpicked inclusions, made just for you 📝\n\n"
-                    "Flexible itinerary 🗓️\n\n"
-                    "A Dev Deepawali experience as unique as you 🌌\n\n"
-                    "📞 Queries: 8800969741 | Bookings: 7054400500\n"
-                    "We’ll craft the perfect celebration of lights, tailored to you. 🪔💫"
-                )
-                send_message(get_text_message_input(wa_id, custom_msg))
-        
-        # IMPORTANT: Return here to prevent any further processing
+
+def process_sender_messages(wa_id, events):
+    """
+    Reply to one sender's events. With INBOUND_DEBOUNCE_SECONDS set, events
+    are first collected until the sender pauses and answered together.
+    """
+    debouncer = current_app.extensions.get("inbound_debouncer")
+    if debouncer is None:
+        process_burst(wa_id, events)
         return
+    for event in events:
+        debouncer.push(wa_id, event)
+
+
+def process_whatsapp_message(body):
+    for wa_id, events in parse_webhook(body).by_sender().items():
+        process_sender_messages(wa_id, events)
+
 
-    # Handle text messages - ONLY send welcome + buttons for GREETING messages
-    elif message_type == "text":
-        message_text = message.get("text", {}).get("body", "").strip()
-        
-        # Check if this is a greeting message
-        if is_greeting_message(message_text):
-            # Send image with caption first (replace <IMAGE_MEDIA_ID> with your actual media id)
-            image_payload = json.dumps({
-                "messaging_product": "whatsapp",
-                "recipient_type": "individual",
-                "to": wa_id,
-                "type": "image",
-                "image": {
-                    "id": "792434643189920",
-                    "caption": f"Namaste {name}! 🙏\n\n 🌌 When the Ganga wears a thousand stars, you know it’s Dev Deepawali.Join us with HostmenIndia \n Choose Delhi departure or your city escape, and boom – itinerary at your fingertips \n\n *Choose 1* for -Yuva Yatra 1 – Stay carefree with separate men’s and women’s dorms plus private unattached washrooms for complete comfort, hygiene, and peace of mind.\n\n *Choose 2* for - Yuva Yatra 2 – Stay easy in mixed 👫 and female 👩 dorms, designed with attached washrooms 🚿 for convenience, comfort, and a relaxed journey.\n\n *Choose 3* for Parivaar Pravaas – Stay at ease with family stays that blend comfort, privacy, and a homely touch for your perfect getaway.\n\n *Choose 4* for- Customized Tour – From Your City ,Your journey, your rules. Start right from your hometown Handpicked inclusions, made just for you Flexible itinerary 🗓️\n A Dev Deepawali experience as unique as you 🌌"
-                }
-            })
-            send_message(image_payload)
-
-            # Send welcome message ONLY for greeting messages
-            welcome_text = (
-                # Add your welcome text here if needed
-                ""
+def process_burst(wa_id, events, receipt=None):
+    """
+    Answer a sender's events with one merged reply plan, in order, from
+    the business number each event was sent to.
+
+    `receipt` (events from the durable inbound queue) is held until any
+    Assistant run the burst starts has been answered.
+    """
+    registry = current_app.extensions["number_registry"]
+    for phone_number_id, number_events in group_by_number(events).items():
+        number = registry.get(phone_number_id)
+        if number is None:
+            logging.warning(
+                f"Ignoring {len(number_events)} message(s) to unknown number {phone_number_id}"
             )
-            if welcome_text.strip():  # Only send if there's actual content
-                welcome_msg = get_text_message_input(wa_id, welcome_text)
-                send_message(welcome_msg)
-            
-            # Send tour options
-            send_tour_options(wa_id)
-        else:
-            # For non-greeting text messages, send a different response
-            help_msg = (
-                f"Hello {name}! 👋\n\n"
-                "I can help you with Dev Deepawali tour information. "
-                "If you'd like to see our tour options again, please type 'Hi' or 'Hello'."
+            continue
+        with sending_from(number):
+            answer_burst(wa_id, number_events, receipt)
+
+
+def group_by_number(events):
+    numbers = {}
+    for event in events:
+        numbers.setdefault(event.phone_number_id, []).append(event)
+    return numbers
+
+
+def answer_burst(wa_id, events, receipt=None):
+    """Answer events sent to the current number with one merged reply plan."""
+    number = current_number()
+    name = events[-1].name
+    sent = set()
+    for kind, value in plan_replies([resolve_reply(event) for event in events]):
+        if kind == "flow":
+            # e.g. a second greeting within the cooldown skips the image
+            flow_name = number.cooldowns.choose(wa_id, value)
+            if flow_name:
+                send_flow(flow_name, wa_id, name, already_sent=sent)
+        elif kind == "text":
+            send_text(wa_id, value)
+        elif kind == "ai":
+            # The run coordinator also merges messages sent during a run
+            current_app.extensions["run_coordinator"].submit(
+                wa_id,
+                name,
+                value,
+                phone_number_id=number.phone_number_id,
+                receipt=receipt.hold() if receipt is not None else None,
             )
-            send_message(get_text_message_input(wa_id, help_msg))
-        
-        # IMPORTANT: Return here to prevent any further processing
-        return
+
+
+def resolve_reply(event):
+    """
+    Decide how to answer one event: ("flow", name), ("text", answer),
+    ("ai", question) or None for no reply.
+    """
+    # Handle interactive button replies FIRST
+    if isinstance(event, ButtonReply):
+        # Button ids map straight to the flow that answers them
+        flow_name = current_number().flows.flow_for_button(event.button_id)
+        return ("flow", flow_name) if flow_name else None
+
+    # Handle text messages - canned flows for known intents, everything else to AI or help
+    if isinstance(event, TextMessage):
+        message_text = event.text.strip()
+
+        # Greetings and tour names each have a flow (see "intents" in
+        # app/flows/flows.json)
+        flow_name = current_number().flows.flow_for_text(message_text)
+        if flow_name:
+            return ("flow", flow_name)
+
+        # Answered from the local index over data/, no Assistant run needed
+        answer = current_app.extensions["faq_responder"].answer(message_text)
+        if answer is not None:
+            return ("text", answer)
+
+        if current_app.config["AI_REPLIES"] != "off":
+            # Let the OpenAI Assistant answer free-form questions
+            return ("ai", message_text)
+
+        # For non-greeting text messages, send a different response
+        return ("flow", "help")
+
+    # Other interactive replies (lists, flows) are not part of this bot's menus
+    if isinstance(event, UnknownMessage) and event.message_type == "interactive":
+        return None
 
     # Handle other message types (audio, image, etc.) - Just send a simple response
-    else:
-        simple_msg = (
-            f"Hello {name}! 👋\n\n"
-            "Please send a text message to get started with our Dev Deepawali tours."
-        )
-        send_message(get_text_message_input(wa_id, simple_msg))
-        
-        # IMPORTANT: Return here to prevent any further processing  
-        return
+    return ("flow", "unsupported")
 
 
-def is_valid_whatsapp_message(body):
+def plan_replies(replies):
     """
-    Check if the incoming webhook event has a valid WhatsApp message structure.
+    Merge the replies to a burst of events: each distinct reply is sent
+    once, questions for the Assistant are asked together, and a fallback
+    flow is only sent when nothing else answers the burst.
     """
-    return (
-        body.get("object")
-        and body.get("entry")
-        and body["entry"][0].get("changes")
-        and body["entry"][0]["changes"][0].get("value")
-        and body["entry"][0]["changes"][0]["value"].get("messages")
-        and body["entry"][0]["changes"][0]["value"]["messages"][0]
-    )
\ No newline at end of file
+    plan = []
+    questions = []
+    for reply in replies:
+        if reply is None or reply in plan:
+            continue
+        if reply[0] == "ai":
+            questions.append(reply[1])
+        else:
+            plan.append(reply)
+
+    if questions:
+        plan.append(("ai", "\n".join(questions)))
+    answers = [reply for reply in plan if reply not in FALLBACK_REPLIES]
+    return answers if answers else plan[:1]
@@ -1,15 +1,22 @@
 import logging
 import json
+import time
 
-from flask import Blueprint, request, jsonify, current_app
+from flask import Blueprint, Response, request, jsonify, current_app
 
-from .decorators.security import signature_required
-from .utils.whatsapp_utils import (
-    process_whatsapp_message,
-    is_valid_whatsapp_message,
-)
+from .decorators.security import signature_required, token_required
+from .services.inbound_queue import QueueWriteError
+from .services.metrics import CONTENT_TYPE, WEBHOOK_SECONDS, webhook_event
+from .services.scheduler import QueueFullError
+from .utils.webhook_parser import load_body, parse_webhook
+from .utils.whatsapp_utils import process_sender_messages
 
 webhook_blueprint = Blueprint("webhook", __name__)
+analytics_blueprint = Blueprint("analytics", __name__)
+metrics_blueprint = Blueprint("metrics", __name__)
+
+STATUS_OK = b'{"status":"ok"}\n'
+JSON_HEADERS = {"Content-Type": "application/json"}
 
 
 def handle_message():
@@ -23,35 +30,86 @@ def handle_message():
 
     Every message send will trigger 4 HTTP requests to your webhook: message, sent, delivered, read.
 
+    With DISPATCH_MODE=async the message is only queued here and the reply
+    flow runs on a background worker, so Meta gets its 200 right away. With
+    INBOUND_QUEUE_PATH set it is written to the durable queue first instead.
+
     Returns:
         response: A tuple containing a JSON response and an HTTP status code.
     """
-    body = request.get_json()
-    # logging.info(f"request body: {body}")
-
-    # Check if it's a WhatsApp status update
-    if (
-        body.get("entry", [{}])[0]
-        .get("changes", [{}])[0]
-        .get("value", {})
-        .get("statuses")
-    ):
-        logging.info("Received a WhatsApp status update.")
-        return jsonify({"status": "ok"}), 200
-
+    started = time.perf_counter()
+    event_type = "invalid"
     try:
-        if is_valid_whatsapp_message(body):
-            process_whatsapp_message(body)
+        # The same bytes signature_required hashed, decoded once (orjson
+        # when installed) and handed on as event objects
+        raw = request.get_data()
+        body = load_body(raw)
+        # logging.info(f"request body: {body}")
+
+        # Meta batches messages and statuses, so parse every entry and change once
+        batch = parse_webhook(body)
+        event_type = webhook_event(batch)
+        if batch.statuses:
+            # Buffered in memory and written in batches by a background thread
+            pipeline = current_app.extensions["status_pipeline"]
+            if pipeline is not None:
+                pipeline.record(batch.statuses)
+            else:
+                logging.info(f"Received {len(batch.statuses)} WhatsApp status update(s).")
+
+        if batch.is_whatsapp and batch.messages:
+            # Drop messages Meta is redelivering because an earlier 200 was slow
+            deduplicator = current_app.extensions["message_deduplicator"]
+            batch.messages = [
+                event for event in batch.messages
+                if not deduplicator.seen(event.message_id)
+            ]
+
+            inbound_queue = current_app.extensions["inbound_queue"]
+            if inbound_queue is not None:
+                if not batch.messages:
+                    return jsonify({"status": "ok"}), 200
+                try:
+                    # Returns once the delivery is on disk (group-committed
+                    # with the other webhooks arriving meanwhile)
+                    inbound_queue.put(raw, [event.message_id for event in batch.messages])
+                except QueueWriteError as e:
+                    logging.error(f"Could not queue webhook, asking Meta to retry: {e}")
+                    for message in batch.messages:
+                        deduplicator.forget(message.message_id)
+                    return jsonify({"status": "error", "message": "Server busy"}), 503
+                return jsonify({"status": "ok"}), 200
+
+            # One job per sender, keyed by wa_id: senders run in parallel,
+            # and each sender's replies stay in order across deliveries
+            jobs = [
+                (wa_id, process_sender_messages, (wa_id, events))
+                for wa_id, events in batch.by_sender().items()
+            ]
+            dispatcher = current_app.extensions["webhook_dispatcher"]
+            try:
+                dispatcher.submit_all(jobs)
+            except QueueFullError:
+                # Let Meta redeliver later instead of blocking this worker
+                logging.warning("Webhook queue is full, asking Meta to retry")
+                for message in batch.messages:
+                    deduplicator.forget(message.message_id)
+                return jsonify({"status": "error", "message": "Server busy"}), 503
             return jsonify({"status": "ok"}), 200
+        elif batch.is_whatsapp and batch.statuses:
+            # Most deliveries are statuses; answer them with a prebuilt body
+            return STATUS_OK, 200, JSON_HEADERS
         else:
             # if the request is not a WhatsApp API event, return an error
             return (
                 jsonify({"status": "error", "message": "Not a WhatsApp API event"}),
                 404,
             )
-    except json.JSONDecodeError:
+    except (json.JSONDecodeError, UnicodeDecodeError):
         logging.error("Failed to decode JSON")
         return jsonify({"status": "error", "message": "Invalid JSON provided"}), 400
+    finally:
+        WEBHOOK_SECONDS.labels(event_type).observe(time.perf_counter() - started)
 
 
 # Required webhook verifictaion for WhatsApp
@@ -87,3 +145,20 @@ def webhook_post():
     return handle_message()
 
 
+@analytics_blueprint.route("/analytics/statuses", methods=["GET"])
+@token_required("ANALYTICS_TOKEN")
+def status_analytics():
+    """Delivery rate, read rate, latencies and failures by error code over ?hours=24."""
+    pipeline = current_app.extensions["status_pipeline"]
+    if pipeline is None:
+        return jsonify({"status": "error", "message": "Status analytics are off"}), 404
+    hours = request.args.get("hours", 24, type=int)
+    phone_number_id = request.args.get("phone_number_id")
+    return jsonify(pipeline.aggregates(max(1, hours), phone_number_id)), 200
+
+
+@metrics_blueprint.route("/metrics", methods=["GET"])
+@token_required("METRICS_TOKEN")
+def metrics():
+    """Latency histograms and queue depths in the Prometheus text format."""
+    return Response(current_app.extensions["metrics"].render(), content_type=CONTENT_TYPE)
@@ -0,0 +1,110 @@
+"""
+Per-request cost of webhook ingress: signature check plus JSON decoding.
+
+"before" is what signature_required and handle_message used to do: decode
+the body to str for validate_signature, encode it back to bytes, key a new
+HMAC from APP_SECRET, then parse the body again with json. "after" hashes
+the raw bytes on a copy of the pre-keyed HMAC and decodes the same buffer
+with load_body (orjson when installed).
+
+    python benchmarks/bench_ingress.py
+"""
+import hashlib
+import hmac
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.decorators.security import signature_matches
+from app.utils import webhook_parser
+from app.utils.webhook_parser import load_body
+
+APP_SECRET = "0123456789abcdef0123456789abcdef"
+
+
+def text_message(i):
+    return {
+        "from": f"9198765{i:05d}",
+        "id": f"wamid.HBgMOTE5ODc2NTQzMjEwFQIAEhgUM0E{i:020d}",
+        "timestamp": "1700000000",
+        "type": "text",
+        "text": {"body": "Namaste! Yuva Yatra 2 ka price kya hai aur booking kaise karein?"},
+    }
+
+
+def status(i):
+    return {
+        "id": f"wamid.HBgMOTE5ODc2NTQzMjEwFQIAERgSQjU{i:020d}",
+        "status": "delivered",
+        "timestamp": "1700000005",
+        "recipient_id": f"9198765{i:05d}",
+        "conversation": {"id": "c" * 32, "origin": {"type": "service"}},
+        "pricing": {"billable": True, "pricing_model": "CBP", "category": "service"},
+    }
+
+
+def delivery(messages=(), statuses=()):
+    value = {
+        "messaging_product": "whatsapp",
+        "metadata": {"display_phone_number": "15550000000", "phone_number_id": "111"},
+    }
+    if messages:
+        value["contacts"] = [
+            {"profile": {"name": f"Guest {i}"}, "wa_id": m["from"]} for i, m in enumerate(messages)
+        ]
+        value["messages"] = list(messages)
+    if statuses:
+        value["statuses"] = list(statuses)
+    body = {
+        "object": "whatsapp_business_account",
+        "entry": [{"id": "1234567890", "changes": [{"field": "messages", "value": value}]}],
+    }
+    return json.dumps(body).encode("utf-8")
+
+
+PAYLOADS = {
+    "1 message": delivery(messages=[text_message(0)]),
+    "1 status": delivery(statuses=[status(0)]),
+    "20 messages": delivery(messages=[text_message(i) for i in range(20)]),
+    "100 statuses": delivery(statuses=[status(i) for i in range(100)]),
+}
+
+
+def before(raw, signature):
+    text = raw.decode("utf-8")
+    expected = hmac.new(
+        bytes(APP_SECRET, "latin-1"), msg=text.encode("utf-8"), digestmod=hashlib.sha256
+    ).hexdigest()
+    assert hmac.compare_digest(expected, signature)
+    return json.loads(raw)
+
+
+def after(raw, signature):
+    assert signature_matches(APP_SECRET, raw, signature)
+    return load_body(raw)
+
+
+def per_request_us(fn, raw, signature, number=5000):
+    seconds = timeit.timeit(lambda: fn(raw, signature), number=number)
+    return seconds / number * 1e6
+
+
+def main():
+    decoder = "orjson" if webhook_parser.orjson is not None else "json"
+    print(f"decoder: {decoder}")
+    print(f"{'payload':>13} {'bytes':>7} {'before':>10} {'after':>10} {'saved':>7}")
+    for label, raw in PAYLOADS.items():
+        signature = hmac.new(APP_SECRET.encode(), raw, hashlib.sha256).hexdigest()
+        old = per_request_us(before, raw, signature)
+        new = per_request_us(after, raw, signature)
+        print(
+            f"{label:>13} {len(raw):>7} {old:>7.1f} us {new:>7.1f} us "
+            f"{1 - new / old:>6.0%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Per-message cost of intent matching as the keyword list grows.
+
+Compares the compiled IntentMatcher with the substring scan that
+is_greeting_message used to do (`any(keyword in text ...)`). The scan grows
+linearly with the number of keywords; the matcher stays flat because it
+only looks up the message's own word n-grams.
+
+    python benchmarks/bench_intents.py
+"""
+import os
+import random
+import string
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.utils.intents import IntentMatcher
+
+MESSAGES = [
+    "Hi",
+    "What is this trip about? Which ship do we take?",
+    "kitna price hai yuva yatra 2 ka",
+    "नमस्ते जी, परिवार प्रवास की बुकिंग कैसे करें?",
+    "Can I get a customized tour from Delhi for 6 people in November please",
+]
+
+
+def random_keywords(count, seed=7):
+    rng = random.Random(seed)
+    keywords = set()
+    while len(keywords) < count:
+        words = rng.randint(1, 3)
+        keywords.add(" ".join(
+            "".join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 9)))
+            for _ in range(words)
+        ))
+    return sorted(keywords)
+
+
+def substring_scan(keywords):
+    def match(text):
+        text = text.lower().strip()
+        return any(keyword in text for keyword in keywords)
+    return match
+
+
+def per_message_us(match, number=2000):
+    seconds = timeit.timeit(lambda: [match(m) for m in MESSAGES], number=number)
+    return seconds / (number * len(MESSAGES)) * 1e6
+
+
+def main():
+    print(f"{'keywords':>9} {'substring scan':>16} {'IntentMatcher':>15}")
+    for count in (10, 100, 1000, 10000):
+        keywords = random_keywords(count)
+        matcher = IntentMatcher({"intent": {"keywords": keywords}})
+        scan = per_message_us(substring_scan(keywords))
+        compiled = per_message_us(matcher.best)
+        print(f"{count:>9} {scan:>13.2f} us {compiled:>12.2f} us")
+
+
+if __name__ == "__main__":
+    main()
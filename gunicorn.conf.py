@@ -0,0 +1,10 @@
+# Read by gunicorn from the working directory, e.g. `gunicorn run:app`
+from flask import Flask
+
+
+def post_worker_init(worker):
+    # The async app (run_async:app) starts its own from on_startup
+    if isinstance(worker.wsgi, Flask):
+        from app import start_serving
+
+        start_serving(worker.wsgi)
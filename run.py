@@ -1,10 +1,11 @@
 import logging
 
-from app import create_app
+from app import create_app, start_serving
 
 
 app = create_app()
 
 if __name__ == "__main__":
     logging.info("Flask app started")
+    start_serving(app)
     app.run(host="0.0.0.0", port=8000)
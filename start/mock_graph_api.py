@@ -0,0 +1,86 @@
+"""
+Local stand-in for the Graph API messages endpoint, for trying campaigns
+and load tests without sending real messages.
+
+    python start/mock_graph_api.py --port 9000 --latency 0.05 --fail-rate 0.01
+    GRAPH_BASE_URL=http://127.0.0.1:9000 flask --app run campaign send recipients.csv --template promo
+
+POST /<version>/<phone_number_id>/messages answers like WhatsApp does,
+after `--latency` seconds. A share of requests gets a 429 throttling error
+(`--throttle-rate`) or a 500 (`--fail-rate`). GET /stats shows how many
+messages each number received, so double sends stand out.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+from collections import Counter
+
+from aiohttp import web
+
+ids = itertools.count(1)
+received = Counter()
+
+
+def graph_error(status, code, message):
+    return web.json_response(
+        {"error": {"message": message, "type": "OAuthException", "code": code}}, status=status
+    )
+
+
+async def post_message(request):
+    options = request.app["options"]
+    if options.latency:
+        await asyncio.sleep(random.uniform(0.5, 1.5) * options.latency)
+    try:
+        payload = json.loads(await request.read())
+        to = payload["to"]
+    except (ValueError, KeyError, TypeError):
+        return graph_error(400, 100, "Invalid parameter")
+
+    roll = random.random()
+    if roll < options.throttle_rate:
+        return graph_error(429, 130429, "Rate limit hit")
+    if roll < options.throttle_rate + options.fail_rate:
+        return graph_error(500, 131000, "Something went wrong")
+
+    received[to] += 1
+    return web.json_response(
+        {
+            "messaging_product": "whatsapp",
+            "contacts": [{"input": to, "wa_id": to}],
+            "messages": [{"id": f"wamid.mock.{next(ids)}"}],
+        }
+    )
+
+
+async def stats(request):
+    duplicates = {to: count for to, count in received.items() if count > 1}
+    return web.json_response(
+        {
+            "messages": sum(received.values()),
+            "recipients": len(received),
+            "duplicates": duplicates,
+        }
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency", type=float, default=0.05, help="Average seconds per request")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Share of 500 responses")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Share of 429 responses")
+    options = parser.parse_args()
+
+    app = web.Application()
+    app["options"] = options
+    app.router.add_post("/{version}/{phone_number_id}/messages", post_message)
+    app.router.add_get("/stats", stats)
+    web.run_app(app, host=options.host, port=options.port)
+
+
+if __name__ == "__main__":
+    main()
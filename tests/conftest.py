@@ -0,0 +1,126 @@
+import hashlib
+import hmac
+import json
+import os
+import sys
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Read at import time by app.services.openai_service
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+os.environ["THREAD_STORE"] = "memory"
+os.environ["ANSWER_CACHE"] = "off"
+
+APP_SECRET = "test-secret"
+PHONE_NUMBER_ID = "111"
+
+BASE_ENV = {
+    "APP_SECRET": APP_SECRET,
+    "ACCESS_TOKEN": "test-token",
+    "VERSION": "v18.0",
+    "PHONE_NUMBER_ID": PHONE_NUMBER_ID,
+    "VERIFY_TOKEN": "verify-me",
+    "MEDIA_PREWARM": "false",
+    "INBOUND_DEBOUNCE_SECONDS": "0",
+    "AI_REPLIES": "off",
+    "METRICS_DIR": "",
+    "METRICS_TOKEN": "metrics-token",
+    "ANALYTICS_TOKEN": "analytics-token",
+}
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, body=None):
+        self.status_code = status_code
+        self.headers = {"content-type": "application/json"}
+        self._body = body if body is not None else {"messages": [{"id": "wamid.out"}]}
+        self.text = json.dumps(self._body)
+        self.ok = status_code < 400
+
+    def json(self):
+        return self._body
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    """Payloads posted to the Graph API, instead of sending them."""
+    from app.services.graph_client import GraphAPIClient
+
+    payloads = []
+
+    def post_message(self, data):
+        payloads.append(json.loads(data))
+        return FakeResponse()
+
+    monkeypatch.setattr(GraphAPIClient, "post_message", post_message)
+    return payloads
+
+
+@pytest.fixture
+def make_app(monkeypatch, tmp_path):
+    """`make_app(SETTING="value", ...)` builds the Flask app with files under tmp_path."""
+    from app import create_app
+
+    def make(**settings):
+        env = {
+            **BASE_ENV,
+            "DEAD_LETTER_PATH": str(tmp_path / "dead_letters.jsonl"),
+            "MEDIA_CACHE_PATH": str(tmp_path / "media_cache.json"),
+            "STATUS_DB_PATH": str(tmp_path / "statuses.db"),
+            "FAQ_INDEX_PATH": str(tmp_path / "faq_index.bin"),
+            **settings,
+        }
+        for name, value in env.items():
+            monkeypatch.setenv(name, value)
+        return create_app()
+
+    return make
+
+
+def webhook_body(*messages, statuses=(), phone_number_id=PHONE_NUMBER_ID, name="Asha"):
+    value = {
+        "messaging_product": "whatsapp",
+        "metadata": {"display_phone_number": "15550000000", "phone_number_id": phone_number_id},
+    }
+    if messages:
+        value["contacts"] = [{"profile": {"name": name}, "wa_id": messages[0]["from"]}]
+        value["messages"] = list(messages)
+    if statuses:
+        value["statuses"] = list(statuses)
+    return {
+        "object": "whatsapp_business_account",
+        "entry": [{"id": "waba", "changes": [{"field": "messages", "value": value}]}],
+    }
+
+
+def text_message(wa_id, text, message_id=None):
+    return {
+        "from": wa_id,
+        "id": message_id or f"wamid.{wa_id}.{time.time_ns()}",
+        "timestamp": "1700000000",
+        "type": "text",
+        "text": {"body": text},
+    }
+
+
+def status(message_id="wamid.out", state="delivered", recipient="919999999999"):
+    return {
+        "id": message_id,
+        "status": state,
+        "timestamp": "1700000005",
+        "recipient_id": recipient,
+    }
+
+
+def post_webhook(client, body, secret=APP_SECRET):
+    raw = body if isinstance(body, bytes) else json.dumps(body).encode()
+    signature = hmac.new(secret.encode(), raw, hashlib.sha256).hexdigest()
+    return client.post(
+        "/webhook",
+        data=raw,
+        headers={"X-Hub-Signature-256": f"sha256={signature}", "Content-Type": "application/json"},
+    )
@@ -0,0 +1,45 @@
+import pytest
+
+from app.services import openai_service
+from app.utils.whatsapp_utils import send_ai_reply
+
+
+def stream_then(monkeypatch, deltas, outcome):
+    """Make the Assistant stream `deltas`, then return or raise `outcome`."""
+
+    def generate_response(message_body, wa_id, name, on_text=None):
+        for delta in deltas:
+            on_text(delta)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    monkeypatch.setattr(openai_service, "generate_response", generate_response)
+
+
+def reply_texts(app, sent):
+    with app.app_context():
+        send_ai_reply("919999999999", "Asha", "Tell me about the tour")
+    return [payload["text"]["body"] for payload in sent]
+
+
+def test_finished_stream_is_sent_in_full(make_app, sent, monkeypatch):
+    stream_then(
+        monkeypatch, ["Day one: Delhi.\n\n", "Day two: Var", "anasi."], "Day one: Delhi.\n\nDay two: Varanasi."
+    )
+
+    assert reply_texts(make_app(AI_REPLIES="stream"), sent) == ["Day one: Delhi.", "Day two: Varanasi."]
+
+
+def test_failed_run_does_not_send_its_half_paragraph(make_app, sent, monkeypatch):
+    stream_then(monkeypatch, ["Day one: Delhi.\n\n", "Day two: Var"], None)
+
+    assert reply_texts(make_app(AI_REPLIES="stream"), sent) == ["Day one: Delhi."]
+
+
+def test_broken_stream_does_not_send_its_half_paragraph(make_app, sent, monkeypatch):
+    stream_then(monkeypatch, ["Day one: Delhi.\n\n", "Day two: Var"], RuntimeError("connection reset"))
+
+    with pytest.raises(RuntimeError):
+        reply_texts(make_app(AI_REPLIES="stream"), sent)
+    assert [payload["text"]["body"] for payload in sent] == ["Day one: Delhi."]
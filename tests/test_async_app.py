@@ -0,0 +1,57 @@
+import asyncio
+
+import pytest
+
+from app.async_app import create_async_app
+from app.services.async_graph_client import AsyncOutboundDelivery, GraphResponse
+from app.services.delivery import DeadLetterLog, DeliveryFailure
+
+
+def test_async_app_refuses_the_inbound_queue(make_app, tmp_path):
+    flask_app = make_app(INBOUND_QUEUE_PATH=str(tmp_path / "inbound.db"))
+
+    with pytest.raises(RuntimeError, match="INBOUND_QUEUE_PATH"):
+        create_async_app(flask_app)
+
+
+def test_async_app_starts_without_the_inbound_queue(make_app):
+    app = create_async_app(make_app())
+
+    assert app.router.resources()
+
+
+def test_given_up_send_lands_in_the_dead_letter_log(tmp_path):
+    class RefusingClient:
+        phone_number_id = "111"
+
+        async def post_message(self, data):
+            return GraphResponse(400, {}, b'{"error": {}}')
+
+    dead_letter = DeadLetterLog(str(tmp_path / "dead_letters.jsonl"))
+    delivery = AsyncOutboundDelivery(RefusingClient(), dead_letter=dead_letter)
+
+    async def send():
+        try:
+            await delivery.send(b'{"to": "919999999999"}')
+        except DeliveryFailure as e:
+            return e.reason
+
+    assert asyncio.run(send()) == "permanent"
+    assert len(dead_letter) == 1
+
+
+def test_async_operator_endpoints_need_a_configured_token(make_app):
+    from aiohttp.test_utils import TestClient, TestServer
+
+    async def statuses(flask_app, headers=None):
+        async with TestClient(TestServer(create_async_app(flask_app))) as client:
+            return [
+                (await client.get(path, headers=headers)).status
+                for path in ("/metrics", "/analytics/statuses")
+            ]
+
+    assert asyncio.run(statuses(make_app(METRICS_TOKEN="", ANALYTICS_TOKEN=""))) == [403, 403]
+    assert asyncio.run(statuses(make_app())) == [401, 401]
+    assert asyncio.run(
+        statuses(make_app(ANALYTICS_TOKEN="metrics-token"), {"Authorization": "Bearer metrics-token"})
+    ) == [200, 200]
@@ -0,0 +1,75 @@
+import asyncio
+import json
+
+import aiohttp
+
+from app.services.async_graph_client import AsyncOutboundDelivery, GraphResponse
+from app.services.campaign import SENT, STARTED, CampaignCheckpoint, CampaignRunner, Recipient, read_recipients
+
+
+class FakeAsyncClient:
+    """Answers each post with the next outcome: a status code or an exception."""
+
+    phone_number_id = "111"
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.posts = 0
+
+    async def post_message(self, data):
+        self.posts += 1
+        outcome = self.outcomes.pop(0) if self.outcomes else 200
+        if isinstance(outcome, Exception):
+            raise outcome
+        body = {"messages": [{"id": f"wamid.{self.posts}"}]} if outcome < 400 else {"error": {}}
+        return GraphResponse(outcome, {}, json.dumps(body).encode())
+
+
+def run_campaign(tmp_path, client):
+    delivery = AsyncOutboundDelivery(client, rate_per_second=1000, burst=1000, base_delay=0.001)
+    checkpoint = CampaignCheckpoint(str(tmp_path / "campaign.jsonl"))
+    runner = CampaignRunner(delivery, checkpoint, "promo", concurrency=1, report_interval=60)
+    stats = asyncio.run(runner.run([Recipient("919999999999")]))
+    checkpoint.close()
+    return stats, CampaignCheckpoint(str(tmp_path / "campaign.jsonl")).states
+
+
+def test_timed_out_send_is_not_repeated(tmp_path):
+    client = FakeAsyncClient(asyncio.TimeoutError())
+
+    stats, states = run_campaign(tmp_path, client)
+
+    assert client.posts == 1
+    assert stats.uncertain == 1
+    assert states == {"919999999999": STARTED}
+
+
+def test_server_error_send_is_not_repeated(tmp_path):
+    client = FakeAsyncClient(503)
+
+    stats, states = run_campaign(tmp_path, client)
+
+    assert client.posts == 1
+    assert states == {"919999999999": STARTED}
+
+
+def test_sends_that_never_went_out_are_retried(tmp_path):
+    client = FakeAsyncClient(aiohttp.ConnectionTimeoutError(), 429)
+
+    stats, states = run_campaign(tmp_path, client)
+
+    assert client.posts == 3
+    assert stats.sent == 1
+    assert states == {"919999999999": SENT}
+
+
+def test_short_csv_rows_are_skipped_or_padded(tmp_path):
+    path = tmp_path / "recipients.csv"
+    path.write_text("name,wa_id,city\nAsha,+919999999999\nRavi\nMeera,919888888888,Pune\n")
+
+    recipients = read_recipients(str(path))
+
+    assert [(r.wa_id, r.params) for r in recipients] == [
+        ("919999999999", ["Asha", ""]),
+        ("919888888888", ["Meera", "Pune"]),
+    ]
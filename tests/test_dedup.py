@@ -0,0 +1,61 @@
+import json
+
+from app.services.dedup import MessageDeduplicator
+from conftest import post_webhook, text_message, webhook_body
+
+
+def test_second_sighting_is_a_duplicate():
+    deduplicator = MessageDeduplicator()
+    assert deduplicator.seen("wamid.1") is False
+    assert deduplicator.seen("wamid.1") is True
+    assert deduplicator.stats() == {"hits": 1, "misses": 1, "entries": 1}
+
+
+def test_events_without_an_id_are_never_duplicates():
+    deduplicator = MessageDeduplicator()
+    assert deduplicator.seen(None) is False
+    assert deduplicator.seen(None) is False
+
+
+def test_forget_lets_a_redelivery_through():
+    deduplicator = MessageDeduplicator()
+    deduplicator.seen("wamid.1")
+    deduplicator.forget("wamid.1")
+    assert deduplicator.seen("wamid.1") is False
+
+
+def test_entries_expire_after_the_ttl(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr("app.services.dedup.time.monotonic", lambda: clock[0])
+    deduplicator = MessageDeduplicator(ttl_seconds=60)
+    deduplicator.seen("wamid.1")
+    clock[0] += 61
+    assert deduplicator.seen("wamid.1") is False
+
+
+def test_oldest_entries_are_evicted_at_capacity():
+    deduplicator = MessageDeduplicator(max_entries=2)
+    for message_id in ("a", "b", "c"):
+        deduplicator.seen(message_id)
+    assert deduplicator.seen("c") is True
+    assert deduplicator.seen("a") is False
+
+
+def test_sqlite_store_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / "dedup.db")
+    first = MessageDeduplicator(sqlite_path=path)
+    second = MessageDeduplicator(sqlite_path=path)
+    assert first.seen("wamid.1") is False
+    assert second.seen("wamid.1") is True
+    second.forget("wamid.1")
+    assert MessageDeduplicator(sqlite_path=path).seen("wamid.1") is False
+
+
+def test_redelivered_webhook_is_answered_once(make_app, sent):
+    client = make_app().test_client()
+    body = webhook_body(text_message("919000000001", "hi", message_id="wamid.hi"))
+    assert post_webhook(client, body).status_code == 200
+    replies = len(sent)
+    assert replies > 0
+    assert post_webhook(client, json.dumps(body).encode()).status_code == 200
+    assert len(sent) == replies
@@ -0,0 +1,78 @@
+import json
+
+import pytest
+import requests
+
+from conftest import FakeResponse
+
+from app.services.delivery import DeadLetterLog, DeliveryFailure, OutboundDelivery
+
+
+class FakeClient:
+    """Answers each post with the next outcome: a status code or an exception."""
+
+    phone_number_id = "111"
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.posts = 0
+
+    def post_message(self, data):
+        self.posts += 1
+        outcome = self.outcomes.pop(0) if self.outcomes else 200
+        if isinstance(outcome, Exception):
+            raise outcome
+        if outcome < 400:
+            return FakeResponse(outcome)
+        # 100 is "invalid parameter", 131000 "something went wrong"
+        return FakeResponse(outcome, {"error": {"code": 100 if outcome < 429 else 131000}})
+
+
+def delivery_for(client, tmp_path, **kwargs):
+    dead_letter = DeadLetterLog(str(tmp_path / "dead_letters.jsonl"))
+    return OutboundDelivery(client, base_delay=0.001, dead_letter=dead_letter, **kwargs)
+
+
+def test_transient_failures_are_retried(tmp_path):
+    client = FakeClient(requests.Timeout(), 503, 429)
+    delivery = delivery_for(client, tmp_path)
+
+    assert delivery.send(b"{}").ok
+    assert client.posts == 4
+    assert len(delivery.dead_letter) == 0
+
+
+def test_exhausted_retries_land_in_the_dead_letter_log(tmp_path):
+    client = FakeClient(*[503] * 3)
+    delivery = delivery_for(client, tmp_path, max_retries=2)
+
+    with pytest.raises(DeliveryFailure) as failure:
+        delivery.send(b'{"to": "919999999999"}')
+
+    assert failure.value.reason == "retry"
+    (record,) = delivery.dead_letter.take()
+    assert record["attempts"] == 3
+    assert json.loads(record["payload"]) == {"to": "919999999999"}
+
+
+def test_permanent_failures_are_not_retried(tmp_path):
+    client = FakeClient(400)
+    delivery = delivery_for(client, tmp_path)
+
+    with pytest.raises(DeliveryFailure):
+        delivery.send(b"{}")
+    assert client.posts == 1
+
+
+def test_take_keeps_records_left_by_an_interrupted_replay(tmp_path):
+    dead_letter = DeadLetterLog(str(tmp_path / "dead_letters.jsonl"))
+    dead_letter.append('{"to": "1"}', "111", "retry")
+    # A replay that died after moving the log aside
+    (tmp_path / "dead_letters.jsonl").rename(tmp_path / "dead_letters.jsonl.replaying")
+    dead_letter.append('{"to": "2"}', "111", "retry")
+
+    records = dead_letter.take()
+
+    assert [record["payload"] for record in records] == ['{"to": "1"}', '{"to": "2"}']
+    assert len(dead_letter) == 0
+    assert dead_letter.take() == []
@@ -0,0 +1,83 @@
+import os
+
+import pytest
+
+from app.services.faq_index import FaqIndex, FaqResponder, _write_index, build_index
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+
+FAQ = [
+    ("What time is check-in and check-out?", "Check-in time is after 3 PM, and check-out time is before 11 AM."),
+    ("What is the Wi-Fi password?", "The Wi-Fi password is Example1234."),
+    ("How do I use the coffee machine in the kitchen?", "Fill the tank, insert a capsule and press the button."),
+    ("Where is the nearest metro station?", "The nearest metro station is Bastille, a five minute walk away."),
+    ("Is there a washing machine?", "Yes, there is a washing machine and dryer in the hallway cupboard."),
+]
+
+
+@pytest.fixture
+def responder(tmp_path):
+    path = str(tmp_path / "faq_index.bin")
+    _write_index(path, {}, [("faq.pdf", f"{q} {a}", a) for q, a in FAQ])
+    # Five passages give low IDFs, so the score floor is scaled down with them
+    return FaqResponder(path, min_score=4.0, reload_interval=0)
+
+
+@pytest.mark.parametrize("question", ["time", "check", "kitchen", "hi", ""])
+def test_short_questions_fall_through(responder, question):
+    assert responder.answer(question) is None
+
+
+@pytest.mark.parametrize(
+    "question",
+    [
+        "tell me a joke about time",
+        "what is the capital of france",
+        "can I bring my dog to the tour",
+        "how much does the Diwali tour cost for a family",
+    ],
+)
+def test_off_topic_questions_fall_through(responder, question):
+    assert responder.answer(question) is None
+
+
+def test_specific_questions_are_answered(responder):
+    assert responder.answer("where is the nearest metro station").startswith("The nearest metro station")
+    assert responder.answer("what time is check-in and check-out").startswith("Check-in time")
+
+
+@pytest.mark.parametrize("question", ["wifi password", "Wi-Fi password?"])
+def test_two_word_questions_are_answered(responder, question):
+    assert responder.answer(question) == "The Wi-Fi password is Example1234."
+
+
+def test_search_reports_matched_terms(responder):
+    responder.answer("metro")
+    passage_id, score, confidence, matched = responder.index.search("nearest metro station", limit=1)[0]
+    assert matched == 3
+    assert confidence == pytest.approx(1.0)
+    # Words the index doesn't know lower the confidence but are never matched
+    assert responder.index.search("nearest metro zzyzx", limit=1)[0][3] == 2
+
+
+def test_repo_data_does_not_answer_one_word_questions(tmp_path):
+    pytest.importorskip("pypdf")
+    path = str(tmp_path / "faq_index.bin")
+    build_index(DATA_DIR, path)
+    responder = FaqResponder(path, reload_interval=0)
+    for question in ("time", "check", "kitchen"):
+        assert responder.answer(question) is None, question
+    assert responder.answer("where is the nearest metro station").startswith("The nearest metro")
+    assert FaqIndex(path).search("time", limit=1)[0][3] == 1
+
+
+def test_repo_data_answers_two_word_questions(tmp_path):
+    pytest.importorskip("pypdf")
+    path = str(tmp_path / "faq_index.bin")
+    build_index(DATA_DIR, path)
+    responder = FaqResponder(path, reload_interval=0)
+
+    assert responder.answer("checkout time?").startswith("Check-in time is after 3 PM")
+    assert responder.answer("wifi password").startswith("The Wi-Fi password is")
+    assert responder.answer("metro station").startswith("The nearest metro station")
+    assert responder.answer("washing machine").startswith("Yes, we have a washing machine")
@@ -0,0 +1,131 @@
+import json
+import time
+
+from conftest import text_message, webhook_body
+
+from app import start_serving
+from app.services.inbound_queue import InboundQueue
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def put_message(queue, wa_id="919999999999", text="hello", message_id="wamid.q1"):
+    body = webhook_body(text_message(wa_id, text, message_id))
+    queue.put(json.dumps(body).encode(), [message_id])
+
+
+def test_unacked_delivery_is_claimed_again_after_the_visibility_timeout(tmp_path):
+    queue = InboundQueue(str(tmp_path / "inbound.db"), visibility_timeout=0.2)
+    put_message(queue)
+
+    (first,) = queue.claim()
+    assert queue.claim() == []
+    assert queue.stats()["in_flight"] == 1
+
+    # The worker holding it died; nobody acks
+    time.sleep(0.25)
+    (again,) = queue.claim()
+    assert again.id == first.id
+    assert again.attempts == 2
+
+    queue.ack(again)
+    assert wait_for(lambda: queue.stats()["in_flight"] == 0)
+    assert queue.claim() == []
+
+
+def test_retry_backoff_counts_as_delayed_not_in_flight(tmp_path):
+    queue = InboundQueue(str(tmp_path / "inbound.db"))
+    put_message(queue)
+    (delivery,) = queue.claim()
+
+    queue.retry(delivery, "reply failed")
+
+    assert wait_for(lambda: queue.stats()["delayed"] == 1)
+    assert queue.stats()["in_flight"] == 0
+
+
+def test_delivery_is_parked_after_max_attempts_and_can_be_requeued(tmp_path):
+    queue = InboundQueue(str(tmp_path / "inbound.db"), visibility_timeout=0, max_attempts=2)
+    put_message(queue)
+
+    (delivery,) = queue.claim()
+    queue.retry(delivery, "reply failed")
+    assert wait_for(lambda: queue.stats()["delayed"] == 1)
+    # Skip the backoff
+    queue._connection().execute("UPDATE inbound SET visible_at = 0")
+
+    (delivery,) = queue.claim()
+    queue.retry(delivery, "reply failed")
+    assert wait_for(lambda: queue.stats()["dead"] == 1)
+    assert queue.claim() == []
+
+    assert queue.requeue() == 1
+    (delivery,) = queue.claim()
+    assert delivery.attempts == 1
+
+
+def test_server_start_replays_the_backlog_without_a_request(make_app, sent, tmp_path):
+    path = str(tmp_path / "inbound.db")
+    # Left behind by a server that crashed after the 200
+    put_message(InboundQueue(path), text="hello", message_id="wamid.crash")
+
+    app = make_app(INBOUND_QUEUE_PATH=path)
+    queue = app.extensions["inbound_queue"]
+    assert queue.stats()["ready"] == 1
+
+    start_serving(app)
+
+    assert wait_for(lambda: sent)
+    assert sent[0]["to"] == "919999999999"
+    assert wait_for(lambda: sum(queue.stats()[state] for state in ("ready", "in_flight", "delayed")) == 0)
+
+
+def test_renewed_lease_is_not_claimed_again(tmp_path):
+    queue = InboundQueue(str(tmp_path / "inbound.db"), visibility_timeout=0.3)
+    put_message(queue)
+    (delivery,) = queue.claim()
+
+    time.sleep(0.2)
+    queue.extend([delivery])
+    assert wait_for(lambda: queue._connection().execute(
+        "SELECT visible_at FROM inbound"
+    ).fetchone()[0] > time.time() + 0.2)
+
+    time.sleep(0.15)
+    assert queue.claim() == []
+
+
+def test_consumer_keeps_the_lease_of_a_slow_reply(make_app, monkeypatch, tmp_path):
+    import threading
+
+    from app.services import inbound_queue
+
+    release = threading.Event()
+    answered = []
+
+    def slow_burst(wa_id, events, receipt=None):
+        answered.append(wa_id)
+        release.wait(5)
+
+    monkeypatch.setattr(inbound_queue, "process_burst", slow_burst)
+    app = make_app()
+    queue = InboundQueue(str(tmp_path / "inbound.db"), visibility_timeout=0.2)
+    consumer = inbound_queue.QueueConsumer(queue, app, poll_interval=0.01)
+    put_message(queue)
+    consumer.start()
+
+    assert wait_for(lambda: answered)
+    # Well past the visibility timeout, while the reply is still going
+    time.sleep(0.5)
+    assert queue.stats()["in_flight"] == 1
+    assert queue._connection().execute("SELECT attempts FROM inbound").fetchone()[0] == 1
+
+    release.set()
+    assert wait_for(lambda: queue.stats()["in_flight"] == 0)
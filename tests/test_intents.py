@@ -0,0 +1,34 @@
+import os
+
+import pytest
+
+from app.services.flow_registry import FlowRegistry
+
+FLOWS_PATH = os.path.join(os.path.dirname(__file__), "..", "app", "flows", "flows.json")
+
+
+@pytest.fixture(scope="module")
+def flows():
+    return FlowRegistry(FLOWS_PATH)
+
+
+@pytest.mark.parametrize("text,flow", [
+    ("Hi", "greeting"),
+    ("namaste ji", "greeting"),
+    ("Yuva Yatra 1 details please", "yuva_yatra_1"),
+    ("Yuva Yatra I", "yuva_yatra_1"),
+    ("2", "yuva_yatra_2"),
+    ("family tour for 4 people", "parivar_pravaas"),
+])
+def test_known_intents_get_their_flow(flows, text, flow):
+    assert flows.flow_for_text(text) == flow
+
+
+@pytest.mark.parametrize("text", [
+    "this ship leaves when?",
+    "yuva yatra i want details",
+    "I'd rate it 5",
+    "what is the price?",
+])
+def test_other_text_is_left_to_the_faq_and_assistant(flows, text):
+    assert flows.flow_for_text(text) is None
@@ -0,0 +1,87 @@
+import hashlib
+import json
+import time
+
+from conftest import post_webhook, text_message, webhook_body
+
+from app import start_serving
+from app.services.flow_registry import FlowRegistry
+from app.services.media_manager import MEDIA_TTL_SECONDS, MediaManager
+
+
+ASSETS = {
+    "brochure": ("brochure.pdf", "application/pdf", None),
+    "poster": ("poster.jpeg", "image/jpeg", "12345"),
+}
+
+
+def write_flows(path):
+    path.write_text(json.dumps({
+        "buttons": {},
+        "intents": {},
+        "flows": {
+            "brochure": [
+                {"to": "{{to}}", "type": "document", "document": {"id": "{{media:brochure}}"}},
+                {"to": "{{to}}", "type": "text", "text": {"body": "Hi {{name}}"}},
+            ],
+        },
+    }))
+    return str(path)
+
+
+def test_missing_asset_without_fixed_id_resolves_to_none(tmp_path):
+    manager = MediaManager(None, str(tmp_path), str(tmp_path / "cache.json"), assets=ASSETS)
+
+    assert manager.resolve("brochure") is None
+    assert manager.resolve("poster") == "12345"
+    assert manager.resolve("unknown") is None
+    assert manager.validate() == ["brochure"]
+
+
+def test_flow_skips_messages_whose_media_has_no_id(tmp_path):
+    manager = MediaManager(None, str(tmp_path), str(tmp_path / "cache.json"), assets=ASSETS)
+    registry = FlowRegistry(write_flows(tmp_path / "flows.json"))
+
+    payloads = registry.render("brochure", "919999999999", "Asha", manager.resolve)
+
+    assert [json.loads(payload)["type"] for payload in payloads] == ["text"]
+
+
+def test_extra_number_never_sends_a_none_media_id(make_app, sent, tmp_path):
+    numbers = tmp_path / "numbers.json"
+    numbers.write_text(json.dumps({"numbers": {"222": {"access_token": "other-token"}}}))
+    app = make_app(NUMBERS_PATH=str(numbers))
+    assert "yuva_yatra_1" in app.extensions["number_registry"].get("222").media_manager.validate()
+
+    response = post_webhook(
+        app.test_client(),
+        webhook_body(text_message("919999999999", "yuva yatra 1"), phone_number_id="222"),
+    )
+
+    assert response.status_code == 200
+    assert sent, "the flow's text message should still go out"
+    assert all(payload["type"] != "document" for payload in sent)
+    assert "None" not in json.dumps(sent)
+
+
+def test_expired_id_is_not_sent_while_uploads_are_backing_off(tmp_path):
+    (tmp_path / "poster.jpeg").write_bytes(b"jpeg")
+    digest = hashlib.sha256(b"jpeg").hexdigest()
+    expired = {"media_id": "old", "uploaded_at": time.time() - MEDIA_TTL_SECONDS - 1}
+    (tmp_path / "cache.json").write_text(json.dumps({digest: expired}))
+    manager = MediaManager(None, str(tmp_path), str(tmp_path / "cache.json"), assets=ASSETS)
+    # A failed upload a moment ago
+    manager._failed_at["poster"] = time.time()
+
+    assert manager.resolve("poster") == "12345"
+
+
+def test_media_refresher_starts_with_the_server_not_the_app(make_app, monkeypatch):
+    monkeypatch.setattr(MediaManager, "prewarm", lambda self: None)
+    app = make_app(MEDIA_PREWARM="true")
+    media_manager = app.extensions["media_manager"]
+    assert media_manager._refresher is None
+
+    start_serving(app)
+
+    assert media_manager._refresher is not None
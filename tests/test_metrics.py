@@ -0,0 +1,104 @@
+import json
+import os
+
+import pytest
+
+from app.services.inbound_queue import QueueWriteError
+from app.services.metrics import Gauge, Histogram, MetricsExporter, MetricsRegistry, merge, render
+from app.services.scheduler import QueueFullError
+from conftest import post_webhook, text_message, webhook_body
+
+
+def scrape(client):
+    response = client.get("/metrics", headers={"Authorization": "Bearer metrics-token"})
+    assert response.status_code == 200
+    return response.get_data(as_text=True)
+
+
+def test_histogram_renders_cumulative_buckets():
+    registry = MetricsRegistry()
+    histogram = Histogram("t_seconds", "Test.", ["path"], buckets=(0.1, 1.0), registry=registry)
+    for value in (0.05, 0.5, 5.0):
+        histogram.labels("/webhook").observe(value)
+    text = MetricsExporter(registry).render()
+    assert 't_seconds_bucket{path="/webhook",le="0.1"} 1' in text
+    assert 't_seconds_bucket{path="/webhook",le="1.0"} 2' in text
+    assert 't_seconds_bucket{path="/webhook",le="+Inf"} 3' in text
+    assert 't_seconds_count{path="/webhook"} 3' in text
+
+
+def test_label_values_are_escaped():
+    registry = MetricsRegistry()
+    Gauge("t_depth", "Test.", lambda: {('say "hi"\n',): 1}, ["q"], registry=registry)
+    assert 't_depth{q="say \\"hi\\"\\n"} 1' in MetricsExporter(registry).render()
+
+
+def test_snapshots_from_several_processes_add_up(tmp_path):
+    registry = MetricsRegistry()
+    histogram = Histogram("t_seconds", "Test.", buckets=(1.0,), registry=registry)
+    Gauge("t_depth", "Test.", lambda: 2, registry=registry)
+    histogram.observe(0.5)
+    exporter = MetricsExporter(registry, directory=str(tmp_path))
+    # A worker that has exited: its histogram counts, its gauge doesn't
+    exited = {"pid": 999999999, "metrics": registry.snapshot()}
+    (tmp_path / "metrics.999999999.json").write_text(json.dumps(exited))
+    text = exporter.render()
+    assert "t_seconds_count 2" in text
+    assert "t_depth 2" in text
+    assert os.path.exists(tmp_path / f"metrics.{os.getpid()}.json")
+
+
+def test_gauges_in_max_mode_take_the_largest_value():
+    snapshot = {"d": {"type": "gauge", "help": "", "labelnames": [], "mode": "max", "samples": [[[], 3]]}}
+    other = {"d": {**snapshot["d"], "samples": [[[], 5]]}}
+    assert "d 5" in render(merge([(1, snapshot), (2, other)]))
+
+
+@pytest.mark.parametrize("failure", ["dispatcher_full", "queue_write"])
+def test_busy_webhooks_keep_metrics_scrapeable(make_app, sent, monkeypatch, tmp_path, failure):
+    if failure == "queue_write":
+        app = make_app(INBOUND_QUEUE_PATH=str(tmp_path / "inbound.db"))
+
+        def put(payload, message_ids):
+            raise QueueWriteError("disk full")
+
+        monkeypatch.setattr(app.extensions["inbound_queue"], "put", put)
+    else:
+        app = make_app()
+
+        def submit_all(jobs):
+            raise QueueFullError("full")
+
+        monkeypatch.setattr(app.extensions["webhook_dispatcher"], "submit_all", submit_all)
+    client = app.test_client()
+    for n in range(2):
+        response = post_webhook(client, webhook_body(text_message("919000000001", f"question {n}")))
+        assert response.status_code == 503
+
+    text = scrape(client)
+    assert 'whatsapp_webhook_seconds_count{event="message"}' in text
+    assert "TextMessage" not in text
+    assert "question 0" not in text and "question 1" not in text
+
+
+def test_webhook_and_send_latency_are_recorded(make_app, sent):
+    client = make_app().test_client()
+    post_webhook(client, webhook_body(text_message("919000000002", "hi")))
+    text = scrape(client)
+    assert 'whatsapp_send_message_seconds_count{status="200"}' in text
+    assert "whatsapp_dispatch_queue_depth 0" in text
+
+
+def test_metrics_are_closed_without_a_token(make_app):
+    client = make_app(METRICS_TOKEN="").test_client()
+
+    assert client.get("/metrics").status_code == 403
+    assert client.get("/metrics", headers={"Authorization": "Bearer "}).status_code == 403
+
+
+def test_metrics_require_their_token(make_app):
+    client = make_app().test_client()
+
+    assert client.get("/metrics").status_code == 401
+    assert client.get("/metrics", headers={"Authorization": "Bearer wrong"}).status_code == 401
+    assert client.get("/metrics", headers={"Authorization": "Bearer metrics-token"}).status_code == 200
@@ -0,0 +1,27 @@
+from app.services.response_cache import ResponseCache, normalize_question
+
+
+def test_rephrasings_of_one_question_share_a_key():
+    assert normalize_question("What is the price?") == normalize_question("what is your price")
+
+
+def test_different_question_words_get_different_keys():
+    keys = {
+        normalize_question(question)
+        for question in (
+            "When is the pickup?",
+            "Where is the pickup?",
+            "Who does the pickup?",
+            "How is the pickup?",
+        )
+    }
+
+    assert len(keys) == 4
+
+
+def test_where_question_does_not_get_the_when_answer(tmp_path):
+    cache = ResponseCache(sqlite_path=str(tmp_path / "answers.db"))
+    cache.set("When is the pickup?", "At 6 am.")
+
+    assert cache.get("Where is the pickup?") is None
+    assert cache.get("when is the pickup") == "At 6 am."
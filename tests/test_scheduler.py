@@ -0,0 +1,79 @@
+import threading
+import time
+
+import pytest
+
+from app.services.scheduler import KeyedScheduler, QueueFullError
+from app.utils.debounce import KeyedDebouncer
+
+
+def test_jobs_for_one_key_run_in_order():
+    scheduler = KeyedScheduler(max_concurrency=4)
+    order = []
+
+    def job(n):
+        time.sleep(0.001 * (5 - n))
+        order.append(n)
+
+    futures = [scheduler.submit("91", job, n) for n in range(5)]
+    for future in futures:
+        future.result(timeout=5)
+    assert order == [0, 1, 2, 3, 4]
+
+
+def test_different_keys_run_in_parallel():
+    scheduler = KeyedScheduler(max_concurrency=2)
+    both_running = threading.Barrier(2, timeout=5)
+    futures = [scheduler.submit(key, both_running.wait) for key in ("91", "92")]
+    for future in futures:
+        future.result(timeout=5)
+
+
+def test_full_queue_rejects_the_whole_batch():
+    scheduler = KeyedScheduler(max_concurrency=1, capacity=2)
+    release = threading.Event()
+    scheduler.submit("91", release.wait)
+    with pytest.raises(QueueFullError):
+        scheduler.submit_many([("92", print, ()), ("93", print, ())])
+    assert scheduler.pending() == 1
+    release.set()
+
+
+def test_failed_job_does_not_stop_its_lane():
+    scheduler = KeyedScheduler(max_concurrency=1)
+
+    def fail():
+        raise RuntimeError("boom")
+
+    failed = scheduler.submit("91", fail)
+    after = scheduler.submit("91", lambda: "ok")
+    with pytest.raises(RuntimeError):
+        failed.result(timeout=5)
+    assert after.result(timeout=5) == "ok"
+
+
+def test_debouncer_merges_a_burst_into_one_flush():
+    flushed = []
+    done = threading.Event()
+
+    def flush(key, items):
+        flushed.append((key, items))
+        done.set()
+
+    debouncer = KeyedDebouncer(flush, window=0.05, max_wait=1.0)
+    for text in ("hi", "hello", "namaste"):
+        debouncer.push("91", text)
+    assert debouncer.backlog() == 3
+    assert done.wait(5)
+    assert flushed == [("91", ["hi", "hello", "namaste"])]
+
+
+def test_inbound_debouncing_is_off_by_default(monkeypatch):
+    from flask import Flask
+
+    from app.config import load_configurations
+
+    monkeypatch.delenv("INBOUND_DEBOUNCE_SECONDS", raising=False)
+    app = Flask("app")
+    load_configurations(app)
+    assert app.config["INBOUND_DEBOUNCE_SECONDS"] == 0
@@ -0,0 +1,41 @@
+from app.services.status_pipeline import StatusPipeline
+from app.utils.webhook_parser import StatusUpdate
+
+
+def update(message_id, state, timestamp, errors=None):
+    return StatusUpdate(
+        state,
+        errors,
+        wa_id="919999999999",
+        name=None,
+        message_id=message_id,
+        timestamp=str(timestamp),
+        phone_number_id="111",
+    )
+
+
+def test_latencies_pair_up_across_flushes_and_redeliveries_count_once(tmp_path):
+    pipeline = StatusPipeline(str(tmp_path / "statuses.db"), batch_size=2)
+    now = 1700000000
+    pipeline.record([update("wamid.1", "sent", now), update("wamid.2", "sent", now)])
+    pipeline.flush()
+
+    pipeline.record([
+        update("wamid.1", "delivered", now + 4),
+        update("wamid.1", "delivered", now + 9),  # redelivered
+        update("wamid.1", "read", now + 10),
+        update("wamid.2", "failed", now + 1, [{"code": 131026}]),
+        update("wamid.3", "read", now + 3),  # before its delivered
+        update("wamid.3", "delivered", now + 2),
+    ])
+    assert pipeline.flush() == 6
+
+    counts = pipeline._connection().execute(
+        "SELECT SUM(sent), SUM(delivered), SUM(read), SUM(failed), "
+        "SUM(delivery_latency_sum), SUM(delivery_latency_count), "
+        "SUM(read_latency_sum), SUM(read_latency_count) FROM status_hourly"
+    ).fetchone()
+    assert counts == (2, 2, 2, 1, 4, 1, 7, 2)
+    assert pipeline._connection().execute(
+        "SELECT error_code, count FROM status_errors"
+    ).fetchall() == [(131026, 1)]
@@ -0,0 +1,27 @@
+from app.services.thread_store import SQLiteThreadStore
+
+
+def test_other_workers_follow_a_rotated_thread(tmp_path):
+    path = str(tmp_path / "threads.db")
+    # Two gunicorn workers sharing one file
+    first, second = SQLiteThreadStore(path), SQLiteThreadStore(path)
+    first.set("919999999999", "thread_old")
+    assert second.get("919999999999") == "thread_old"
+
+    assert first.replace_thread("919999999999", "thread_old", "thread_new", message_count=1)
+
+    assert second.current("919999999999") == ("thread_new", 1)
+    assert second.get("919999999999") == "thread_new"
+
+
+def test_counting_on_a_replaced_thread_drops_the_cached_id(tmp_path):
+    path = str(tmp_path / "threads.db")
+    first, second = SQLiteThreadStore(path), SQLiteThreadStore(path)
+    first.set("919999999999", "thread_old")
+    assert second.get("919999999999") == "thread_old"
+    first.replace_thread("919999999999", "thread_old", "thread_new", message_count=1)
+
+    assert second.add_messages("919999999999", "thread_old") == 1
+
+    assert second.get("919999999999") == "thread_new"
+    assert second.add_messages("919999999999", "thread_new") == 2
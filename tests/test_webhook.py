@@ -0,0 +1,74 @@
+import time
+
+from conftest import post_webhook, status, text_message, webhook_body
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_badly_signed_webhook_is_refused(make_app, sent):
+    client = make_app().test_client()
+    body = webhook_body(text_message("919999999999", "hi"))
+
+    assert post_webhook(client, body, secret="wrong").status_code == 403
+    assert sent == []
+
+
+def test_every_entry_and_change_of_a_batch_is_answered(make_app, sent):
+    client = make_app().test_client()
+    body = webhook_body(text_message("919000000001", "hi"))
+    second = webhook_body(text_message("919000000002", "hi"))
+    body["entry"].append(second["entry"][0])
+
+    assert post_webhook(client, body).status_code == 200
+
+    assert {payload["to"] for payload in sent} == {"919000000001", "919000000002"}
+
+
+def test_async_dispatch_acknowledges_before_replying(make_app, sent):
+    client = make_app(DISPATCH_MODE="async").test_client()
+
+    response = post_webhook(client, webhook_body(text_message("919999999999", "hi")))
+
+    assert response.status_code == 200
+    assert wait_for(lambda: sent)
+    assert sent[0]["to"] == "919999999999"
+
+
+def test_status_updates_reach_the_analytics(make_app):
+    app = make_app()
+    client = app.test_client()
+    body = webhook_body(statuses=[status("wamid.1", "sent"), status("wamid.1", "delivered")])
+
+    assert post_webhook(client, body).status_code == 200
+    app.extensions["status_pipeline"].flush()
+
+    response = client.get(
+        "/analytics/statuses?hours=1000000",
+        headers={"Authorization": "Bearer analytics-token"},
+    )
+    assert response.status_code == 200
+    assert response.json["delivered"] == 1
+
+
+def test_status_analytics_are_closed_without_a_token(make_app):
+    client = make_app(ANALYTICS_TOKEN="").test_client()
+
+    assert client.get("/analytics/statuses").status_code == 403
+    assert client.get("/analytics/statuses", headers={"Authorization": "Bearer "}).status_code == 403
+
+
+def test_status_analytics_require_their_token(make_app):
+    client = make_app().test_client()
+
+    assert client.get("/analytics/statuses").status_code == 401
+    assert client.get("/analytics/statuses", headers={"Authorization": "Bearer wrong"}).status_code == 401
+    assert client.get(
+        "/analytics/statuses", headers={"Authorization": "Bearer analytics-token"}
+    ).status_code == 200
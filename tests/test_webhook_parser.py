@@ -0,0 +1,33 @@
+import pytest
+
+from conftest import post_webhook, text_message, webhook_body
+
+from app.utils import webhook_parser
+from app.utils.webhook_parser import ButtonReply, TextMessage, parse_webhook
+
+
+def test_malformed_sub_objects_are_skipped_not_raised():
+    body = webhook_body(
+        text_message("919999999999", "hi"),
+        {"from": "919999999999", "id": "wamid.b", "type": "interactive",
+         "interactive": {"type": "button_reply", "button_reply": "oops"}},
+    )
+    value = body["entry"][0]["changes"][0]["value"]
+    value["metadata"] = "not an object"
+    value["contacts"][0]["profile"] = ["not", "an", "object"]
+
+    batch = parse_webhook(body)
+
+    text, button = batch.messages
+    assert isinstance(text, TextMessage) and text.phone_number_id is None and text.name == ""
+    assert isinstance(button, ButtonReply) and button.button_id is None
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_bodies_that_are_not_utf8_json_get_a_400(make_app, monkeypatch, use_orjson):
+    if not use_orjson:
+        monkeypatch.setattr(webhook_parser, "orjson", None)
+    client = make_app().test_client()
+
+    for raw in (b'{"object": "\xff"}', b"\xff\xfe", b"{not json"):
+        assert post_webhook(client, raw).status_code == 400